@@ -0,0 +1,103 @@
+import os
+import threading
+from collections import deque
+from metrics import get_metrics
+
+# "on" lets the local scripts find the number of requests in flight per model and server on
+# their own; "off" keeps it at the parallel requests of the server (OLLAMA_NUM_PARALLEL)
+ADAPTIVE_CONCURRENCY = os.environ.get("CTA_ADAPTIVE_CONCURRENCY", "on")
+# Upper bound as a multiple of the server's parallel requests (the limit starts at 1x)
+MAX_PARALLEL_FACTOR = float(os.environ.get("CTA_MAX_PARALLEL_FACTOR", 2))
+# The limit is lowered when the smoothed latency exceeds its recent best by this factor
+LATENCY_TOLERANCE = float(os.environ.get("CTA_LATENCY_TOLERANCE", 2.0))
+# Share kept of the limit after a timeout, a server error or a latency jump
+BACKOFF = 0.75
+# Weight of the newest latency in the smoothed latency, and the requests the best one is kept for
+SMOOTHING = 0.2
+LATENCY_WINDOW = 200
+
+
+def max_limit(num_parallel):
+    if ADAPTIVE_CONCURRENCY != 'on':
+        return num_parallel
+    return max(num_parallel, int(num_parallel * MAX_PARALLEL_FACTOR))
+
+
+class AdaptiveLimit:
+    # AIMD limit of the requests in flight for one model on one server. Every `limit` requests
+    # that completed in time while the limit was used up raise it by one; a failed request or a
+    # smoothed latency above LATENCY_TOLERANCE x its recent best cuts it to BACKOFF x limit.
+    # Latency is tracked per kind of request, as a score-only answer stops after a few tokens while
+    # an audited or batched one is generated in full.
+    # The requests already in flight at a cut are not counted again, so one jam cuts once.
+    # Several limits can share one condition, so a pool can wait for any of its servers.
+    def __init__(self, name, initial, maximum, condition=None):
+        self.name = name
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.condition = condition or threading.Condition()
+        self.in_flight = 0
+        self.successes = 0
+        self.ignore = 0
+        self.smoothed = {}
+        self.recent = {}
+        self._publish()
+
+    @property
+    def current(self):
+        return max(1, int(self.limit))
+
+    # Function to count the free slots (call with the condition held)
+    def free(self):
+        return self.current - self.in_flight
+
+    # Function to take a slot that is known to be free (call with the condition held)
+    def take(self):
+        self.in_flight += 1
+
+    def acquire(self):
+        with self.condition:
+            while self.free() <= 0:
+                self.condition.wait()
+            self.take()
+
+    # Function to give the slot back with what was observed: the latency in seconds and whether
+    # the server coped (False for timeouts, connection errors, 429 and 5xx answers)
+    def release(self, latency, ok, kind="full"):
+        with self.condition:
+            saturated = self.in_flight >= self.current
+            self.in_flight -= 1
+            if ADAPTIVE_CONCURRENCY == 'on':
+                self._update(latency, ok, saturated, kind)
+            self.condition.notify_all()
+
+    def _update(self, latency, ok, saturated, kind):
+        previous = self.current
+        reason = None
+        recent = self.recent.setdefault(kind, deque(maxlen=LATENCY_WINDOW))
+        if ok:
+            smoothed = self.smoothed.get(kind)
+            self.smoothed[kind] = latency if smoothed is None else SMOOTHING * latency + (1 - SMOOTHING) * smoothed
+            recent.append(self.smoothed[kind])
+        if self.ignore > 0:
+            self.ignore -= 1
+            return
+        if not ok:
+            reason = "request failed"
+        elif len(recent) >= 10 and self.smoothed[kind] > LATENCY_TOLERANCE * min(recent):
+            reason = f"{kind} latency {self.smoothed[kind] / min(recent):.1f}x its best"
+        if reason is not None:
+            self.limit = max(1.0, self.limit * BACKOFF)
+            self.successes = 0
+            self.ignore = self.in_flight
+        elif saturated:
+            self.successes += 1
+            if self.successes >= self.current:
+                self.limit = min(float(self.maximum), self.limit + 1)
+                self.successes = 0
+        if self.current != previous:
+            print(f"Concurrency limit {self.name}: {previous} -> {self.current}" + (f" ({reason})" if reason else ""))
+            self._publish()
+
+    def _publish(self):
+        get_metrics().set_gauge(f"concurrency_limit[{self.name}]", self.current)
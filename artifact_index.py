@@ -0,0 +1,203 @@
+import os
+import json
+import bisect
+
+INDEX_FILENAME = 'artifact_index.json'
+INDEX_VERSION = 1
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Sidecar suffixes mapped to the key they are stored under for a post.
+# Longer suffixes come first so "-cta-img-loc.json" is not taken for "-cta-img.json".
+SIDECAR_SUFFIXES = [
+    ('-cta-img-loc.json', 'cta_img_loc'),
+    ('-cta-img.json', 'cta_img'),
+    ('-cta-txt-loc.json', 'cta_txt_loc'),
+    ('-cta-txt-llava.json', 'cta_txt_llava'),
+    ('-cta-txt.json', 'cta_txt'),
+    ('-cta-local.json', 'cta_local'),
+]
+
+SUFFIX_BY_KIND = {kind: suffix for suffix, kind in SIDECAR_SUFFIXES}
+
+# Characters that may follow a post ID in the name of one of its artifacts
+ID_SEPARATORS = ('_', '-', '.')
+
+
+def sidecar_kind(filename):
+    for suffix, kind in SIDECAR_SUFFIXES:
+        if filename.endswith(suffix):
+            return kind
+    return None
+
+
+def is_sidecar(filename):
+    return sidecar_kind(filename) is not None
+
+
+def is_image(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def is_post_json(filename):
+    return filename.endswith('.json') and not is_sidecar(filename)
+
+
+# Function to load a previously saved index (or an empty one)
+def load_index(root_directory):
+    index_path = os.path.join(root_directory, INDEX_FILENAME)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version': INDEX_VERSION, 'dirs': {}}
+
+
+def save_index(root_directory, index):
+    index_path = os.path.join(root_directory, INDEX_FILENAME)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+
+
+# Function to list one directory of the tree as an index entry (raises OSError if it is gone)
+def scan_directory(root_directory, rel_dir, mtime=None):
+    abs_dir = os.path.join(root_directory, rel_dir)
+    if mtime is None:
+        mtime = os.stat(abs_dir).st_mtime
+    files, subdirs = [], []
+    with os.scandir(abs_dir) as it:
+        for dir_entry in it:
+            if dir_entry.is_dir(follow_symlinks=False):
+                subdirs.append(dir_entry.name)
+            elif dir_entry.name != INDEX_FILENAME:
+                files.append(dir_entry.name)
+    return {'mtime': mtime, 'files': sorted(files), 'subdirs': sorted(subdirs)}
+
+
+# Function to bring the index up to date. Only directories whose mtime changed
+# since the last run are listed again; all others reuse their stored entries.
+def refresh_index(root_directory, index=None):
+    if index is None:
+        index = load_index(root_directory)
+    old_dirs = index['dirs']
+    new_dirs = {}
+    rescanned = 0
+
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        abs_dir = os.path.join(root_directory, rel_dir)
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+        except OSError:
+            continue
+
+        entry = old_dirs.get(rel_dir)
+        if entry is None or entry['mtime'] != mtime:
+            try:
+                entry = scan_directory(root_directory, rel_dir, mtime)
+            except OSError:
+                continue
+            rescanned += 1
+
+        new_dirs[rel_dir] = entry
+        for subdir in entry['subdirs']:
+            stack.append(os.path.join(rel_dir, subdir))
+
+    index['dirs'] = new_dirs
+    index['rescanned_dirs'] = rescanned
+    return index
+
+
+def update_index(root_directory):
+    index = refresh_index(root_directory)
+    save_index(root_directory, index)
+    return ArtifactIndex(root_directory, index)
+
+
+class ArtifactIndex:
+    def __init__(self, root_directory, index):
+        self.root_directory = root_directory
+        self.index = index
+        # Sorted (filename, relative directory) pairs for prefix lookups
+        self._names = sorted(
+            (filename, rel_dir)
+            for rel_dir, entry in index['dirs'].items()
+            for filename in entry['files']
+        )
+        self._keys = [name for name, _ in self._names]
+
+    def __len__(self):
+        return len(self._names)
+
+    def iter_files(self):
+        for filename, rel_dir in self._names:
+            yield os.path.join(self.root_directory, rel_dir, filename)
+
+    # Function to list all indexed files whose name starts with the given prefix
+    def files_with_prefix(self, prefix):
+        position = bisect.bisect_left(self._keys, prefix)
+        while position < len(self._names) and self._keys[position].startswith(prefix):
+            yield self._names[position]
+            position += 1
+
+    def post_ids(self):
+        return [os.path.splitext(filename)[0] for filename, _ in self._names if is_post_json(filename)]
+
+    # Function to collect every artifact belonging to one post
+    def lookup(self, post_id):
+        base_name = os.path.splitext(post_id)[0]
+        artifacts = {
+            'original': None,
+            'directory': None,
+            'images': [],
+            'cta_img': [],
+            'cta_img_loc': [],
+            'cta_txt': None,
+            'cta_txt_loc': None,
+            'cta_txt_llava': None,
+            'cta_local': None,
+        }
+
+        candidates = []
+        for filename, rel_dir in self.files_with_prefix(base_name):
+            rest = filename[len(base_name):]
+            if rest and not rest.startswith(ID_SEPARATORS):
+                continue
+            if filename == base_name + '.json':
+                artifacts['original'] = filename
+                artifacts['directory'] = rel_dir
+            else:
+                candidates.append((filename, rel_dir))
+
+        # Post IDs may contain underscores ("C04Fy4zqy_I"), so "C04Fy4zqy" is a prefix of another
+        # post. Every post has its own folder, so only files next to the original JSON count.
+        for filename, rel_dir in candidates:
+            if artifacts['directory'] is not None and rel_dir != artifacts['directory']:
+                continue
+            if is_image(filename):
+                artifacts['images'].append(filename)
+            else:
+                kind = sidecar_kind(filename)
+                if kind in ('cta_img', 'cta_img_loc'):
+                    artifacts[kind].append(filename)
+                elif kind is not None and filename == base_name + SUFFIX_BY_KIND[kind]:
+                    artifacts[kind] = filename
+
+        return artifacts
+
+    def path_of(self, artifacts, filename):
+        return os.path.join(self.root_directory, artifacts['directory'] or '', filename)
+
+
+if __name__ == "__main__":
+    import sys
+    root_directory = sys.argv[1] if len(sys.argv) > 1 else r'C:\git\SocialReporter\data'
+    artifact_index = update_index(root_directory)
+    print(f"Indexed {len(artifact_index)} files "
+          f"({artifact_index.index['rescanned_dirs']} directories rescanned).")
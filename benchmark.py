@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from PIL import Image, ImageDraw
+from results_store import SqliteStore
+from fake_model_servers import FakeModelConfig, FakeOllamaHandler, FakeOpenAIHandler, start_server, server_url
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Script, results method and backend of every pipeline
+PIPELINES = {
+    'cta-img-api': {'script': 'cta-img-api.py', 'method': 'img-api', 'backend': 'openai'},
+    'cta-img-loc': {'script': 'cta-img-loc.py', 'method': 'img-loc', 'backend': 'ollama'},
+    'cta-text-api': {'script': 'cta-text-api.py', 'method': 'txt-api', 'backend': 'openai'},
+    'cta-txt-loc': {'script': 'cta-txt-loc.py', 'method': 'local', 'backend': 'ollama', 'flat': True},
+    'cta-img-loc-6months': {'script': 'cta-img-loc-6months.py', 'method': 'img-loc', 'backend': 'ollama'},
+    'cta-txt-loc-6months': {'script': 'cta-txt-loc-6months.py', 'method': 'txt-loc', 'backend': 'ollama'},
+    # One request per post; the files column counts the image results
+    'cta-post-api': {'script': 'cta-post.py', 'args': ['--backend', 'api'], 'method': 'img-api', 'backend': 'openai'},
+    'cta-post-loc': {'script': 'cta-post.py', 'args': ['--backend', 'loc'], 'method': 'img-loc', 'backend': 'ollama'},
+}
+
+CAPTIONS = [
+    "Jetzt bewerben! Die Bewerbungsphase für das Wintersemester läuft bis zum 15. Juli.",
+    "Impressionen vom Campusfest am Wochenende.",
+    "Join us for the open day and meet our students. Register via the link in bio!",
+    "Our research team published new results on renewable energy storage.",
+    "Schaut vorbei: Infoabend zum Masterstudium am Donnerstag um 18 Uhr.",
+]
+
+
+# Function to create a synthetic data root: root/<account>/<post_id>/<post_id>.json plus images.
+# With flat=True all post JSON files are written into the root, as cta-txt-loc.py expects.
+def build_corpus(root_directory, posts, images_per_post=1, image_size=1080, flat=False, seed=0):
+    rng = random.Random(seed)
+    filenames = []
+    for index in range(posts):
+        post_id = f"B{index:06d}"
+        account = f"account{index % 5}"
+        post_directory = root_directory if flat else os.path.join(root_directory, account, post_id)
+        os.makedirs(post_directory, exist_ok=True)
+
+        # Every text and image is unique, so the result cache never hits
+        caption = f"{rng.choice(CAPTIONS)} #{index}"
+        post = {
+            'text': caption,
+            'caption': caption,
+            'time': f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00.000Z",
+            'likes': rng.randint(0, 500),
+            'comments': [],
+            'follower_count': 1000 + rng.randint(0, 9000),
+        }
+        with open(os.path.join(post_directory, f"{post_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(post, f, ensure_ascii=False)
+        filenames.append(f"{post_id}.json")
+
+        if flat:
+            continue
+        for number in range(1, images_per_post + 1):
+            image = Image.new('RGB', (image_size, image_size), tuple(rng.randint(0, 255) for _ in range(3)))
+            draw = ImageDraw.Draw(image)
+            for _ in range(8):
+                x, y = rng.randint(0, image_size - 1), rng.randint(0, image_size - 1)
+                draw.rectangle([x, y, x + rng.randint(20, image_size // 3), y + rng.randint(20, image_size // 3)],
+                               fill=tuple(rng.randint(0, 255) for _ in range(3)))
+            draw.text((20, 20), f"{post_id} {number}", fill=(255, 255, 255))
+            image.save(os.path.join(post_directory, f"{post_id}_{number}.png"))
+
+    # Input of the 6-month scripts
+    with open(os.path.join(root_directory, 'relevant_post_filenames.json'), 'w', encoding='utf-8') as f:
+        json.dump({'total_posts_from_dec_2023': len(filenames), 'filenames': filenames}, f)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+# Function to run one pipeline against a fresh corpus and return its measurements
+def run_pipeline(name, args, servers, work_directory):
+    pipeline = PIPELINES[name]
+    run_directory = os.path.join(work_directory, name)
+    root_directory = os.path.join(run_directory, 'data')
+    build_corpus(root_directory, args.posts, args.images_per_post, args.image_size, pipeline.get('flat', False), args.seed)
+
+    # equipment.py holds the local API key and directory; the benchmark brings its own
+    with open(os.path.join(run_directory, 'equipment.py'), 'w', encoding='utf-8') as f:
+        f.write(f"myKey = 'benchmark'\nmyDirectory = {root_directory!r}\n")
+
+    server = servers[pipeline['backend']]
+    server.config.reset()
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([run_directory, REPO_DIRECTORY]),
+        CTA_DATA_ROOT=root_directory,
+        CTA_RESULTS_STORE='sqlite',
+        CTA_CACHE_PATH=os.path.join(run_directory, 'cache.sqlite'),
+        CTA_IMAGE_CACHE_DIR=os.path.join(run_directory, 'images'),
+        CTA_METRICS_PATH=os.path.join(run_directory, 'metrics.json'),
+        OLLAMA_URL=server_url(servers['ollama']),
+        OLLAMA_NUM_PARALLEL=str(args.client_parallel or args.ollama_parallel),
+        OPENAI_BASE_URL=server_url(servers['openai']) + '/v1',
+        OPENAI_API_KEY='benchmark',
+        OPENAI_RPM=str(args.openai_rpm),
+        OPENAI_TPM=str(args.openai_tpm),
+        CTA_RULES=args.rules,
+        CTA_SCORE_ONLY=args.score_only,
+        CTA_AUDIT_RATE=str(args.audit_rate),
+        CTA_CAPTION_BATCH=str(args.caption_batch),
+        CTA_ADAPTIVE_CONCURRENCY=args.adaptive,
+    )
+    if args.max_in_flight:
+        env['CTA_MAX_IN_FLIGHT'] = str(args.max_in_flight)
+
+    log_path = os.path.join(run_directory, 'output.log')
+    start_time = time.time()
+    with open(log_path, 'w', encoding='utf-8') as log:
+        process = subprocess.run([sys.executable, os.path.join(REPO_DIRECTORY, pipeline['script'])] + pipeline.get('args', []),
+                                 cwd=run_directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall_time = time.time() - start_time
+
+    store = SqliteStore(root_directory)
+    results = [result for result in store.iter_results(pipeline['method']) if result['score'] is not None]
+    store.close()
+
+    # Per-stage timings written by the script itself
+    try:
+        with open(os.path.join(run_directory, 'metrics.json'), 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        stages = {stage: values['sum'] / values['count'] for stage, values in snapshot['stages'].items() if values['count']}
+        limits = {name: value for name, value in snapshot.get('gauges', {}).items() if name.startswith('concurrency_limit')}
+    except (OSError, ValueError, KeyError):
+        stages = {}
+        limits = {}
+
+    stats = server.config.stats()
+    latencies = [result['latency'] for result in results if result['latency'] is not None]
+    model_requests = max(stats['requests'], 1)
+    model_time = (stats['queue_time_total'] + stats['service_time_total']) / model_requests
+    mean_latency = sum(latencies) / len(latencies) if latencies else None
+    return {
+        'pipeline': name,
+        'exit_code': process.returncode,
+        'files': len(results),
+        'wall_time': wall_time,
+        'files_per_second': len(results) / wall_time if wall_time > 0 else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'model_requests': stats['requests'],
+        'model_errors': stats['errors'],
+        'model_cancelled': stats['cancelled'],
+        'model_max_in_flight': stats['max_in_flight'],
+        'model_time_mean': model_time,
+        # Time per file spent outside the model call (read, encode, HTTP, parse, queueing in the client)
+        'overhead_mean': mean_latency - model_time if mean_latency is not None else None,
+        'stage_means': stages,
+        # In-flight limits the adaptive controller ended the run with
+        'concurrency_limits': limits,
+        'log': log_path,
+    }
+
+
+def format_seconds(value):
+    return f"{value:8.3f}" if value is not None else "       -"
+
+
+def print_report(reports):
+    print(f"{'pipeline':22} {'files':>6} {'files/s':>8} {'p50 s':>8} {'p95 s':>8} {'model s':>8} {'overhead':>8} {'errors':>6}")
+    for report in reports:
+        files_per_second = report['files_per_second'] or 0.0
+        print(f"{report['pipeline']:22} {report['files']:6d} {files_per_second:8.2f} "
+              f"{format_seconds(report['latency_p50'])} {format_seconds(report['latency_p95'])} "
+              f"{format_seconds(report['model_time_mean'])} {format_seconds(report['overhead_mean'])} "
+              f"{report['model_errors']:6d}")
+        for name, value in sorted(report['concurrency_limits'].items()):
+            print(f"  {name}: {value} (server max. in flight {report['model_max_in_flight']})")
+        if report['exit_code'] != 0:
+            print(f"  exit code {report['exit_code']}, see {report['log']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the scoring scripts against local fake model servers.")
+    parser.add_argument('pipelines', nargs='*', default=list(PIPELINES), help=f"any of {', '.join(PIPELINES)} (default: all)")
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--images-per-post', type=int, default=1)
+    parser.add_argument('--image-size', type=int, default=1080)
+    parser.add_argument('--latency', default='lognormal:0.5,0.3',
+                        help="fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA (seconds)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument('--response', action='append', dest='responses',
+                        help="response text ({score} is replaced), can be given several times")
+    parser.add_argument('--ollama-parallel', type=int, default=4, help="parallel slots of the fake Ollama server")
+    parser.add_argument('--client-parallel', type=int, default=None,
+                        help="OLLAMA_NUM_PARALLEL the local scripts start with (default: --ollama-parallel)")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="CTA_MAX_IN_FLIGHT of the API scripts")
+    parser.add_argument('--openai-rpm', type=int, default=100000)
+    parser.add_argument('--openai-tpm', type=int, default=100000000)
+    parser.add_argument('--rules', choices=['on', 'off'], default='off',
+                        help="rule-based triage of the text scripts (off: every caption goes to the model)")
+    parser.add_argument('--score-only', choices=['on', 'off'], default='off',
+                        help="stream the local models and stop once the score is complete")
+    parser.add_argument('--audit-rate', type=float, default=0.05, help="share of items that keep the full reasoning in score-only mode")
+    parser.add_argument('--caption-batch', type=int, default=1, help="captions per request of the text scripts")
+    parser.add_argument('--adaptive', choices=['on', 'off'], default='on',
+                        help="CTA_ADAPTIVE_CONCURRENCY of the local scripts")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-directory', default=None, help="keep corpora and logs here instead of a temp directory")
+    parser.add_argument('--output', default=None, help="write the report as JSON")
+    args = parser.parse_args()
+    unknown = [name for name in args.pipelines if name not in PIPELINES]
+    if unknown:
+        parser.error(f"unknown pipeline: {', '.join(unknown)}")
+
+    servers = {
+        'ollama': start_server(FakeOllamaHandler, FakeModelConfig(args.latency, args.error_rate, 500, args.responses,
+                                                                  args.ollama_parallel, args.seed)),
+        'openai': start_server(FakeOpenAIHandler, FakeModelConfig(args.latency, args.error_rate, 429, args.responses,
+                                                                  seed=args.seed)),
+    }
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='cta-bench-')
+    reports = []
+    try:
+        for name in args.pipelines:
+            print(f"Running {name} ...")
+            reports.append(run_pipeline(name, args, servers, work_directory))
+    finally:
+        for server in servers.values():
+            server.shutdown()
+
+    print_report(reports)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+    if args.work_directory is None and all(report['exit_code'] == 0 for report in reports):
+        shutil.rmtree(work_directory, ignore_errors=True)
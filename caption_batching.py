@@ -0,0 +1,224 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import statistics
+from results_store import open_store
+
+# Captions packed into one request by the text scripts (1 = one request per caption)
+CAPTION_BATCH = int(os.environ.get("CTA_CAPTION_BATCH", 1))
+# Seconds a caption waits for the others of its batch before the batch is sent incomplete
+BATCH_WAIT = float(os.environ.get("CTA_CAPTION_BATCH_WAIT", 0.5))
+# Share of the batched captions that are scored on their own as well, for the calibration report
+CALIBRATION_RATE = float(os.environ.get("CTA_CALIBRATION_RATE", 0.05))
+
+BATCH_PROMPT_TEMPLATE = (
+    "Analyze each of the following {count} texts for a call to action.\n\n{items}\n\n"
+    "For every text return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action.\n"
+    "Respond with JSON only, in the form {{\"scores\": [{{\"id\": 1, \"score\": 0.5}}]}}, with one entry for every text id."
+)
+
+# JSON schema of the answer, passed as `format` to Ollama (OpenAI gets JSON mode instead)
+SCORES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scores": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, "score": {"type": "number"}},
+                "required": ["id", "score"],
+            },
+        },
+    },
+    "required": ["scores"],
+}
+
+
+def build_batch_prompt(texts):
+    items = "\n\n".join(f"Text {number}:\n\"\"\"\n{text}\n\"\"\"" for number, text in enumerate(texts, 1))
+    return BATCH_PROMPT_TEMPLATE.format(count=len(texts), items=items)
+
+
+# Function to read JSON from a model answer, which may wrap it in a code fence or prose
+def load_json(response_text):
+    try:
+        return json.loads(response_text)
+    except ValueError:
+        pass
+    match = re.search(r'[\[{].*[\]}]', response_text, re.DOTALL)
+    if match:
+        try:
+            return json.loads(match.group(0))
+        except ValueError:
+            pass
+    return None
+
+
+# Function to read the per-item scores of a batched answer into {id: score}. Items with a
+# missing, repeated or out-of-range id or score are left out, so they can be scored on their own.
+def parse_batch_scores(response_text, count):
+    data = load_json(response_text)
+    if isinstance(data, dict):
+        items = data.get('scores')
+        if items is None:
+            # {"1": 0.4, "2": 0.9}
+            items = [{'id': key, 'score': value} for key, value in data.items()]
+    else:
+        items = data
+    if not isinstance(items, list):
+        return {}
+
+    scores = {}
+    repeated = set()
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            item_id = int(item.get('id'))
+            score = float(item.get('score'))
+        except (TypeError, ValueError):
+            continue
+        if not 1 <= item_id <= count or not 0.0 <= score <= 1.0:
+            continue
+        if item_id in scores:
+            repeated.add(item_id)
+        scores[item_id] = round(score, 1)
+    for item_id in repeated:
+        del scores[item_id]
+    return scores
+
+
+# Function to pick the calibration sample; stable per text, like the audit sample of the local scripts
+def in_calibration_sample(text, rate=None):
+    rate = CALIBRATION_RATE if rate is None else rate
+    digest = hashlib.sha1(text.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < rate
+
+
+class _Slot:
+    def __init__(self, text):
+        self.text = text
+        self.done = threading.Event()
+        self.score = None
+        self.response = None
+        self.batch_size = 0
+
+
+class CaptionBatcher:
+    # Collects the captions of concurrent workers into batches of `size` and scores each batch
+    # with one request. ask_batch(texts) returns the answer text, ask_single(text) returns
+    # (score, response) and is used for items the batched answer did not score.
+    def __init__(self, ask_batch, ask_single, size=CAPTION_BATCH, max_wait=BATCH_WAIT, metrics=None):
+        self.ask_batch = ask_batch
+        self.ask_single = ask_single
+        self.size = size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def _count(self, event):
+        if self.metrics is not None:
+            self.metrics.count(event)
+
+    def _take(self, slot=None):
+        with self.lock:
+            if slot is not None and slot not in self.pending:
+                return []
+            batch, self.pending = self.pending, []
+            return batch
+
+    def _run(self, batch):
+        try:
+            response_text = self.ask_batch([slot.text for slot in batch])
+            scores = parse_batch_scores(response_text, len(batch))
+        except Exception as e:
+            print(f"Batch of {len(batch)} captions failed, scoring them one by one - {e}")
+            scores = {}
+        self._count("batches")
+        for number, slot in enumerate(batch, 1):
+            slot.batch_size = len(batch)
+            if number in scores:
+                slot.score = scores[number]
+                slot.response = (f"Score: {slot.score}\nReasoning: Scored as text {number} of a batch of {len(batch)} "
+                                 f"(no reasoning in batched mode).")
+            slot.done.set()
+
+    # Function to score one caption as part of a batch. Returns the score, the response and
+    # details for the results store (batch size, fallback, single score of the calibration sample).
+    def score(self, text):
+        slot = _Slot(text)
+        with self.lock:
+            self.pending.append(slot)
+            batch = self.pending if len(self.pending) >= self.size else None
+            if batch is not None:
+                self.pending = []
+        if batch is not None:
+            self._run(batch)
+        elif not slot.done.wait(self.max_wait):
+            # The batch did not fill up in time (e.g. at the end of the run): send what is there
+            batch = self._take(slot)
+            if batch:
+                self._run(batch)
+            slot.done.wait()
+
+        if slot.score is None:
+            self._count("batch_fallbacks")
+            score, response_text = self.ask_single(text)
+            return score, response_text, {'batch_fallback': True}
+        details = {'batch_size': slot.batch_size}
+        if in_calibration_sample(text):
+            details['single_score'], _ = self.ask_single(text)
+        return slot.score, slot.response, details
+
+
+# Function to set the number of workers so that every parallel request slot gets a full batch
+def batch_workers(num_parallel, size=CAPTION_BATCH):
+    return num_parallel * max(1, size)
+
+
+# Function to compare the batched scores of the calibration sample with their single-item scores
+def calibration_report(root_directory, method, threshold=0.5, store=None):
+    store = store or open_store(root_directory)
+    pairs = [(result['score'], result['extra']['single_score']) for result in store.iter_results(method)
+             if result['score'] is not None and result['extra'].get('single_score') is not None]
+    report = {'method': method, 'threshold': threshold, 'pairs': len(pairs)}
+    if not pairs:
+        return report
+    differences = [batched - single for batched, single in pairs]
+    report['mean_difference'] = statistics.fmean(differences)
+    report['mean_abs_difference'] = statistics.fmean(abs(difference) for difference in differences)
+    report['max_abs_difference'] = max(abs(difference) for difference in differences)
+    report['exact'] = sum(1 for difference in differences if abs(difference) < 0.05) / len(pairs)
+    report['agreement'] = sum(1 for batched, single in pairs if (batched >= threshold) == (single >= threshold)) / len(pairs)
+    try:
+        report['correlation'] = statistics.correlation([batched for batched, _ in pairs], [single for _, single in pairs])
+    except statistics.StatisticsError:
+        report['correlation'] = None
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python caption_batching.py <root_directory> [method ...]")
+        sys.exit(1)
+    root_directory = sys.argv[1]
+    methods = sys.argv[2:] or ['txt-api', 'txt-loc', 'local']
+
+    reports = [calibration_report(root_directory, method) for method in methods]
+    for report in reports:
+        if not report['pairs']:
+            print(f"{report['method']}: no calibration sample")
+            continue
+        correlation = f"{report['correlation']:.2f}" if report['correlation'] is not None else "-"
+        print(f"{report['method']}: {report['pairs']} captions, mean abs. difference {report['mean_abs_difference']:.2f} "
+              f"(mean {report['mean_difference']:+.2f}), same score {report['exact']:.1%}, "
+              f"agreement at {report['threshold']} {report['agreement']:.1%}, correlation {correlation}")
+
+    output_path = os.path.join(root_directory, 'cta_batch_calibration.json')
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(reports, f, indent=2, ensure_ascii=False)
+    print(f"Report saved to: {output_path}")
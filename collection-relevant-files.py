@@ -1,35 +1,30 @@
 import os
 import json
+from artifact_index import update_index
 
 def collect_relevant_files(root_directory, relevant_posts_file):
     # Load relevant post IDs
     with open(os.path.join(root_directory, relevant_posts_file), 'r') as f:
         relevant_posts = json.load(f)['filenames']
     
+    # Refresh the persistent artifact index (only changed directories are rescanned)
+    artifact_index = update_index(root_directory)
+    
     relevant_files = {}
     
     for post_id in relevant_posts:
         base_name = os.path.splitext(post_id)[0]
+        artifacts = artifact_index.lookup(base_name)
         relevant_files[base_name] = {
             'original': post_id,
-            'images': [],
-            'local_cta_img': [],
-            'api_cta_img': [],
-            'cta_txt': None
+            'directory': artifacts['directory'],
+            'images': artifacts['images'],
+            'local_cta_img': artifacts['cta_img_loc'],
+            'api_cta_img': artifacts['cta_img'],
+            'cta_txt': artifacts['cta_txt'],
+            'cta_txt_loc': artifacts['cta_txt_loc'],
+            'cta_local': artifacts['cta_local']
         }
-        
-        # Search for related files in the directory
-        for subdir, _, files in os.walk(root_directory):
-            for file in files:
-                if file.startswith(base_name):
-                    if file.endswith('.png'):
-                        relevant_files[base_name]['images'].append(file)
-                    elif file.endswith('-cta-img-loc.json'):
-                        relevant_files[base_name]['local_cta_img'].append(file)
-                    elif file.endswith('-cta-img.json'):
-                        relevant_files[base_name]['api_cta_img'].append(file)
-                    elif file.endswith('-cta-txt.json'):
-                        relevant_files[base_name]['cta_txt'] = file
     
     # Save the structured data
     output_file = os.path.join(root_directory, 'relevant_cta_files.json')
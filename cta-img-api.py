@@ -1,93 +1,212 @@
 import os
 import re
-import json
-import base64
 import time  # Import the time module
 from PIL import Image
 from openai import OpenAI
 from equipment import myKey
+from results_store import open_store
+from image_prep import ImagePreprocessor, PREP_SIGNATURE, MIME_TYPE, scaled_size
+from result_cache import get_cache, file_key
+from metrics import get_metrics
+from work_queue import WorkQueue, QUEUE_MODE, print_counts
+from openai_batch import BATCH_MODE, run_batches
+from image_dedup import DEDUP_MODE, find_duplicates, reuse_score
+from scoring_engine import TokenBucket, call_with_limits, estimate_image_tokens, estimate_text_tokens, run_concurrently
 
 # Set the API key and model name
 MODEL = "gpt-4o-mini"
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", myKey))
 
-# Function to encode the image as a base64 string
+# Concurrency and rate limits (adjust to the limits of your account)
+MAX_IN_FLIGHT = int(os.environ.get("CTA_MAX_IN_FLIGHT", 8))
+REQUESTS_PER_MINUTE = int(os.environ.get("OPENAI_RPM", 500))
+TOKENS_PER_MINUTE = int(os.environ.get("OPENAI_TPM", 200000))
+metrics = get_metrics(MODEL)
+
+SYSTEM_PROMPT = "You are a helpful assistant that responds in Markdown. Help me analyze this image for a call to action."
+USER_PROMPT = "Analyze the following image for a call to action. Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."
+
+# Function to encode the image as a base64 string (downscaled and re-encoded by the preprocessing stage)
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return preprocessor.encode(image_path)
 
-# Function to analyze the image for a call to action and return a score and response
-def analyze_image_for_cta(image_path):
-    base64_image = encode_image(image_path)
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that responds in Markdown. Help me analyze this image for a call to action."},
+# Function to estimate the prompt size of a request for the token limiter
+def estimate_request_tokens(image_path):
+    with Image.open(image_path) as image:
+        width, height = scaled_size(*image.size)
+    return estimate_text_tokens(SYSTEM_PROMPT + USER_PROMPT) + estimate_image_tokens(width, height)
+
+# Function to build the chat request for one image (also used for the batch files)
+def build_request(base64_image):
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": [
-                {"type": "text", "text": "Analyze the following image for a call to action. Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}}
+                {"type": "text", "text": USER_PROMPT},
+                {"type": "image_url", "image_url": {"url": f"data:{MIME_TYPE};base64,{base64_image}"}}
             ]}
         ],
-        temperature=0.0,
-    )
-    response_text = response.choices[0].message.content.strip()
-    
-    # Use regex to extract the score from the response text
+        "temperature": 0.0,
+    }
+
+# Function to extract the score from the response text (None if there is none)
+def parse_score(response_text):
     score_match = re.search(r'\b(\d\.\d)\b', response_text)
-    if score_match:
-        score = float(score_match.group(1))
-        return round(score, 1), response_text
+    return round(float(score_match.group(1)), 1) if score_match else None
+
+# Function to analyze the image for a call to action and return a score and response
+def analyze_image_for_cta(image_path):
+    # Identical images (same bytes, model and prompt) are only scored once
+    with metrics.stage("cache"):
+        cache_key = file_key(MODEL, SYSTEM_PROMPT + "\n" + USER_PROMPT + "\n" + PREP_SIGNATURE, image_path)
+        cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.count("cache_hits")
+        preprocessor.discard(image_path)
+        return cached
+
+    with metrics.stage("encode"):
+        base64_image = encode_image(image_path)
+        estimated_tokens = estimate_request_tokens(image_path)
+    # Includes waiting for the rate limiter and retries
+    with metrics.stage("model"), metrics.in_flight():
+        response = call_with_limits(
+            lambda: client.chat.completions.create(**build_request(base64_image)),
+            limiter,
+            estimated_tokens,
+        )
+    with metrics.stage("parse"):
+        response_text = response.choices[0].message.content.strip()
+        score = parse_score(response_text)
+    if score is not None:
+        cache.put(cache_key, score, response_text)
+        return score, response_text
     else:
+        metrics.count("parse_failures")
         return 0.0, response_text  # Return 0.0 and the full response if the score cannot be parsed
 
-# Function to check if a "-cta-img" JSON file already exists
+# Function to check if an analysis already exists in the results store
 def json_analysis_exists(image_path):
-    json_filename = os.path.splitext(image_path)[0] + "-cta-img.json"
-    return os.path.exists(json_filename)
-
-# Path to the root directory containing the data
-root_directory = r'C:\git\SocialReporter\data'
-
-# Traverse the directory structure
-for subdir, dirs, files in os.walk(root_directory):
-    for filename in files:
-        if filename.endswith(".png"):  # Check if the file is a PNG image
-            image_path = os.path.join(subdir, filename)
-            
-            # Check if the analysis is already done
-            if not json_analysis_exists(image_path):
-                try:
-                    # Record the start time
-                    start_time = time.time()
-                    
-                    cta_score, api_response = analyze_image_for_cta(image_path)
-                    
-                    # Create a new JSON object with the analysis result
-                    analysis_result = {
-                        "original_filename": filename,
-                        "cta_img_score": cta_score,
-                        "api_img_response": api_response
-                    }
-                    
-                    # Create a new filename with the "-cta-img" suffix
-                    new_filename = os.path.splitext(filename)[0] + "-cta-img.json"
-                    new_filepath = os.path.join(subdir, new_filename)
-                    
-                    # Write the analysis result to the new JSON file
-                    with open(new_filepath, "w", encoding="utf-8") as outfile:
-                        json.dump(analysis_result, outfile, indent=4)
-                    
-                    # Record the end time
-                    end_time = time.time()
-                    
-                    # Calculate the time taken
-                    time_taken = end_time - start_time
-                    
-                    # Output the result and time to the console
-                    print(f"{filename}: {cta_score} (Result saved to {new_filename})")
-                    print(f"Time taken to process {filename}: {time_taken:.2f} seconds")
-                
-                except Exception as e:
-                    print(f"{filename}: An unexpected error occurred - {e}")
+    return store.exists(image_path, "img-api")
+
+# Function to analyze one image and write its "-cta-img" JSON file
+def process_image(subdir, filename):
+    image_path = os.path.join(subdir, filename)
+    try:
+        # Record the start time
+        start_time = time.time()
+
+        cta_score, api_response = analyze_image_for_cta(image_path)
+
+        # Save the analysis result in the results store ("-cta-img" JSON file by default)
+        with metrics.stage("write"):
+            store.put(image_path, "img-api", MODEL, cta_score, api_response, latency=time.time() - start_time)
+        new_filename = os.path.splitext(filename)[0] + "-cta-img.json"
+
+        # The time per stage is recorded in the metrics snapshot
+        metrics.observe("file", time.time() - start_time)
+        metrics.count("scored")
+        print(f"{filename}: {cta_score} (Result saved to {new_filename})")
+
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {e}")
+        # Reported to the work queue, which retries the image later
+        raise
+
+# Function to list the images that still need an analysis (the others are added to scored_paths)
+def find_pending_images(root_directory, scored_paths=None):
+    for subdir, dirs, files in os.walk(root_directory):
+        for filename in files:
+            if filename.endswith(".png"):  # Check if the file is a PNG image
+                image_path = os.path.join(subdir, filename)
+
+                # Check if the analysis is already done
+                if not json_analysis_exists(image_path):
+                    yield subdir, filename
+                else:
+                    metrics.count("skipped")
+                    print(f"Analysis for {filename} already exists. Skipping.")
+                    if scored_paths is not None:
+                        scored_paths.append(image_path)
+
+if __name__ == "__main__":
+    # Path to the root directory containing the data
+    root_directory = os.environ.get("CTA_DATA_ROOT", r'C:\git\SocialReporter\data')
+    # In queue mode a job is marked done only once its result is on disk, so results are written right away
+    store = open_store(root_directory, write_behind=QUEUE_MODE != 'on')
+    # Created here rather than on import: on Windows the preprocessing pool spawns its workers,
+    # which import this script again
+    # Retries (including 429 retry-after) are handled by the scoring engine
+    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", myKey), max_retries=0)
+    limiter = TokenBucket(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    cache = get_cache()
+    preprocessor = ImagePreprocessor()
+
+    start_time = time.time()
+    metrics.start()
+
+    # Reposted flyers and carousel copies take over the score of the image they duplicate
+    scored_paths = []
+    pending = metrics.timed("walk", find_pending_images(root_directory, scored_paths))
+    duplicates = {}
+    if DEDUP_MODE != 'off':
+        pending = list(pending)
+        with metrics.stage("hash"):
+            pending, duplicates = find_duplicates(root_directory, scored_paths, pending, lambda item: os.path.join(*item))
+    unresolved = []
+
+    def resolve_duplicates(source_path):
+        for item, distance in duplicates.pop(source_path, []):
+            if reuse_score(store, "img-api", MODEL, os.path.join(*item), source_path, distance) is None:
+                unresolved.append(item)
             else:
-                print(f"Analysis for {filename} already exists. Skipping.")
+                metrics.count("dedup_reused")
+
+    for source_path in scored_paths:
+        resolve_duplicates(source_path)
+
+    # Analyze up to MAX_IN_FLIGHT images at once within the rate limits,
+    # while the next images are decoded and downscaled in a process pool
+    if BATCH_MODE == 'on':
+        # Duplicates of images without a result yet are submitted as well, their sources are only
+        # scored once the batch is done
+        pending = list(pending) + unresolved + [item for entries in duplicates.values() for item, _ in entries]
+        # Ingest finished batches and submit the missing images as new ones (run again to collect the results)
+        pending = preprocessor.prefetch(pending, lambda item: os.path.join(*item))
+        run_batches(client, store, "img-api", MODEL, pending, lambda item: os.path.join(*item),
+                    lambda item: (os.path.join(*item), build_request(encode_image(os.path.join(*item)))), parse_score)
+    elif QUEUE_MODE == 'on':
+        # Every worker adds the missing images to the shared queue and then drains it
+        queue = WorkQueue(root_directory)
+
+        def drain():
+            while queue.has_pending("img-api"):
+                jobs = preprocessor.prefetch(queue.iter_jobs("img-api", batch_size=MAX_IN_FLIGHT), lambda job: job['input_path'])
+                for job, _, error in run_concurrently(jobs, lambda job: process_image(*os.path.split(job['input_path'])), MAX_IN_FLIGHT):
+                    if queue.finish(job, error) and error is None:
+                        resolve_duplicates(job['input_path'])
+
+        queue.enqueue("img-api", (os.path.join(*item) for item in pending))
+        drain()
+        # Sources scored by other workers (or not at all); duplicates without a score are queued on their own
+        for source_path in list(duplicates):
+            resolve_duplicates(source_path)
+        if unresolved:
+            queue.enqueue("img-api", (os.path.join(*item) for item in unresolved))
+            drain()
+        print_counts(queue, "img-api")
+        queue.close()
+    else:
+        pending = preprocessor.prefetch(pending, lambda item: os.path.join(*item))
+        for item, _, _ in run_concurrently(pending, lambda item: process_image(*item), MAX_IN_FLIGHT):
+            resolve_duplicates(os.path.join(*item))
+        # Duplicates of images that could not be scored get a request of their own
+        for _ in run_concurrently(unresolved, lambda item: process_image(*item), MAX_IN_FLIGHT):
+            pass
+    preprocessor.close()
+    store.close()
+
+    print(f"Total processing time: {time.time() - start_time:.2f} seconds")
+    metrics.print_summary()
+    metrics.close()
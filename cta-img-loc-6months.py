@@ -1,106 +1,206 @@
 import os
 import json
 import re
-import base64
 import time
-import requests
 from PIL import Image
+from ollama_client import get_client, client_for, ANSWER_SIGNATURE
+from results_store import open_store
+from image_prep import ImagePreprocessor, PREP_SIGNATURE
+from result_cache import get_cache, file_key
+from metrics import get_metrics
+from image_dedup import DEDUP_MODE, find_duplicates, reuse_score
+from sharding import parse_shard, in_shard, shard_summary_path, merge_shard_summaries
+from watch_mode import PostWatcher, watch_and_score
 
 # Set the model name (adjust if needed)
 MODEL = "llava:13b"
 
+metrics = get_metrics(MODEL)
+
+PROMPT = (
+    "You are a helpful assistant that responds in Markdown. Help me analyze this image for a call to action."
+    "Analyze the following image for a call to action. Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."
+    "Your response should always start with 'Score: ' followed by the number. Then provide a brief reasoning."
+)
+
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return preprocessor.encode(image_path)
 
 def analyze_image_for_cta(image_path):
-    base64_image = encode_image(image_path)
-    
-    api_url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": MODEL,
-        "prompt": (
-            "You are a helpful assistant that responds in Markdown. Help me analyze this image for a call to action."
-            "Analyze the following image for a call to action. Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."
-            "Your response should always start with 'Score: ' followed by the number. Then provide a brief reasoning."
-        ),
-        "images": [base64_image],
-        "stream": False
-    }
-    
-    response = requests.post(api_url, json=payload)
-    
+    # Identical images (same bytes, model and prompt) are only scored once
+    with metrics.stage("cache"):
+        cache_key = file_key(MODEL, PROMPT + "\n" + PREP_SIGNATURE + ANSWER_SIGNATURE, image_path)
+        cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.count("cache_hits")
+        preprocessor.discard(image_path)
+        return cached
+
+    with metrics.stage("encode"):
+        base64_image = encode_image(image_path)
+
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.score(MODEL, PROMPT, images=[base64_image], sample_key=cache_key)
+
     if response.status_code != 200:
+        metrics.count("http_errors")
         return 0.0, f"Error: HTTP {response.status_code} - {response.text}"
-    
-    response_text = response.json().get('response', 'No description available')
-    
-    score_match = re.search(r'Score:\s*(\d\.\d)', response_text)
+
+    with metrics.stage("parse"):
+        response_text = response.json().get('response', 'No description available')
+
+        score_match = re.search(r'Score:\s*(\d\.\d)', response_text)
     if score_match:
-        score = float(score_match.group(1))
-        return round(score, 1), response_text
+        score = round(float(score_match.group(1)), 1)
+        cache.put(cache_key, score, response_text)
+        return score, response_text
     else:
+        metrics.count("parse_failures")
         return 0.0, response_text
 
+OUTPUT_FILENAME = 'updated_cta_analysis_summary.json'
+
 def get_relevant_posts(root_directory, relevant_filenames_json):
     with open(os.path.join(root_directory, relevant_filenames_json), 'r') as f:
         relevant_data = json.load(f)
         return set(file.replace('.json', '') for file in relevant_data['filenames'])
 
+def analyze_image(store, image_path):
+    filename = os.path.basename(image_path)
+    analysis_filename = f"{os.path.splitext(filename)[0]}-cta-img-loc.json"
+    try:
+        start_time = time.time()
+        cta_score, api_response = analyze_image_for_cta(image_path)
+        if api_response.startswith("Error: HTTP"):
+            # Not saved, so the image is analyzed again on the next run (or retried by the work queue)
+            raise RuntimeError(api_response)
+
+        with metrics.stage("write"):
+            store.put(image_path, "img-loc", MODEL, cta_score, api_response, latency=time.time() - start_time)
+
+        # The time per stage is recorded in the metrics snapshot
+        metrics.observe("file", time.time() - start_time)
+        metrics.count("scored")
+        print(f"{filename}: {cta_score} (Result saved to {analysis_filename})")
+        return cta_score
+
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {e}")
+        return None
+
 def analyze_posts(root_directory, relevant_posts):
     results = {}
     total_analyzed = 0
     total_relevant_pictures = 0
+    pending = []
+    scored_paths = []
+    store = open_store(root_directory, write_behind=True)
 
-    for subdir, _, files in os.walk(root_directory):
+    for subdir, _, files in metrics.timed("walk", os.walk(root_directory)):
         for filename in files:
             if filename.endswith(('.png', '.jpg', '.jpeg')):
                 post_id = filename.split('_')[0]
                 if post_id in relevant_posts:
                     total_relevant_pictures += 1
                     image_path = os.path.join(subdir, filename)
-                    
+
                     # Check if analysis already exists
-                    analysis_filename = f"{os.path.splitext(filename)[0]}-cta-img-loc.json"
-                    analysis_path = os.path.join(subdir, analysis_filename)
-                    
-                    if not os.path.exists(analysis_path):
-                        try:
-                            start_time = time.time()
-                            cta_score, api_response = analyze_image_for_cta(image_path)
-                            total_analyzed += 1
-
-                            analysis_result = {
-                                "original_loc_filename": filename,
-                                "cta_img_loc_score": cta_score,
-                                "api_img_loc_response": api_response
-                            }
-
-                            with open(analysis_path, "w", encoding="utf-8") as outfile:
-                                json.dump(analysis_result, outfile, indent=4)
-
-                            end_time = time.time()
-                            time_taken = end_time - start_time
-
-                            print(f"{filename}: {cta_score} (Result saved to {analysis_filename})")
-                            print(f"Time taken to process {filename}: {time_taken:.2f} seconds")
-
-                        except Exception as e:
-                            print(f"{filename}: An unexpected error occurred - {e}")
+                    existing_analysis = store.get(image_path, "img-loc")
+
+                    if existing_analysis is None:
+                        pending.append((post_id, image_path))
                     else:
+                        metrics.count("skipped")
                         print(f"Analysis for {filename} already exists. Skipping.")
-                        with open(analysis_path, 'r') as f:
-                            existing_analysis = json.load(f)
-                            cta_score = existing_analysis.get('cta_img_loc_score', 0.0)
+                        cta_score = existing_analysis['score'] or 0.0
+                        scored_paths.append(image_path)
                         total_analyzed += 1
+                        results.setdefault(post_id, []).append((filename, cta_score))
+
+    def record(post_id, image_path, cta_score):
+        nonlocal total_analyzed
+        total_analyzed += 1
+        results.setdefault(post_id, []).append((os.path.basename(image_path), cta_score))
+
+    # Reposted flyers and carousel copies reuse the score of the picture they duplicate
+    duplicates = {}
+    if DEDUP_MODE != 'off':
+        with metrics.stage("hash"):
+            pending, duplicates = find_duplicates(root_directory, scored_paths, pending, lambda item: item[1])
+    unresolved = []
+
+    def resolve_duplicates(source_path):
+        for (post_id, image_path), distance in duplicates.pop(source_path, []):
+            cta_score = reuse_score(store, "img-loc", MODEL, image_path, source_path, distance)
+            if cta_score is None:
+                unresolved.append((post_id, image_path))
+            else:
+                metrics.count("dedup_reused")
+                record(post_id, image_path, cta_score)
 
-                    if post_id not in results:
-                        results[post_id] = []
-                    results[post_id].append((filename, cta_score))
+    for source_path in scored_paths:
+        resolve_duplicates(source_path)
 
+    # Analyze the missing pictures with as many requests in flight as the server handles,
+    # while the next pictures are decoded and downscaled in a process pool
+    ollama.preload(MODEL)
+    prefetched = preprocessor.prefetch(pending, lambda item: item[1])
+    for item, cta_score, _ in ollama.map(prefetched, lambda item: analyze_image(store, item[1])):
+        post_id, image_path = item
+        if cta_score is not None:
+            record(post_id, image_path, cta_score)
+        resolve_duplicates(image_path)
+
+    # Duplicates of pictures that could not be scored get a model call of their own
+    for item, cta_score, _ in ollama.map(unresolved, lambda item: analyze_image(store, item[1])):
+        if cta_score is not None:
+            record(*item, cta_score)
+
+    # Waits until the writer thread has written every result
+    store.close()
     return results, total_analyzed, total_relevant_pictures
 
-def save_summary(root_directory, results, total_analyzed, total_relevant_pictures, relevant_posts):
+# Function to score a picture that landed while watching; raises when it could not be scored,
+# so the work queue tries it again
+def score_new_picture(store, image_path):
+    existing_analysis = store.get(image_path, "img-loc")
+    if existing_analysis is not None:
+        return existing_analysis['score'] or 0.0
+    cta_score = analyze_image(store, image_path)
+    if cta_score is None:
+        raise RuntimeError("Picture could not be scored")
+    return cta_score
+
+# Function to keep scoring the pictures of new relevant posts as they land (--watch)
+def watch_pictures(root_directory, watcher, results, total_analyzed, total_relevant_pictures, relevant_posts, shard=None):
+    # Results are written right away, a job is only marked done once its result is on disk
+    store = open_store(root_directory)
+    totals = {'analyzed': total_analyzed, 'pictures': total_relevant_pictures}
+
+    def find_new():
+        _, pictures = watcher.poll()
+        new_pictures = [image_path for image_path in pictures if in_shard(os.path.basename(image_path).split('_')[0], shard)]
+        relevant_posts.update(os.path.basename(image_path).split('_')[0] for image_path in new_pictures)
+        totals['pictures'] += len(new_pictures)
+        return new_pictures
+
+    def on_scored(image_path, cta_score):
+        filename = os.path.basename(image_path)
+        pictures = results.setdefault(filename.split('_')[0], [])
+        # Pictures that landed during the first pass may have been scored by it already
+        if all(name != filename for name, _ in pictures):
+            pictures.append((filename, cta_score))
+            totals['analyzed'] += 1
+
+    def on_batch():
+        save_summary(root_directory, results, totals['analyzed'], totals['pictures'], relevant_posts, shard)
+
+    watch_and_score(root_directory, "img-loc", find_new, lambda image_path: score_new_picture(store, image_path), on_scored,
+                    on_batch, ollama, MODEL, ollama.max_parallel)
+    store.close()
+
+def save_summary(root_directory, results, total_analyzed, total_relevant_pictures, relevant_posts, shard=None):
     summary = {
         "total_relevant_posts": len(relevant_posts),
         "total_relevant_pictures": total_relevant_pictures,
@@ -109,8 +209,7 @@ def save_summary(root_directory, results, total_analyzed, total_relevant_picture
         "cta_scores": {f"{post_id}_{filename}": score for post_id, pics in results.items() for filename, score in pics}
     }
 
-    output_filename = 'updated_cta_analysis_summary.json'
-    output_path = os.path.join(root_directory, output_filename)
+    output_path = shard_summary_path(root_directory, OUTPUT_FILENAME, shard)
     with open(output_path, 'w', encoding='utf-8') as f:
         json.dump(summary, f, indent=2, ensure_ascii=False)
 
@@ -122,9 +221,38 @@ def save_summary(root_directory, results, total_analyzed, total_relevant_picture
     print(f"Summary saved to: {output_path}")
 
 if __name__ == "__main__":
-    root_directory = r'C:\git\SocialReporter\data'
+    import argparse
+    parser = argparse.ArgumentParser(description="Score the pictures of the relevant posts for a call to action.")
+    parser.add_argument('--root', default=os.environ.get("CTA_DATA_ROOT", r'C:\git\SocialReporter\data'))
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="only score the posts of shard i of N (i/N, counted from 0); every node runs one shard")
+    parser.add_argument('--endpoint', action='append', default=None,
+                        help="Ollama server as URL or URL=parallel requests; repeat for several servers")
+    parser.add_argument('--merge', action='store_true', help="merge the shard summaries into the combined summary and exit")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and score the pictures of new posts as they land")
+    args = parser.parse_args()
+    root_directory = args.root
     relevant_filenames_json = 'relevant_post_filenames.json'
-    
-    relevant_posts = get_relevant_posts(root_directory, relevant_filenames_json)
+
+    if args.merge:
+        output_path, _ = merge_shard_summaries(root_directory, OUTPUT_FILENAME)
+        print(f"Merged summary saved to: {output_path}")
+        raise SystemExit
+    # Created here rather than on import: on Windows the preprocessing pool spawns its workers,
+    # which import this script again
+    ollama = client_for(args.endpoint) if args.endpoint else get_client()
+    cache = get_cache()
+    preprocessor = ImagePreprocessor()
+
+    metrics.start()
+    # Started before the first pass, so pictures that land during it are not missed
+    watcher = PostWatcher(root_directory) if args.watch else None
+    relevant_posts = {post_id for post_id in get_relevant_posts(root_directory, relevant_filenames_json) if in_shard(post_id, args.shard)}
     results, total_analyzed, total_relevant_pictures = analyze_posts(root_directory, relevant_posts)
-    save_summary(root_directory, results, total_analyzed, total_relevant_pictures, relevant_posts)
\ No newline at end of file
+    save_summary(root_directory, results, total_analyzed, total_relevant_pictures, relevant_posts, args.shard)
+    if watcher is not None:
+        watch_pictures(root_directory, watcher, results, total_analyzed, total_relevant_pictures, relevant_posts, args.shard)
+    preprocessor.close()
+    metrics.print_summary()
+    metrics.close()
@@ -1,6 +1,8 @@
 import os
 import json
 from collections import defaultdict
+from artifact_index import update_index
+from result_manifest import update_results
 
 def find_missing_cta_analyses(root_directory, relevant_filenames_json, output_filename):
     # Load the list of relevant filenames
@@ -13,24 +15,26 @@ def find_missing_cta_analyses(root_directory, relevant_filenames_json, output_fi
     analyzed_pictures = set()
     missing_analyses = defaultdict(list)
 
-    # Walk through the directory structure
-    for subdir, _, files in os.walk(root_directory):
-        for filename in files:
-            if filename.endswith(('.png', '.jpg', '.jpeg')):
-                # Extract the post ID (assume it's the part before the first dot or underscore)
-                post_id = filename.split('.')[0].split('_')[0]
-                
-                # Check if this post ID is in our relevant list
-                if post_id in relevant_filenames:
-                    full_path = os.path.join(subdir, filename)
-                    post_pictures[post_id].append(full_path)
-                    
-                    # Check if a corresponding CTA analysis file exists
-                    cta_filename = filename.rsplit('.', 1)[0] + '-cta-img-loc.json'
-                    if os.path.exists(os.path.join(subdir, cta_filename)):
-                        analyzed_pictures.add(full_path)
-                    else:
-                        missing_analyses[post_id].append(filename)
+    # Files from the artifact index and results from the result manifest, both only
+    # re-read where something changed since the last run
+    artifact_index = update_index(root_directory)
+    results = update_results(root_directory, "img-loc", artifact_index)
+
+    for full_path in artifact_index.iter_files():
+        filename = os.path.basename(full_path)
+        if filename.endswith(('.png', '.jpg', '.jpeg')):
+            # Extract the post ID (assume it's the part before the first dot or underscore)
+            post_id = filename.split('.')[0].split('_')[0]
+
+            # Check if this post ID is in our relevant list
+            if post_id in relevant_filenames:
+                post_pictures[post_id].append(full_path)
+
+                # Check if a corresponding CTA analysis exists
+                if results.analyzed(full_path):
+                    analyzed_pictures.add(full_path)
+                else:
+                    missing_analyses[post_id].append(filename)
 
     # Create the summary
     summary = {
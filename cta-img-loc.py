@@ -1,98 +1,143 @@
 import os
 import re
-import json
-import base64
 import time
-import requests
 from PIL import Image
+from ollama_client import get_client, ANSWER_SIGNATURE
+from results_store import open_store
+from image_prep import ImagePreprocessor, PREP_SIGNATURE
+from result_cache import get_cache, file_key
+from metrics import get_metrics
+from work_queue import WorkQueue, QUEUE_MODE, print_counts
 
 # Set the model name (adjust if needed)
 MODEL = "llava:13b"
 
-# Function to encode the image as a base64 string
+metrics = get_metrics(MODEL)
+
+PROMPT = (
+    "You are a helpful assistant that responds in Markdown. Help me analyze this image for a call to action."
+    "Analyze the following image for a call to action. Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."
+    "Your response should always start with 'Score: ' followed by the number. Then provide a brief reasoning."
+)
+
+# Function to encode the image as a base64 string (downscaled and re-encoded by the preprocessing stage)
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return preprocessor.encode(image_path)
 
 # Function to analyze the image for a call to action and return a score and response
 def analyze_image_for_cta(image_path):
-    base64_image = encode_image(image_path)
-    
-    api_url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": MODEL,
-        "prompt": (
-            "You are a helpful assistant that responds in Markdown. Help me analyze this image for a call to action."
-            "Analyze the following image for a call to action. Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."
-            "Your response should always start with 'Score: ' followed by the number. Then provide a brief reasoning."
-        ),
-        "images": [base64_image],
-        "stream": False
-    }
-    
-    response = requests.post(api_url, json=payload)
-    
+    # Identical images (same bytes, model and prompt) are only scored once
+    with metrics.stage("cache"):
+        cache_key = file_key(MODEL, PROMPT + "\n" + PREP_SIGNATURE + ANSWER_SIGNATURE, image_path)
+        cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.count("cache_hits")
+        preprocessor.discard(image_path)
+        return cached
+
+    with metrics.stage("encode"):
+        base64_image = encode_image(image_path)
+
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.score(MODEL, PROMPT, images=[base64_image], sample_key=cache_key)
+
     if response.status_code != 200:
+        metrics.count("http_errors")
         return 0.0, f"Error: HTTP {response.status_code} - {response.text}"
-    
-    response_text = response.json().get('response', 'No description available')
-    
-    # Use regex to extract the score from the response text
-    score_match = re.search(r'Score:\s*(\d\.\d)', response_text)
+
+    with metrics.stage("parse"):
+        response_text = response.json().get('response', 'No description available')
+
+        # Use regex to extract the score from the response text
+        score_match = re.search(r'Score:\s*(\d\.\d)', response_text)
     if score_match:
-        score = float(score_match.group(1))
-        return round(score, 1), response_text
+        score = round(float(score_match.group(1)), 1)
+        cache.put(cache_key, score, response_text)
+        return score, response_text
     else:
+        metrics.count("parse_failures")
         return 0.0, response_text  # Return 0.0 and the full response if the score cannot be parsed
 
-# Function to check if a "-cta-img-loc" JSON file already exists
+# Function to check if an analysis already exists in the results store
 def json_analysis_exists(image_path):
-    json_filename = os.path.splitext(image_path)[0] + "-cta-img-loc.json"
-    return os.path.exists(json_filename)
-
-# Path to the root directory containing the data
-root_directory = r'C:\git\SocialReporter\data'
-
-# Traverse the directory structure
-for subdir, dirs, files in os.walk(root_directory):
-    for filename in files:
-        if filename.endswith(".png"):  # Check if the file is a PNG image
-            image_path = os.path.join(subdir, filename)
-            
-            # Check if the analysis is already done
-            if not json_analysis_exists(image_path):
-                try:
-                    # Record the start time
-                    start_time = time.time()
-                    
-                    cta_score, api_response = analyze_image_for_cta(image_path)
-                    
-                    # Create a new JSON object with the analysis result
-                    analysis_result = {
-                        "original_loc_filename": filename,
-                        "cta_img_loc_score": cta_score,
-                        "api_img_loc_response": api_response
-                    }
-                    
-                    # Create a new filename with the "-cta-img-loc" suffix
-                    new_filename = os.path.splitext(filename)[0] + "-cta-img-loc.json"
-                    new_filepath = os.path.join(subdir, new_filename)
-                    
-                    # Write the analysis result to the new JSON file
-                    with open(new_filepath, "w", encoding="utf-8") as outfile:
-                        json.dump(analysis_result, outfile, indent=4)
-                    
-                    # Record the end time
-                    end_time = time.time()
-                    
-                    # Calculate the time taken
-                    time_taken = end_time - start_time
-                    
-                    # Output the result and time to the console
-                    print(f"{filename}: {cta_score} (Result saved to {new_filename})")
-                    print(f"Time taken to process {filename}: {time_taken:.2f} seconds")
-                
-                except Exception as e:
-                    print(f"{filename}: An unexpected error occurred - {e}")
-            else:
-                print(f"Analysis for {filename} already exists. Skipping.")
\ No newline at end of file
+    return store.exists(image_path, "img-loc")
+
+# Function to analyze one image and write its "-cta-img-loc" JSON file
+def process_image(subdir, filename):
+    image_path = os.path.join(subdir, filename)
+    try:
+        # Record the start time
+        start_time = time.time()
+
+        cta_score, api_response = analyze_image_for_cta(image_path)
+        if api_response.startswith("Error: HTTP"):
+            # Not saved, so the image is analyzed again on the next run
+            raise RuntimeError(api_response)
+
+        # Save the analysis result in the results store ("-cta-img-loc" JSON file by default)
+        with metrics.stage("write"):
+            store.put(image_path, "img-loc", MODEL, cta_score, api_response, latency=time.time() - start_time)
+        new_filename = os.path.splitext(filename)[0] + "-cta-img-loc.json"
+
+        # The time per stage is recorded in the metrics snapshot
+        metrics.observe("file", time.time() - start_time)
+        metrics.count("scored")
+        print(f"{filename}: {cta_score} (Result saved to {new_filename})")
+
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {e}")
+        # Reported to the work queue, which retries the image later
+        raise
+
+# Function to list the images that still need an analysis
+def find_pending_images(root_directory):
+    for subdir, dirs, files in os.walk(root_directory):
+        for filename in files:
+            if filename.endswith(".png"):  # Check if the file is a PNG image
+                image_path = os.path.join(subdir, filename)
+
+                # Check if the analysis is already done
+                if not json_analysis_exists(image_path):
+                    yield subdir, filename
+                else:
+                    metrics.count("skipped")
+                    print(f"Analysis for {filename} already exists. Skipping.")
+
+if __name__ == "__main__":
+    # Path to the root directory containing the data
+    root_directory = os.environ.get("CTA_DATA_ROOT", r'C:\git\SocialReporter\data')
+    # In queue mode a job is marked done only once its result is on disk, so results are written right away
+    store = open_store(root_directory, write_behind=QUEUE_MODE != 'on')
+    # Created here rather than on import: on Windows the preprocessing pool spawns its workers,
+    # which import this script again
+    ollama = get_client()
+    cache = get_cache()
+    preprocessor = ImagePreprocessor()
+
+    start_time = time.time()
+    metrics.start()
+
+    # Keep the model loaded and send as many requests as the server runs in parallel,
+    # while the next images are decoded and downscaled in a process pool
+    ollama.preload(MODEL)
+    if QUEUE_MODE == 'on':
+        # Every worker adds the missing images to the shared queue and then drains it
+        queue = WorkQueue(root_directory)
+        queue.enqueue("img-loc", (os.path.join(*item) for item in metrics.timed("walk", find_pending_images(root_directory))))
+        while queue.has_pending("img-loc"):
+            jobs = preprocessor.prefetch(queue.iter_jobs("img-loc", batch_size=ollama.max_parallel), lambda job: job['input_path'])
+            for job, _, error in ollama.map(jobs, lambda job: process_image(*os.path.split(job['input_path']))):
+                queue.finish(job, error)
+        print_counts(queue, "img-loc")
+        queue.close()
+    else:
+        pending = preprocessor.prefetch(metrics.timed("walk", find_pending_images(root_directory)), lambda item: os.path.join(*item))
+        for _ in ollama.map(pending, lambda item: process_image(*item)):
+            pass
+    preprocessor.close()
+    store.close()
+
+    print(f"Total processing time: {time.time() - start_time:.2f} seconds")
+    metrics.print_summary()
+    metrics.close()
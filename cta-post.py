@@ -0,0 +1,219 @@
+import os
+import time
+import argparse
+from PIL import Image
+from openai import OpenAI
+from equipment import myKey
+from ollama_client import get_client
+from results_store import open_store
+from image_prep import ImagePreprocessor, MIME_TYPE, scaled_size
+from metrics import get_metrics
+from artifact_index import update_index
+from caption_batching import load_json, parse_batch_scores
+from post_ingest import read_post_record
+from scoring_engine import TokenBucket, call_with_limits, estimate_image_tokens, estimate_text_tokens, run_concurrently
+
+# Models and the result methods they write: the caption and every image keep their own
+# record, exactly as if cta-text-api.py / cta-img-api.py (or cta-img-loc.py) had scored them.
+# LLaVA caption scores go to txt-llava, as txt-loc holds the llama3.1 ones.
+BACKENDS = {
+    'api': {'model': "gpt-4o-mini", 'text_method': "txt-api", 'image_method': "img-api"},
+    'loc': {'model': "llava:13b", 'text_method': "txt-llava", 'image_method': "img-loc"},
+}
+
+# Concurrency and rate limits of the API backend (adjust to the limits of your account)
+MAX_IN_FLIGHT = int(os.environ.get("CTA_MAX_IN_FLIGHT", 8))
+REQUESTS_PER_MINUTE = int(os.environ.get("OPENAI_RPM", 500))
+TOKENS_PER_MINUTE = int(os.environ.get("OPENAI_TPM", 200000))
+# Images sent with one post; the rest are left to the image scripts
+MAX_IMAGES = int(os.environ.get("CTA_POST_MAX_IMAGES", 10))
+MAX_RESPONSE_TOKENS = 400
+
+SYSTEM_PROMPT = "You work in marketing at a university and you analyze social media posts."
+USER_PROMPT = (
+    "Analyze the following post for a call to action. The caption is:\n\n{text}\n\n"
+    "The post has {count} images, attached in order as image 1 to image {count}.\n"
+    "Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action, "
+    "for the caption and for every image on its own.\n"
+    "Respond with JSON only, in the form "
+    "{{\"text_score\": 0.5, \"scores\": [{{\"id\": 1, \"score\": 0.5}}], \"reasoning\": \"...\"}}, "
+    "with one entry in \"scores\" for every image id."
+)
+
+# JSON schema of the answer, passed as `format` to Ollama (OpenAI gets JSON mode instead)
+POST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "text_score": {"type": "number"},
+        "scores": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, "score": {"type": "number"}},
+                "required": ["id", "score"],
+            },
+        },
+        "reasoning": {"type": "string"},
+    },
+    "required": ["text_score", "scores"],
+}
+
+def build_prompt(text, image_count):
+    return USER_PROMPT.format(text=text or "(no caption)", count=image_count)
+
+# Function to send the caption and all images of a post to the OpenAI API; returns the answer text
+def ask_api(text, image_paths, images):
+    user_prompt = build_prompt(text, len(images))
+    content = [{"type": "text", "text": user_prompt}]
+    content.extend({"type": "image_url", "image_url": {"url": f"data:{MIME_TYPE};base64,{image}"}} for image in images)
+    estimated_tokens = estimate_text_tokens(SYSTEM_PROMPT + user_prompt) + MAX_RESPONSE_TOKENS
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            estimated_tokens += estimate_image_tokens(*scaled_size(*image.size))
+
+    with metrics.stage("model"), metrics.in_flight():
+        response = call_with_limits(
+            lambda: client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": content}
+                ],
+                temperature=0.0,
+                response_format={"type": "json_object"},
+            ),
+            limiter,
+            estimated_tokens,
+        )
+    return response.choices[0].message.content
+
+# Function to send the caption and all images of a post to llava; returns the answer text
+def ask_local(text, image_paths, images):
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.generate(MODEL, SYSTEM_PROMPT + " " + build_prompt(text, len(images)), images=images, format=POST_SCHEMA)
+    if response.status_code != 200:
+        metrics.count("http_errors")
+        raise RuntimeError(f"HTTP {response.status_code} - {response.text}")
+    return response.json().get('response', '')
+
+# Function to read the caption score and the image scores ({image number: score}) of an answer
+def parse_post_scores(response_text, image_count):
+    data = load_json(response_text)
+    if not isinstance(data, dict):
+        return None, {}, ""
+    try:
+        text_score = float(data.get('text_score'))
+        text_score = round(text_score, 1) if 0.0 <= text_score <= 1.0 else None
+    except (TypeError, ValueError):
+        text_score = None
+    reasoning = data.get('reasoning') if isinstance(data.get('reasoning'), str) else ""
+    return text_score, parse_batch_scores(response_text, image_count), reasoning
+
+# Function to score one post with a single request and write the caption and image records.
+# Only inputs without a result are written; anything the answer misses stays pending.
+def process_post(post):
+    filename = os.path.basename(post['json_path'])
+    try:
+        start_time = time.time()
+        image_paths = post['image_paths']
+        with metrics.stage("encode"):
+            images = [preprocessor.encode(image_path) for image_path in image_paths]
+
+        answer = ask(post['text'], image_paths, images)
+        with metrics.stage("parse"):
+            text_score, image_scores, reasoning = parse_post_scores(answer, len(images))
+        extra = {'scored_with': 'post', 'post_images': len(images)}
+        latency = time.time() - start_time
+
+        written = 0
+        with metrics.stage("write"):
+            if post['text'] and not post['text_done'] and text_score is not None:
+                store.put(post['json_path'], BACKEND['text_method'], MODEL, text_score,
+                          f"Score: {text_score}\nReasoning: {reasoning}", latency=latency, extra=extra)
+                written += 1
+            for number, image_path in enumerate(image_paths, 1):
+                if number in image_scores and image_path not in post['images_done']:
+                    store.put(image_path, BACKEND['image_method'], MODEL, image_scores[number],
+                              f"Score: {image_scores[number]}\nReasoning: {reasoning}", latency=latency, extra=extra)
+                    written += 1
+
+        missing = post['inputs'] - written
+        if missing:
+            metrics.count("parse_failures")
+            print(f"{filename}: {missing} scores missing in the answer, left for the next run")
+        metrics.observe("file", time.time() - start_time)
+        metrics.count("scored")
+        print(f"{filename}: caption {text_score}, images {[image_scores.get(number) for number in range(1, len(images) + 1)]}")
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {e}")
+
+# Function to list the posts whose caption or images still need a score
+def find_pending_posts(root_directory):
+    artifact_index = update_index(root_directory)
+    for post_id in artifact_index.post_ids():
+        artifacts = artifact_index.lookup(post_id)
+        if artifacts['original'] is None:
+            continue
+        json_path = artifact_index.path_of(artifacts, artifacts['original'])
+        try:
+            with metrics.stage("read"):
+                record = read_post_record(json_path)
+        except (OSError, ValueError) as e:
+            metrics.count("read_errors")
+            print(f"{post_id}: Error reading JSON - {e}")
+            continue
+        if record is None:
+            continue
+
+        text = record["text"]
+        image_paths = [artifact_index.path_of(artifacts, image) for image in sorted(artifacts['images'])]
+        if len(image_paths) > MAX_IMAGES:
+            print(f"{post_id}: {len(image_paths)} images, only the first {MAX_IMAGES} are sent with the post")
+            image_paths = image_paths[:MAX_IMAGES]
+        text_done = not text or store.exists(json_path, BACKEND['text_method'])
+        images_done = {image_path for image_path in image_paths if store.exists(image_path, BACKEND['image_method'])}
+        inputs = (0 if text_done else 1) + len(image_paths) - len(images_done)
+        if inputs == 0:
+            metrics.count("skipped")
+            continue
+        yield {'json_path': json_path, 'text': text, 'image_paths': image_paths,
+               'text_done': text_done, 'images_done': images_done, 'inputs': inputs}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the caption and the images of every post with one request per post.")
+    parser.add_argument('--backend', choices=list(BACKENDS), default=os.environ.get("CTA_POST_BACKEND", "api"),
+                        help="api: gpt-4o-mini, loc: llava on Ollama")
+    parser.add_argument('--root', default=os.environ.get("CTA_DATA_ROOT", r'C:\git\SocialReporter\data'))
+    args = parser.parse_args()
+
+    BACKEND = BACKENDS[args.backend]
+    MODEL = BACKEND['model']
+    root_directory = args.root
+    store = open_store(root_directory, write_behind=True)
+    preprocessor = ImagePreprocessor()
+    metrics = get_metrics(MODEL)
+
+    start_time = time.time()
+    metrics.start()
+
+    pending = preprocessor.prefetch(metrics.timed("walk", find_pending_posts(root_directory)), lambda post: post['image_paths'])
+    if args.backend == 'api':
+        # Retries (including 429 retry-after) are handled by the scoring engine
+        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", myKey), max_retries=0)
+        limiter = TokenBucket(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        ask = ask_api
+        for _ in run_concurrently(pending, process_post, MAX_IN_FLIGHT):
+            pass
+    else:
+        ollama = get_client()
+        ask = ask_local
+        ollama.preload(MODEL)
+        for _ in ollama.map(pending, process_post):
+            pass
+    preprocessor.close()
+    store.close()
+
+    print(f"Total processing time: {time.time() - start_time:.2f} seconds")
+    metrics.print_summary()
+    metrics.close()
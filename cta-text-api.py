@@ -1,99 +1,225 @@
 import os
-import json
 import re
 import time  # Import the time module
 from openai import OpenAI
 from equipment import myKey
+from results_store import open_store
+from result_cache import get_cache, make_key
+from metrics import get_metrics
+from work_queue import WorkQueue, QUEUE_MODE, print_counts
+from openai_batch import BATCH_MODE, run_batches
+from cta_rules import triage, provenance
+from caption_batching import CaptionBatcher, CAPTION_BATCH, build_batch_prompt, batch_workers
+from post_ingest import read_post_record
+from scoring_engine import TokenBucket, call_with_limits, estimate_text_tokens, run_concurrently
 
 # Set the API key and model name
 MODEL = "gpt-4o-mini"
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", myKey))
-
-# Function to analyze the text for a call to action and return a score and response
-def analyze_text_for_cta(text):
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
-            {"role": "system", "content": "You work in marketing at a university and you analyze text."},
-            {"role": "user", "content": f"Analyze the following text for a call to action. The text is:\n\n{text}\n\nReturn a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."}
+# Retries (including 429 retry-after) are handled by the scoring engine
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", myKey), max_retries=0)
+
+# Concurrency and rate limits (adjust to the limits of your account)
+MAX_IN_FLIGHT = int(os.environ.get("CTA_MAX_IN_FLIGHT", 8))
+REQUESTS_PER_MINUTE = int(os.environ.get("OPENAI_RPM", 500))
+TOKENS_PER_MINUTE = int(os.environ.get("OPENAI_TPM", 200000))
+limiter = TokenBucket(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+cache = get_cache()
+metrics = get_metrics(MODEL)
+
+SYSTEM_PROMPT = "You work in marketing at a university and you analyze text."
+USER_PROMPT = "Analyze the following text for a call to action. The text is:\n\n{text}\n\nReturn a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action."
+
+# Completion budget added to the prompt estimate for the token limiter
+MAX_RESPONSE_TOKENS = 300
+
+# Function to build the chat request for one text (also used for the batch files)
+def build_request(text):
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": USER_PROMPT.format(text=text)}
         ],
-        temperature=0.0,
-    )
-    response_text = response.choices[0].message.content.strip()
+        "temperature": 0.0,
+    }
 
-    # Use regex to extract the score from the response text
+# Function to extract the score from the response text (None if there is none)
+def parse_score(response_text):
     score_match = re.search(r'\b(\d\.\d)\b', response_text)
-    if score_match:
-        score = float(score_match.group(1))
-        return round(score, 1), response_text
+    return round(float(score_match.group(1)), 1) if score_match else None
+
+# Function to ask the model for the score of a text and return the score and response
+def ask_model_for_cta(text):
+    # Identical texts (same text, model and prompt) are only scored once
+    with metrics.stage("cache"):
+        cache_key = make_key(MODEL, SYSTEM_PROMPT + "\n" + USER_PROMPT, text)
+        cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.count("cache_hits")
+        return cached
+
+    user_prompt = USER_PROMPT.format(text=text)
+    # Includes waiting for the rate limiter and retries
+    with metrics.stage("model"), metrics.in_flight():
+        response = call_with_limits(
+            lambda: client.chat.completions.create(**build_request(text)),
+            limiter,
+            estimate_text_tokens(SYSTEM_PROMPT + user_prompt) + MAX_RESPONSE_TOKENS,
+        )
+    with metrics.stage("parse"):
+        response_text = response.choices[0].message.content.strip()
+        score = parse_score(response_text)
+    if score is not None:
+        cache.put(cache_key, score, response_text)
+        return score, response_text
     else:
+        metrics.count("parse_failures")
         return 0.0, response_text  # Return 0.0 and the full response if the score cannot be parsed
 
-# Function to check if a "-cta-txt" JSON file already exists
+# Function to score several texts with one request; returns the JSON answer of the model
+def ask_model_for_batch(texts):
+    user_prompt = build_batch_prompt(texts)
+    with metrics.stage("model"), metrics.in_flight():
+        response = call_with_limits(
+            lambda: client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.0,
+                response_format={"type": "json_object"},
+            ),
+            limiter,
+            estimate_text_tokens(SYSTEM_PROMPT + user_prompt) + MAX_RESPONSE_TOKENS,
+        )
+    return response.choices[0].message.content
+
+# Captions are packed into batches of CTA_CAPTION_BATCH when it is above 1
+batcher = CaptionBatcher(ask_model_for_batch, ask_model_for_cta, metrics=metrics) if CAPTION_BATCH > 1 else None
+
+# Function to score a text for a call to action: clear-cut texts are decided by the rules,
+# only ambiguous ones go to the model. Returns the score, the response and who decided.
+def analyze_text_for_cta(text):
+    decision = triage(text)
+    if decision is not None:
+        metrics.count("rule_decisions")
+        return decision['score'], decision['response'], provenance(decision)
+    if batcher is not None:
+        score, response_text, details = batcher.score(text)
+        return score, response_text, dict(provenance(), **details)
+    score, response_text = ask_model_for_cta(text)
+    return score, response_text, provenance()
+
+# Function to check if a text analysis already exists in the results store
 def json_text_analysis_exists(json_path):
-    json_filename = os.path.splitext(json_path)[0] + "-cta-txt.json"
-    return os.path.exists(json_filename)
-
-# Path to the root directory containing the data
-root_directory = r'C:\git\SocialReporter\data'
-
-# Traverse the directory structure
-for subdir, dirs, files in os.walk(root_directory):
-    for filename in files:
-        if filename.endswith(".json"):  # Check if the file is a JSON file
-            json_path = os.path.join(subdir, filename)
-
-            # Check if the text analysis is already done
-            if not json_text_analysis_exists(json_path):
-                try:
-                    # Read the JSON file
-                    with open(json_path, "r", encoding="utf-8") as file:
-                        data = json.load(file)
-
-                    # Check if the data is a list or a dictionary
-                    if isinstance(data, list):
-                        print(f"{filename}: JSON data is a list. Skipping file.")
-                        continue
-                    
-                    # Extract the text instead of caption
-                    text_content = data.get("text", "")
-
-                    if text_content:  # Proceed if text exists
-                        # Record the start time
-                        start_time = time.time()
-
-                        # Analyze the text
-                        cta_score, api_response = analyze_text_for_cta(text_content)
-
-                        # Create a new JSON object with the analysis result
-                        analysis_result = {
-                            "original_filename": filename,
-                            "cta_txt_score": cta_score,
-                            "api_txt_response": api_response
-                        }
-
-                        # Create a new filename with the "-cta-txt" suffix
-                        new_filename = os.path.splitext(filename)[0] + "-cta-txt.json"
-                        new_filepath = os.path.join(subdir, new_filename)
-
-                        # Write the analysis result to the new JSON file
-                        with open(new_filepath, "w", encoding="utf-8") as outfile:
-                            json.dump(analysis_result, outfile, indent=4)
-
-                        # Record the end time
-                        end_time = time.time()
-
-                        # Calculate the time taken
-                        time_taken = end_time - start_time
-
-                        # Output the result and time to the console
-                        print(f"{filename}: {cta_score} (Result saved to {new_filename})")
-                        print(f"Time taken to process {filename}: {time_taken:.2f} seconds")
-                    else:
-                        print(f"{filename}: No text found.")
-                except json.JSONDecodeError as e:
-                    print(f"{filename}: Error reading JSON - {e}")
-                except Exception as e:
-                    print(f"{filename}: An unexpected error occurred - {e}")
-            else:
-                print(f"Analysis for {filename} already exists. Skipping.")
+    return store.exists(json_path, "txt-api")
+
+# Function to analyze the text of one post and write its "-cta-txt" JSON file
+def process_post(subdir, filename, text_content):
+    try:
+        # Record the start time
+        start_time = time.time()
+
+        # Analyze the text
+        cta_score, api_response, source = analyze_text_for_cta(text_content)
+
+        # Save the analysis result in the results store ("-cta-txt" JSON file by default)
+        with metrics.stage("write"):
+            store.put(os.path.join(subdir, filename), "txt-api", MODEL, cta_score, api_response, latency=time.time() - start_time,
+                      extra=source)
+        new_filename = os.path.splitext(filename)[0] + "-cta-txt.json"
+
+        # The time per stage is recorded in the metrics snapshot
+        metrics.observe("file", time.time() - start_time)
+        metrics.count("scored")
+        print(f"{filename}: {cta_score} (Result saved to {new_filename})")
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {e}")
+        # Reported to the work queue, which retries the post later
+        raise
+
+# Function to read the text of a post that comes from the work queue
+def process_job(job):
+    subdir, filename = os.path.split(job['input_path'])
+    with metrics.stage("read"):
+        record = read_post_record(job['input_path'])
+    process_post(subdir, filename, record["text"] if record else "")
+
+# Function to turn a pending post into a batch request; posts the rules decide are stored right away
+def build_batch_request(item):
+    subdir, filename, text_content = item
+    if triage(text_content) is not None:
+        process_post(subdir, filename, text_content)
+        return None
+    return os.path.join(subdir, filename), build_request(text_content)
+
+# Function to list the posts whose text still needs an analysis
+def find_pending_posts(root_directory):
+    for subdir, dirs, files in os.walk(root_directory):
+        for filename in files:
+            if filename.endswith(".json"):  # Check if the file is a JSON file
+                json_path = os.path.join(subdir, filename)
+
+                # Check if the text analysis is already done
+                if not json_text_analysis_exists(json_path):
+                    try:
+                        # Read the JSON file
+                        with metrics.stage("read"):
+                            record = read_post_record(json_path)
+
+                        # Lists and other non-post JSON files have no record
+                        if record is None:
+                            print(f"{filename}: JSON data is a list. Skipping file.")
+                            continue
+
+                        # Extract the text instead of caption
+                        text_content = record["text"]
+
+                        if text_content:  # Proceed if text exists
+                            yield subdir, filename, text_content
+                        else:
+                            print(f"{filename}: No text found.")
+                    except ValueError as e:
+                        metrics.count("read_errors")
+                        print(f"{filename}: Error reading JSON - {e}")
+                    except Exception as e:
+                        print(f"{filename}: An unexpected error occurred - {e}")
+                else:
+                    metrics.count("skipped")
+                    print(f"Analysis for {filename} already exists. Skipping.")
+
+if __name__ == "__main__":
+    # Path to the root directory containing the data
+    root_directory = os.environ.get("CTA_DATA_ROOT", r'C:\git\SocialReporter\data')
+    # In queue mode a job is marked done only once its result is on disk, so results are written right away
+    store = open_store(root_directory, write_behind=QUEUE_MODE != 'on')
+
+    start_time = time.time()
+    metrics.start()
+
+    # Analyze up to MAX_IN_FLIGHT texts at once within the rate limits
+    # (with caption batches, enough workers to fill a batch for every request)
+    if BATCH_MODE == 'on':
+        # Ingest finished batches and submit the missing posts as new ones (run again to collect the results)
+        run_batches(client, store, "txt-api", MODEL, metrics.timed("walk", find_pending_posts(root_directory)),
+                    lambda item: os.path.join(item[0], item[1]), build_batch_request, parse_score, provenance())
+    elif QUEUE_MODE == 'on':
+        # Every worker adds the missing posts to the shared queue and then drains it
+        queue = WorkQueue(root_directory)
+        queue.enqueue("txt-api", (os.path.join(subdir, filename) for subdir, filename, _ in metrics.timed("walk", find_pending_posts(root_directory))))
+        while queue.has_pending("txt-api"):
+            for job, _, error in run_concurrently(queue.iter_jobs("txt-api", batch_size=batch_workers(MAX_IN_FLIGHT)), process_job, batch_workers(MAX_IN_FLIGHT)):
+                queue.finish(job, error)
+        print_counts(queue, "txt-api")
+        queue.close()
+    else:
+        for _ in run_concurrently(metrics.timed("walk", find_pending_posts(root_directory)), lambda item: process_post(*item), batch_workers(MAX_IN_FLIGHT)):
+            pass
+
+    store.close()
+
+    print(f"Total processing time: {time.time() - start_time:.2f} seconds")
+    metrics.print_summary()
+    metrics.close()
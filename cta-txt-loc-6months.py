@@ -1,111 +1,211 @@
 import os
 import json
 import re
-import requests
 import time
 from datetime import datetime
+from ollama_client import get_client, client_for, ANSWER_SIGNATURE
+from results_store import open_store
+from result_cache import get_cache, make_key
+from metrics import get_metrics
+from cta_rules import triage, provenance
+from caption_batching import CaptionBatcher, CAPTION_BATCH, SCORES_SCHEMA, build_batch_prompt, batch_workers
+from sharding import parse_shard, in_shard, shard_summary_path, merge_shard_summaries
+from post_ingest import read_post_record
+from watch_mode import PostWatcher, watch_and_score
 
 # Set the model name
 MODEL = "llama3.1"
 
-def analyze_text_for_cta(text):
-    api_url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": MODEL,
-        "prompt": (
-            "You work in marketing at a university and you analyze text. "
-            f"Analyze the following text for a call to action. The text is:\n\n{text}\n\n"
-            "Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action.\n"
-            "Respond in the following format:\n"
-            "Score: [Your score]\n"
-            "Reasoning: [Your reasoning]"
-        ),
-        "stream": False
-    }
-   
-    response = requests.post(api_url, json=payload)
+ollama = get_client()
+cache = get_cache()
+metrics = get_metrics(MODEL)
+
+PROMPT_TEMPLATE = (
+    "You work in marketing at a university and you analyze text. "
+    "Analyze the following text for a call to action. The text is:\n\n{text}\n\n"
+    "Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action.\n"
+    "Respond in the following format:\n"
+    "Score: [Your score]\n"
+    "Reasoning: [Your reasoning]"
+)
+
+def ask_model_for_cta(text):
+    # Identical captions (same text, model and prompt) are only scored once
+    with metrics.stage("cache"):
+        cache_key = make_key(MODEL, PROMPT_TEMPLATE + ANSWER_SIGNATURE, text)
+        cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.count("cache_hits")
+        return cached
+
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.score(MODEL, PROMPT_TEMPLATE.format(text=text), sample_key=cache_key)
    
     if response.status_code != 200:
+        metrics.count("http_errors")
         return 0.0, f"Error: HTTP {response.status_code} - {response.text}"
    
-    response_json = response.json()
-    response_text = response_json.get('response', 'No analysis available')
-   
-    score_match = re.search(r'Score:\s*(\d+\.?\d*)', response_text)
+    with metrics.stage("parse"):
+        response_json = response.json()
+        response_text = response_json.get('response', 'No analysis available')
+
+        score_match = re.search(r'Score:\s*(\d+\.?\d*)', response_text)
     if score_match:
-        score = float(score_match.group(1))
-        return round(score, 1), response_text
+        score = round(float(score_match.group(1)), 1)
+        cache.put(cache_key, score, response_text)
+        return score, response_text
     else:
+        metrics.count("parse_failures")
         return 0.0, response_text
 
+# Function to score several texts with one request; returns the JSON answer of the model
+def ask_model_for_batch(texts):
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.generate(MODEL, "You work in marketing at a university and you analyze text. " + build_batch_prompt(texts),
+                                   format=SCORES_SCHEMA, kind="batch")
+    if response.status_code != 200:
+        metrics.count("http_errors")
+        raise RuntimeError(f"HTTP {response.status_code} - {response.text}")
+    return response.json().get('response', '')
+
+# Captions are packed into batches of CTA_CAPTION_BATCH when it is above 1
+batcher = CaptionBatcher(ask_model_for_batch, ask_model_for_cta, metrics=metrics) if CAPTION_BATCH > 1 else None
+
+# Function to score a text for a call to action: clear-cut texts are decided by the rules,
+# only ambiguous ones go to the model. Returns the score, the response and who decided.
+def analyze_text_for_cta(text):
+    decision = triage(text)
+    if decision is not None:
+        metrics.count("rule_decisions")
+        return decision['score'], decision['response'], provenance(decision)
+    if batcher is not None:
+        score, response_text, details = batcher.score(text)
+        return score, response_text, dict(provenance(), **details)
+    score, response_text = ask_model_for_cta(text)
+    return score, response_text, provenance()
+
+OUTPUT_FILENAME = 'cta_txt_analysis_summary.json'
+
 def get_relevant_posts(root_directory, relevant_filenames_json):
     with open(os.path.join(root_directory, relevant_filenames_json), 'r') as f:
         relevant_data = json.load(f)
         return set(relevant_data['filenames'])
 
+def analyze_caption(store, json_path, text_content):
+    filename = os.path.basename(json_path)
+    analysis_filename = f"{os.path.splitext(filename)[0]}-cta-txt-loc.json"
+    try:
+        start_time = time.time()
+        cta_score, api_response, source = analyze_text_for_cta(text_content)
+        if api_response.startswith("Error: HTTP"):
+            # Not saved, so the caption is analyzed again on the next run (or retried by the work queue)
+            raise RuntimeError(api_response)
+
+        with metrics.stage("write"):
+            store.put(json_path, "txt-loc", MODEL, cta_score, api_response, latency=time.time() - start_time,
+                      extra=source, analyzed_at=datetime.now().isoformat())
+
+        # The time per stage is recorded in the metrics snapshot
+        metrics.observe("file", time.time() - start_time)
+        metrics.count("scored")
+        print(f"{filename}: {cta_score} (Result saved to {analysis_filename})")
+        return cta_score
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {e}")
+        return None
+
 def analyze_captions(root_directory, relevant_posts):
     results = {}
     total_analyzed = 0
+    pending = []
+    store = open_store(root_directory, write_behind=True)
 
-    for subdir, _, files in os.walk(root_directory):
+    for subdir, _, files in metrics.timed("walk", os.walk(root_directory)):
         for filename in files:
             if filename in relevant_posts:
                 json_path = os.path.join(subdir, filename)
-                analysis_filename = f"{os.path.splitext(filename)[0]}-cta-txt-loc.json"
-                analysis_path = os.path.join(subdir, analysis_filename)
+                existing_analysis = store.get(json_path, "txt-loc")
 
-                if not os.path.exists(analysis_path):
+                if existing_analysis is None:
                     try:
-                        with open(json_path, 'r', encoding='utf-8') as file:
-                            data = json.load(file)
+                        with metrics.stage("read"):
+                            record = read_post_record(json_path)
 
-                        text_content = data.get("text", "")
+                        text_content = record["text"] if record else ""
 
                         if text_content:
-                            start_time = time.time()
-                            cta_score, api_response = analyze_text_for_cta(text_content)
-                            total_analyzed += 1
-
-                            analysis_result = {
-                                "original_loc_filenam": filename,
-                                "cta_txt_loc_score": cta_score,
-                                "api_txt_loc_response": api_response,
-                                "analysis_date": datetime.now().isoformat()
-                            }
-
-                            with open(analysis_path, "w", encoding="utf-8") as outfile:
-                                json.dump(analysis_result, outfile, indent=4)
-
-                            end_time = time.time()
-                            time_taken = end_time - start_time
-
-                            print(f"{filename}: {cta_score} (Result saved to {analysis_filename})")
-                            print(f"Time taken to process {filename}: {time_taken:.2f} seconds")
-
-                            results[filename] = cta_score
+                            pending.append((json_path, text_content))
                         else:
+                            metrics.count("no_text")
                             print(f"{filename}: No text content found.")
                     except Exception as e:
+                        metrics.count("read_errors")
                         print(f"{filename}: An unexpected error occurred - {e}")
                 else:
+                    metrics.count("skipped")
                     print(f"Analysis for {filename} already exists. Skipping.")
-                    with open(analysis_path, 'r') as f:
-                        existing_analysis = json.load(f)
-                        cta_score = existing_analysis.get('cta_caption_score', 0.0)
-                    results[filename] = cta_score
+                    results[filename] = existing_analysis['score'] or 0.0
                     total_analyzed += 1
 
+    # Analyze the missing captions with as many requests in flight as the server handles
+    # (with caption batches, enough workers to fill a batch for every request)
+    ollama.preload(MODEL)
+    for item, cta_score, _ in ollama.map(pending, lambda item: analyze_caption(store, *item), batch_workers(ollama.max_parallel)):
+        if cta_score is not None:
+            results[os.path.basename(item[0])] = cta_score
+            total_analyzed += 1
+
+    # Waits until the writer thread has written every result
+    store.close()
     return results, total_analyzed
 
-def save_summary(root_directory, results, total_analyzed, relevant_posts):
+# Function to score the caption of a post that landed while watching; raises when it could not be
+# scored, so the work queue tries it again
+def score_new_post(store, json_path):
+    existing_analysis = store.get(json_path, "txt-loc")
+    if existing_analysis is not None:
+        return existing_analysis['score'] or 0.0
+    with metrics.stage("read"):
+        record = read_post_record(json_path)
+    text_content = record["text"] if record else ""
+    if not text_content:
+        metrics.count("no_text")
+        print(f"{os.path.basename(json_path)}: No text content found.")
+        return None
+    cta_score = analyze_caption(store, json_path, text_content)
+    if cta_score is None:
+        raise RuntimeError("Caption could not be scored")
+    return cta_score
+
+# Function to keep scoring the captions of new relevant posts as they land (--watch)
+def watch_captions(root_directory, watcher, results, relevant_posts, shard=None):
+    # Results are written right away, a job is only marked done once its result is on disk
+    store = open_store(root_directory)
+
+    def find_new():
+        posts, _ = watcher.poll()
+        new_posts = [json_path for json_path in posts if in_shard(os.path.splitext(os.path.basename(json_path))[0], shard)]
+        relevant_posts.update(os.path.basename(json_path) for json_path in new_posts)
+        return new_posts
+
+    def on_scored(json_path, cta_score):
+        if cta_score is not None:
+            results[os.path.basename(json_path)] = cta_score
+
+    watch_and_score(root_directory, "txt-loc", find_new, lambda json_path: score_new_post(store, json_path), on_scored,
+                    lambda: save_summary(root_directory, results, len(results), relevant_posts, shard),
+                    ollama, MODEL, batch_workers(ollama.max_parallel))
+    store.close()
+
+def save_summary(root_directory, results, total_analyzed, relevant_posts, shard=None):
     summary = {
         "total_relevant_posts": len(relevant_posts),
         "analyzed_captions": total_analyzed,
         "caption_cta_scores": results
     }
 
-    output_filename = 'cta_txt_analysis_summary.json'
-    output_path = os.path.join(root_directory, output_filename)
+    output_path = shard_summary_path(root_directory, OUTPUT_FILENAME, shard)
     with open(output_path, 'w', encoding='utf-8') as f:
         json.dump(summary, f, indent=2, ensure_ascii=False)
 
@@ -115,9 +215,35 @@ def save_summary(root_directory, results, total_analyzed, relevant_posts):
     print(f"Summary saved to: {output_path}")
 
 if __name__ == "__main__":
-    root_directory = r'C:\git\SocialReporter\data'
+    import argparse
+    parser = argparse.ArgumentParser(description="Score the captions of the relevant posts for a call to action.")
+    parser.add_argument('--root', default=os.environ.get("CTA_DATA_ROOT", r'C:\git\SocialReporter\data'))
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="only score the posts of shard i of N (i/N, counted from 0); every node runs one shard")
+    parser.add_argument('--endpoint', action='append', default=None,
+                        help="Ollama server as URL or URL=parallel requests; repeat for several servers")
+    parser.add_argument('--merge', action='store_true', help="merge the shard summaries into the combined summary and exit")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and score the captions of new posts as they land")
+    args = parser.parse_args()
+    root_directory = args.root
     relevant_filenames_json = 'relevant_post_filenames.json'
-    
-    relevant_posts = get_relevant_posts(root_directory, relevant_filenames_json)
+
+    if args.merge:
+        output_path, _ = merge_shard_summaries(root_directory, OUTPUT_FILENAME)
+        print(f"Merged summary saved to: {output_path}")
+        raise SystemExit
+    if args.endpoint:
+        ollama = client_for(args.endpoint)
+
+    metrics.start()
+    # Started before the first pass, so posts that land during it are not missed
+    watcher = PostWatcher(root_directory) if args.watch else None
+    relevant_posts = {filename for filename in get_relevant_posts(root_directory, relevant_filenames_json)
+                      if in_shard(os.path.splitext(filename)[0], args.shard)}
     results, total_analyzed = analyze_captions(root_directory, relevant_posts)
-    save_summary(root_directory, results, total_analyzed, relevant_posts)
\ No newline at end of file
+    save_summary(root_directory, results, total_analyzed, relevant_posts, args.shard)
+    if watcher is not None:
+        watch_captions(root_directory, watcher, results, relevant_posts, args.shard)
+    metrics.print_summary()
+    metrics.close()
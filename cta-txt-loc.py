@@ -1,115 +1,156 @@
 import os
-import json
 import re
-import requests
-import chardet
 from datetime import datetime
 import time
 from equipment import myDirectory
+from ollama_client import get_client, ANSWER_SIGNATURE
+from results_store import open_store
+from result_cache import get_cache, make_key
+from metrics import get_metrics
+from cta_rules import triage, provenance
+from caption_batching import CaptionBatcher, CAPTION_BATCH, SCORES_SCHEMA, build_batch_prompt, batch_workers
+from post_ingest import read_post_record
 
-def detect_encoding(file_path):
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
-    return chardet.detect(raw_data)['encoding']
+# Set the model name
+MODEL = "llama3.1"
 
-def analyze_text_for_cta(text):
-    api_url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": "llama3.1",
-        "prompt": (
-            "You work in marketing at a university and you analyze text. "
-            f"Analyze the following text for a call to action. The text is:\n\n{text}\n\n"
-            "Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action.\n"
-            "Respond in the following format:\n"
-            "Score: [Your score]\n"
-            "Reasoning: [Your reasoning]"
-        ),
-        "stream": False
-    }
-   
-    response = requests.post(api_url, json=payload)
+ollama = get_client()
+cache = get_cache()
+metrics = get_metrics(MODEL)
+
+PROMPT_TEMPLATE = (
+    "You work in marketing at a university and you analyze text. "
+    "Analyze the following text for a call to action. The text is:\n\n{text}\n\n"
+    "Return a score from 0 to 1 in increments of 0.1 based on the likelihood it contains a call to action.\n"
+    "Respond in the following format:\n"
+    "Score: [Your score]\n"
+    "Reasoning: [Your reasoning]"
+)
+
+def ask_model_for_cta(text):
+    # Identical captions (same text, model and prompt) are only scored once
+    with metrics.stage("cache"):
+        cache_key = make_key(MODEL, PROMPT_TEMPLATE + ANSWER_SIGNATURE, text)
+        cached = cache.get(cache_key)
+    if cached is not None:
+        metrics.count("cache_hits")
+        return cached
+
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.score(MODEL, PROMPT_TEMPLATE.format(text=text), sample_key=cache_key)
    
     if response.status_code != 200:
+        metrics.count("http_errors")
         return 0.0, f"Error: HTTP {response.status_code} - {response.text}"
    
-    response_json = response.json()
-    response_text = response_json.get('response', 'No analysis available')
-   
-    score_match = re.search(r'Score:\s*(\d+\.?\d*)', response_text)
+    with metrics.stage("parse"):
+        response_json = response.json()
+        response_text = response_json.get('response', 'No analysis available')
+
+        score_match = re.search(r'Score:\s*(\d+\.?\d*)', response_text)
     if score_match:
-        score = float(score_match.group(1))
-        return round(score, 1), response_text
+        score = round(float(score_match.group(1)), 1)
+        cache.put(cache_key, score, response_text)
+        return score, response_text
     else:
+        metrics.count("parse_failures")
         return 0.0, response_text
 
-directory = myDirectory
+# Function to score several texts with one request; returns the JSON answer of the model
+def ask_model_for_batch(texts):
+    with metrics.stage("model"), metrics.in_flight():
+        response = ollama.generate(MODEL, "You work in marketing at a university and you analyze text. " + build_batch_prompt(texts),
+                                   format=SCORES_SCHEMA, kind="batch")
+    if response.status_code != 200:
+        metrics.count("http_errors")
+        raise RuntimeError(f"HTTP {response.status_code} - {response.text}")
+    return response.json().get('response', '')
 
-start_time = time.time()
+# Captions are packed into batches of CTA_CAPTION_BATCH when it is above 1
+batcher = CaptionBatcher(ask_model_for_batch, ask_model_for_cta, metrics=metrics) if CAPTION_BATCH > 1 else None
+
+# Function to score a text for a call to action: clear-cut texts are decided by the rules,
+# only ambiguous ones go to the model. Returns the score, the response and who decided.
+def analyze_text_for_cta(text):
+    decision = triage(text)
+    if decision is not None:
+        metrics.count("rule_decisions")
+        return decision['score'], decision['response'], provenance(decision)
+    if batcher is not None:
+        score, response_text, details = batcher.score(text)
+        return score, response_text, dict(provenance(), **details)
+    score, response_text = ask_model_for_cta(text)
+    return score, response_text, provenance()
 
-for filename in os.listdir(directory):
-    if filename.endswith(".json") and not filename.endswith("-cta-local.json"):
-        json_path = os.path.join(directory, filename)
-        cta_local_path = os.path.join(directory, os.path.splitext(filename)[0] + "-cta-local.json")
+def process_file(store, directory, filename):
+    json_path = os.path.join(directory, filename)
+    cta_local_path = os.path.join(directory, os.path.splitext(filename)[0] + "-cta-local.json")
+    
+    file_start_time = time.time()
+    
+    try:
+        # Check if the file has already been checked
+        if store.exists(json_path, "local"):
+            metrics.count("skipped")
+            print(f"{filename}: Already analyzed. Skipping.")
+            return
         
-        file_start_time = time.time()
+        # UTF-8 is tried first, the encoding of other files is detected once and cached
+        with metrics.stage("read"):
+            record = read_post_record(json_path)
         
-        try:
-            # Check if -cta-local.json file exists and has been checked
-            if os.path.exists(cta_local_path):
-                with open(cta_local_path, "r", encoding="utf-8") as cta_file:
-                    cta_data = json.load(cta_file)
-                    if cta_data.get("checked", False):
-                        print(f"{filename}: Already analyzed. Skipping.")
-                        continue
-            
-            encoding = detect_encoding(json_path)
-            with open(json_path, "r", encoding=encoding) as file:
-                data = json.load(file)
-            
-            caption = data.get("caption", "")
+        # The record also has captions kept in nested structures
+        caption = record["caption"] if record else ""
+        
+        if caption:
+            cta_score, api_response, source = analyze_text_for_cta(caption)
+            if api_response.startswith("Error: HTTP"):
+                # Not saved, so the caption is analyzed again on the next run
+                raise RuntimeError(api_response)
             
-            if not caption and isinstance(data, dict):
-                # Try to find caption in nested structures
-                for key, value in data.items():
-                    if isinstance(value, dict) and "caption" in value:
-                        caption = value["caption"]
-                        break
+            with metrics.stage("write"):
+                store.put(json_path, "local", MODEL, cta_score, api_response, latency=time.time() - file_start_time,
+                          extra=source, analyzed_at=datetime.now().isoformat())
+            metrics.count("scored")
             
-            if caption:
-                cta_score, api_response = analyze_text_for_cta(caption)
-                
-                analysis_result = {
-                    "original_filename": filename,
-                    "cta_txt_score": cta_score,
-                    "api_txt_response": api_response,
-                    "checked": True,
-                    "check_date": datetime.now().isoformat()
-                }
-                
-                with open(cta_local_path, "w", encoding="utf-8") as outfile:
-                    json.dump(analysis_result, outfile, indent=4)
-                
-                print(f"{filename}: {cta_score} (Result saved to {os.path.basename(cta_local_path)})")
-            else:
-                print(f"{filename}: No caption found.")
-                # Create a file indicating it was checked but no caption was found
-                analysis_result = {
-                    "original_filename": filename,
-                    "checked": True,
-                    "check_date": datetime.now().isoformat(),
-                    "error": "No caption found"
-                }
-                with open(cta_local_path, "w", encoding="utf-8") as outfile:
-                    json.dump(analysis_result, outfile, indent=4)
-        
-        except json.JSONDecodeError as e:
-            print(f"{filename}: Error reading JSON - {e}")
-        except Exception as e:
-            print(f"{filename}: An unexpected error occurred - {str(e)}")
-        
-        file_end_time = time.time()
-        print(f"Time taken to process {filename}: {file_end_time - file_start_time:.2f} seconds")
+            print(f"{filename}: {cta_score} (Result saved to {os.path.basename(cta_local_path)})")
+        else:
+            metrics.count("no_text")
+            print(f"{filename}: No caption found.")
+            # Record that it was checked but no caption was found
+            store.put(json_path, "local", MODEL, None, None,
+                      extra={"error": "No caption found"}, analyzed_at=datetime.now().isoformat())
+    
+    except ValueError as e:
+        metrics.count("read_errors")
+        print(f"{filename}: Error reading JSON - {e}")
+    except Exception as e:
+        metrics.count("errors")
+        print(f"{filename}: An unexpected error occurred - {str(e)}")
+    
+    # The time per stage is recorded in the metrics snapshot
+    metrics.observe("file", time.time() - file_start_time)
+
+if __name__ == "__main__":
+    directory = os.environ.get("CTA_DATA_ROOT", myDirectory)
+    store = open_store(directory, write_behind=True)
+
+    start_time = time.time()
+    metrics.start()
+
+    with metrics.stage("walk"):
+        filenames = [filename for filename in os.listdir(directory)
+                     if filename.endswith(".json") and not filename.endswith("-cta-local.json")]
+
+    # Keep the model loaded and send as many requests as the server runs in parallel
+    # (with caption batches, enough workers to fill a batch for every request)
+    ollama.preload(MODEL)
+    for _ in ollama.map(filenames, lambda filename: process_file(store, directory, filename), batch_workers(ollama.max_parallel)):
+        pass
 
-end_time = time.time()
-print(f"Total processing time: {end_time - start_time:.2f} seconds")
-print("Processing complete.")
+    store.close()
+    end_time = time.time()
+    print(f"Total processing time: {end_time - start_time:.2f} seconds")
+    print("Processing complete.")
+    metrics.print_summary()
+    metrics.close()
@@ -0,0 +1,300 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# CTA categories in the order of the notebooks; their index is the category code
+CATEGORIES = ['Text Only', 'Image Only', 'Both', 'No CTA']
+TEXT_ONLY, IMAGE_ONLY, BOTH, NO_CTA = range(len(CATEGORIES))
+
+# Category code by (has text CTA, has image CTA). cta-analysis.ipynb counts posts with both as 'No CTA'.
+CODES = np.array([[NO_CTA, IMAGE_ONLY], [TEXT_ONLY, BOTH]], dtype=np.int8)
+CODES_WITHOUT_BOTH = np.array([[NO_CTA, IMAGE_ONLY], [TEXT_ONLY, NO_CTA]], dtype=np.int8)
+
+# (text score, image score) columns per score source of the dataset_loader.load_posts table
+POST_SOURCES = {
+    'local': ('text_cta_local_score', 'max_local_image_cta_score'),
+    'api': ('text_cta_api_score', 'max_api_image_cta_score'),
+}
+# The same for the dataset_loader.load_score_pairs table of hypothesis-2.ipynb
+PAIR_SOURCES = {'post': ('cta_txt_score', 'cta_img_score')}
+
+# Local vs API columns compared in cta-analysis.ipynb
+POST_CORRELATIONS = {
+    'text': ('text_cta_local_score', 'text_cta_api_score'),
+    'image': ('avg_local_image_cta_score', 'avg_api_image_cta_score'),
+}
+
+
+def column_values(df, column):
+    return pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+
+
+# Function to flag the scores at the threshold (>= as in dataset_loader, > as in hypothesis-2.ipynb
+# with strict=True); missing scores are no CTA
+def cta_flags(scores, threshold=0.5, strict=False):
+    scores = np.asarray(scores, dtype=float)
+    with np.errstate(invalid='ignore'):
+        return scores > threshold if strict else scores >= threshold
+
+
+def category_codes(has_text, has_image, include_both=True):
+    lookup = CODES if include_both else CODES_WITHOUT_BOTH
+    return lookup[np.asarray(has_text, dtype=np.intp), np.asarray(has_image, dtype=np.intp)]
+
+
+# Function to return the category codes of every source as a (sources, posts) array
+def source_codes(df, sources, threshold=0.5, strict=False, include_both=True):
+    return np.stack([
+        category_codes(cta_flags(column_values(df, text_column), threshold, strict),
+                       cta_flags(column_values(df, image_column), threshold, strict), include_both)
+        for text_column, image_column in sources.values()
+    ]) if sources else np.empty((0, len(df)), dtype=np.int8)
+
+
+# Function to return the CTA category of every post per source, e.g. columns
+# local_cta_category and api_cta_category for the post table
+def categorize(df, sources=POST_SOURCES, threshold=0.5, strict=False, include_both=True):
+    codes = source_codes(df, sources, threshold, strict, include_both)
+    return pd.DataFrame({f"{source}_cta_category": pd.Categorical.from_codes(source_codes_row, CATEGORIES)
+                         for source, source_codes_row in zip(sources, codes)}, index=df.index)
+
+
+# Function to count, sum and sum up the squares of `values` per group in one pass.
+# Values are centred first, so the variance does not suffer from cancellation.
+def grouped_moments(groups, values, n_groups):
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    groups, values = groups[valid], values[valid]
+    center = values.mean() if len(values) else 0.0
+    centred = values - center
+    counts = np.bincount(groups, minlength=n_groups)
+    sums = np.bincount(groups, weights=centred, minlength=n_groups)
+    squares = np.bincount(groups, weights=centred * centred, minlength=n_groups)
+    return (counts, *moment_statistics(counts, sums, squares, center))
+
+
+# Function to turn counts, sums and sums of squares (of values minus `center`) into means and
+# sample standard deviations
+def moment_statistics(counts, sums, squares, center=0.0):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        variances = (squares - counts * means * means) / (counts - 1)
+    return means + center, np.sqrt(np.maximum(variances, 0.0))
+
+
+# Function to add mean, standard deviation, change in percent and a two-sample t-test
+# (as scipy's ttest_ind) against the row `baseline_of` of every row to a table
+def add_baseline_comparison(table, counts, means, stds, baseline_of):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_statistic, p_value = stats.ttest_ind_from_stats(means, stds, counts, means[baseline_of],
+                                                          stds[baseline_of], counts[baseline_of])
+        baseline_means = means[baseline_of]
+        change = np.where(baseline_means != 0, (means / baseline_means - 1) * 100, 0.0)
+    is_baseline = np.arange(len(counts)) == baseline_of
+    table['mean'] = means
+    table['std'] = stds
+    table['change_pct'] = np.where(is_baseline, 0.0, change)
+    table['t_statistic'] = np.where(is_baseline, np.nan, t_statistic)
+    table['p_value'] = np.where(is_baseline, np.nan, p_value)
+    return table
+
+
+def _source_groups(codes):
+    # One group per (source, category), so all sources are aggregated together
+    n_sources = codes.shape[0]
+    return (np.arange(n_sources, dtype=np.intp)[:, None] * len(CATEGORIES) + codes).ravel()
+
+
+def _category_frame(sources):
+    return pd.DataFrame({
+        'source': np.repeat(list(sources), len(CATEGORIES)),
+        'category': pd.Categorical(CATEGORIES * len(sources), categories=CATEGORIES),
+    })
+
+
+# Function to count the posts per source and category (share in percent of all posts)
+def category_distribution(df, sources=POST_SOURCES, threshold=0.5, strict=False, include_both=True):
+    codes = source_codes(df, sources, threshold, strict, include_both)
+    counts = np.bincount(_source_groups(codes), minlength=len(sources) * len(CATEGORIES))
+    table = _category_frame(sources)
+    table['posts'] = counts
+    table['share'] = counts / len(df) * 100 if len(df) else 0.0
+    return table
+
+
+# Function to compare the mean of every value column per source and category with the baseline
+# category (see add_baseline_comparison). Returns one row per (source, category, metric).
+def engagement_by_category(df, sources=POST_SOURCES, value_columns=('engagement_rate',), threshold=0.5,
+                           strict=False, include_both=True, baseline='No CTA'):
+    codes = source_codes(df, sources, threshold, strict, include_both)
+    groups = _source_groups(codes)
+    n_groups = len(sources) * len(CATEGORIES)
+    baseline_rows = np.arange(len(sources)) * len(CATEGORIES) + CATEGORIES.index(baseline)
+    baseline_of = np.repeat(baseline_rows, len(CATEGORIES))
+
+    tables = []
+    for column in value_columns:
+        values = np.tile(column_values(df, column), len(sources))
+        counts, means, stds = grouped_moments(groups, values, n_groups)
+        table = _category_frame(sources)
+        table['metric'] = column
+        table['posts'] = counts
+        tables.append(add_baseline_comparison(table, counts, means, stds, baseline_of))
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+# Function to correlate column pairs (Pearson) over the posts that have both values,
+# e.g. the local and API scores of POST_CORRELATIONS
+def score_correlations(df, pairs=POST_CORRELATIONS):
+    rows = []
+    for name, (column_a, column_b) in pairs.items():
+        a, b = column_values(df, column_a), column_values(df, column_b)
+        valid = np.isfinite(a) & np.isfinite(b)
+        posts = int(valid.sum())
+        correlation = np.nan
+        if posts > 1:
+            a, b = a[valid] - a[valid].mean(), b[valid] - b[valid].mean()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                correlation = float((a @ b) / np.sqrt((a @ a) * (b @ b)))
+        rows.append({'pair': name, 'column_a': column_a, 'column_b': column_b, 'posts': posts, 'correlation': correlation})
+    return pd.DataFrame(rows, columns=['pair', 'column_a', 'column_b', 'posts', 'correlation'])
+
+
+# Function to compute the correlation matrix of `columns` for every category of every source
+# from grouped sums of the values and their pairwise products (rows with a missing value are left out).
+# Returns one row per (source, category, column_a, column_b).
+def correlation_by_category(df, columns, sources=PAIR_SOURCES, threshold=0.5, strict=True, include_both=True):
+    values = np.column_stack([column_values(df, column) for column in columns])
+    valid = np.isfinite(values).all(axis=1)
+    values = values[valid] - values[valid].mean(axis=0) if valid.any() else values[valid]
+    codes = source_codes(df, sources, threshold, strict, include_both)[:, valid]
+    groups = _source_groups(codes)
+    n_groups = len(sources) * len(CATEGORIES)
+    tiled = np.tile(values, (len(sources), 1))
+
+    counts = np.bincount(groups, minlength=n_groups)
+    sums = np.stack([np.bincount(groups, weights=tiled[:, i], minlength=n_groups) for i in range(len(columns))], axis=1)
+    products = np.empty((n_groups, len(columns), len(columns)))
+    for i in range(len(columns)):
+        for j in range(i, len(columns)):
+            products[:, i, j] = products[:, j, i] = np.bincount(groups, weights=tiled[:, i] * tiled[:, j], minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums[:, :, None] * sums[:, None, :] / counts[:, None, None]
+        deviation = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+        correlation = covariance / (deviation[:, :, None] * deviation[:, None, :])
+    correlation[counts < 2] = np.nan
+
+    k = len(columns)
+    table = _category_frame(sources).loc[np.repeat(np.arange(n_groups), k * k)].reset_index(drop=True)
+    table['posts'] = np.repeat(counts, k * k)
+    table['column_a'] = np.tile(np.repeat(list(columns), k), n_groups)
+    table['column_b'] = np.tile(list(columns), n_groups * k)
+    table['correlation'] = correlation.ravel()
+    return table
+
+
+# Thresholds of the sweep: the scores come in 0.1 steps, so these are all cut-offs that differ
+THRESHOLDS = np.round(np.arange(11) / 10, 1)
+LEVELS = len(THRESHOLDS) + 1
+
+
+# Function to map every score to the number of sweep thresholds it reaches (0-11), so
+# "score >= threshold k" (or "> k" with strict=True) becomes "level > k"; missing scores reach none
+def score_levels(scores, strict=False):
+    scaled = np.asarray(scores, dtype=float) * 10
+    with np.errstate(invalid='ignore'):
+        levels = np.ceil(scaled - 1e-9) if strict else np.floor(scaled + 1e-9) + 1
+    return np.clip(np.nan_to_num(levels, nan=0.0), 0, LEVELS - 1).astype(np.intp)
+
+
+def threshold_indices(thresholds):
+    indices = np.rint(np.asarray(thresholds, dtype=float) * 10).astype(np.intp)
+    if np.any((indices < 0) | (indices >= len(THRESHOLDS))) or not np.allclose(indices / 10, thresholds):
+        raise ValueError(f"Thresholds must be multiples of 0.1 between 0 and 1: {thresholds}")
+    return indices
+
+
+# Function to build, per source, the joint histogram of text and image score levels with the
+# count and the sum and sum of squares of every value column (centred on its mean).
+# Returns the suffix sums as an array (sources, moments, LEVELS + 1, LEVELS + 1), where
+# [..., a, b] covers all posts with text level >= a and image level >= b, and the centres.
+def cumulative_histograms(df, sources=POST_SOURCES, value_columns=('engagement_rate',), strict=False):
+    values = [column_values(df, column) for column in value_columns]
+    centers = [v[np.isfinite(v)].mean() if np.isfinite(v).any() else 0.0 for v in values]
+    histograms = np.zeros((len(sources), 1 + 3 * len(values), LEVELS + 1, LEVELS + 1))
+    for i, (text_column, image_column) in enumerate(sources.values()):
+        cells = score_levels(column_values(df, text_column), strict) * LEVELS + score_levels(column_values(df, image_column), strict)
+        moments = [np.bincount(cells, minlength=LEVELS * LEVELS)]
+        for v, center in zip(values, centers):
+            valid = np.isfinite(v)
+            centred = np.where(valid, v - center, 0.0)
+            moments.append(np.bincount(cells, weights=valid, minlength=LEVELS * LEVELS))
+            moments.append(np.bincount(cells, weights=centred, minlength=LEVELS * LEVELS))
+            moments.append(np.bincount(cells, weights=centred * centred, minlength=LEVELS * LEVELS))
+        joint = np.stack(moments).reshape(-1, LEVELS, LEVELS)
+        histograms[i, :, :LEVELS, :LEVELS] = joint[:, ::-1, ::-1].cumsum(axis=1).cumsum(axis=2)[:, ::-1, ::-1]
+    return histograms, centers
+
+
+# Function to answer every threshold at once from the cumulative histograms: posts, share and
+# (per value column) mean, standard deviation, change against the baseline and t-test per source,
+# text threshold, image threshold and category. Without `pairs` the text and image thresholds are
+# the same; with `pairs` every combination is returned.
+def threshold_sweep(df, sources=POST_SOURCES, value_columns=('engagement_rate',), thresholds=THRESHOLDS,
+                    strict=False, include_both=True, pairs=False, baseline='No CTA'):
+    histograms, centers = cumulative_histograms(df, sources, value_columns, strict)
+    indices = threshold_indices(thresholds)
+    if pairs:
+        text_index, image_index = (grid.ravel() for grid in np.meshgrid(indices, indices, indexing='ij'))
+    else:
+        text_index = image_index = indices
+
+    # Level > k for threshold k, i.e. the suffix sums from k + 1
+    both = histograms[:, :, text_index + 1, image_index + 1]
+    text_all = histograms[:, :, text_index + 1, 0]
+    image_all = histograms[:, :, 0, image_index + 1]
+    total = histograms[:, :, :1, 0]
+    by_category = np.stack([text_all - both, image_all - both, both, total - text_all - image_all + both], axis=-1)
+    if not include_both:
+        by_category[..., NO_CTA] += by_category[..., BOTH]
+        by_category[..., BOTH] = 0
+    # Rows in the order source, threshold combination, category
+    moments = by_category.transpose(1, 0, 2, 3).reshape(histograms.shape[1], -1)
+
+    n_combinations = len(text_index)
+    n_rows = len(sources) * n_combinations * len(CATEGORIES)
+    rows = pd.DataFrame({
+        'source': np.repeat(list(sources), n_combinations * len(CATEGORIES)),
+        'text_threshold': np.tile(np.repeat(THRESHOLDS[text_index], len(CATEGORIES)), len(sources)),
+        'image_threshold': np.tile(np.repeat(THRESHOLDS[image_index], len(CATEGORIES)), len(sources)),
+        'category': pd.Categorical(CATEGORIES * (n_rows // len(CATEGORIES)), categories=CATEGORIES),
+        'posts': np.rint(moments[0]).astype(np.int64),
+    })
+    rows['share'] = rows['posts'] / len(df) * 100 if len(df) else 0.0
+    baseline_of = np.repeat(np.arange(n_rows // len(CATEGORIES)) * len(CATEGORIES) + CATEGORIES.index(baseline), len(CATEGORIES))
+
+    tables = []
+    for i, (column, center) in enumerate(zip(value_columns, centers)):
+        counts, sums, squares = moments[1 + 3 * i], moments[2 + 3 * i], moments[3 + 3 * i]
+        means, stds = moment_statistics(counts, sums, squares, center)
+        table = rows.copy()
+        table['metric'] = column
+        tables.append(add_baseline_comparison(table, counts, means, stds, baseline_of))
+    return pd.concat(tables, ignore_index=True) if tables else rows
+
+if __name__ == "__main__":
+    import sys
+    from dataset_loader import load_posts
+    if len(sys.argv) < 2:
+        print("Usage: python cta_analysis.py <root_directory> [threshold]")
+        sys.exit(1)
+    root_directory = sys.argv[1]
+    threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+    df_posts = load_posts(root_directory, threshold=threshold)
+    pd.set_option('display.width', 160)
+    print(category_distribution(df_posts, threshold=threshold).to_string(index=False))
+    print()
+    print(engagement_by_category(df_posts, threshold=threshold).to_string(index=False))
+    print()
+    print(score_correlations(df_posts).to_string(index=False))
@@ -0,0 +1,144 @@
+import os
+import re
+import json
+from results_store import open_store
+from post_ingest import read_post_record
+
+# "on" decides clear-cut captions without a model call, "off" (default) sends every caption to the model.
+# Rule scores replace model scores, so only turn this on once the agreement report looks acceptable.
+RULES_MODE = os.environ.get("CTA_RULES", "off")
+# Bump when the patterns change, it is stored with every rule decision
+RULES_VERSION = 1
+
+# Scores given to the clear-cut cases (same 0.1 steps as the model scores)
+CTA_SCORE = 0.9
+NO_CTA_SCORE = 0.1
+
+# Each of these is a call to action on its own
+STRONG_PATTERNS = {
+    'link_in_bio': r"\blinks?\s+(?:in|im)\s+(?:der\s+|unserer\s+|our\s+|the\s+|my\s+)?(?:bio|profil|profile|story)\b",
+    'url': r"(?:https?://|www\.)\S+|\b[\w-]+\.(?:de|com|org|eu|net|info)/\S*",
+    'register_now': r"\b(?:apply|register|sign\s+up|enrol+|book|subscribe|join\s+us)\s+(?:now|today|here|online|by|before|until)\b",
+    'jetzt_handeln': r"\bjetzt\s+(?:hier\s+)?(?:anmelden|bewerben|registrieren|einschreiben|informieren|mitmachen|teilnehmen|"
+                     r"abstimmen|vorbeikommen|buchen|abonnieren|downloaden|herunterladen|(?:plätze?|tickets?|platz)\s+sichern)\b",
+    'euch_anmelden': r"\b(?:meldet\s+euch|melde\s+dich|melden\s+sie\s+sich)\s+(?:\w+\s+){0,3}?an\b|\bbewerbt\s+euch\b|\bbewirb\s+dich\b|"
+                     r"\bbewerben\s+sie\s+sich\b|\bsichert\s+euch\b|\bsichere?\s+dir\b|\binformiert\s+euch\b|\binformier(?:e)?\s+dich\b",
+    'deadline': r"\b(?:bewerbungsschluss|anmeldeschluss|anmeldefrist|bewerbungsfrist|einschreibefrist|deadline|"
+                r"registration\s+(?:closes|deadline)|apply\s+by)\b",
+    'direct_action': r"\b(?:swipe\s+up|tap\s+the\s+link|click\s+(?:the|on\s+the)\s+link|klickt?\s+auf\s+den\s+link|"
+                     r"dm\s+us|send\s+us\s+a\s+(?:dm|message)|schreibt?\s+uns\s+eine?\s+(?:dm|nachricht)|"
+                     r"tag\s+(?:a\s+friend|your)|markiert?\s+(?:eure|deine|einen?)\s+\w+)\b",
+}
+
+# These make a caption ambiguous: it may or may not ask the reader to act
+WEAK_PATTERNS = {
+    'imperative_en': r"(?:^|[.!?\n]\s*)(?:join|visit|check\s+out|follow|share|comment|save|click|download|watch|read|"
+                     r"discover|learn|find\s+out|come|get|grab|don'?t\s+miss|tell\s+us|let\s+us\s+know|meet)\b",
+    'imperative_de': r"\b(?:schaut|schau|kommt|komm|macht\s+mit|mach\s+mit|seid\s+dabei|sei\s+dabei|besucht|besuche|folgt|folge|"
+                     r"teilt|teile|kommentiert|lest|lies|entdeckt|erfahrt|verpasst|verpass|nutzt|nutze|holt\s+euch|hol\s+dir|"
+                     r"stimmt|erzählt|sagt\s+uns|fragt)\b",
+    'address': r"\b(?:you|your|du|dich|dir|dein\w*|euch|euer|eure\w*|ihr)\b",
+    'exclamation': r"!",
+    'question': r"\?",
+    'event': r"\b(?:anmeldung|registration|tickets?|termin|workshop|infoabend|infotag|open\s+day|webinar|save\s+the\s+date|"
+             r"bewerbung|application|einladung|invitation|gewinnspiel|giveaway|verlosung)\b",
+}
+
+STRONG_RULES = {name: re.compile(pattern, re.IGNORECASE) for name, pattern in STRONG_PATTERNS.items()}
+WEAK_RULES = {name: re.compile(pattern, re.IGNORECASE) for name, pattern in WEAK_PATTERNS.items()}
+
+
+# Function to decide clear-cut captions. Returns None for ambiguous ones, which go to the model.
+def triage(text):
+    if RULES_MODE == 'off' or not text or not text.strip():
+        return None
+    strong = [name for name, rule in STRONG_RULES.items() if rule.search(text)]
+    if strong:
+        return {'score': CTA_SCORE, 'label': 'cta', 'matched': strong,
+                'response': f"Score: {CTA_SCORE}\nReasoning: Rule-based triage found a call to action ({', '.join(strong)})."}
+    weak = [name for name, rule in WEAK_RULES.items() if rule.search(text)]
+    if not weak:
+        return {'score': NO_CTA_SCORE, 'label': 'no_cta', 'matched': [],
+                'response': f"Score: {NO_CTA_SCORE}\nReasoning: Rule-based triage found no imperative, address or link."}
+    return None
+
+
+# Function to describe who decided a score; stored next to every text result
+def provenance(decision=None):
+    if decision is None:
+        return {'decided_by': 'model'}
+    return {'decided_by': 'rules', 'rules_version': RULES_VERSION, 'rule_label': decision['label'],
+            'rule_matches': decision['matched']}
+
+
+# Post JSON key holding the text each method scores
+TEXT_KEYS = {'txt-api': 'text', 'txt-loc': 'text', 'local': 'caption'}
+
+
+def read_text(json_path, method):
+    record = read_post_record(json_path)
+    if record is None:
+        return None
+    return record[TEXT_KEYS[method]] or None
+
+
+# Function to compare the rules with the scores the model already gave
+def agreement_report(root_directory, method, threshold=0.5, store=None):
+    store = store or open_store(root_directory)
+    report = {'method': method, 'threshold': threshold, 'model_scored': 0, 'rule_decided': 0,
+              'agree': 0, 'disagree': 0, 'by_label': {}, 'disagreements': []}
+    for result in store.iter_results(method):
+        if result['score'] is None or result['extra'].get('decided_by') == 'rules':
+            continue
+        try:
+            text = read_text(result['input_path'], method)
+        except (OSError, ValueError):
+            continue
+        report['model_scored'] += 1
+        decision = triage(text)
+        if decision is None:
+            continue
+
+        report['rule_decided'] += 1
+        model_cta = result['score'] >= threshold
+        rule_cta = decision['label'] == 'cta'
+        counts = report['by_label'].setdefault(decision['label'], {'decided': 0, 'agree': 0, 'abs_error': 0.0})
+        counts['decided'] += 1
+        counts['abs_error'] += abs(result['score'] - decision['score'])
+        if model_cta == rule_cta:
+            report['agree'] += 1
+            counts['agree'] += 1
+        else:
+            report['disagree'] += 1
+            report['disagreements'].append({'input_path': result['input_path'], 'model_score': result['score'],
+                                            'rule_label': decision['label'], 'rule_matches': decision['matched']})
+
+    for counts in report['by_label'].values():
+        counts['mean_abs_error'] = counts.pop('abs_error') / counts['decided']
+    report['coverage'] = report['rule_decided'] / report['model_scored'] if report['model_scored'] else 0.0
+    report['agreement'] = report['agree'] / report['rule_decided'] if report['rule_decided'] else None
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python cta_rules.py <root_directory> [method ...]")
+        sys.exit(1)
+    root_directory = sys.argv[1]
+    methods = sys.argv[2:] or list(TEXT_KEYS)
+    RULES_MODE = 'on'
+
+    reports = [agreement_report(root_directory, method) for method in methods]
+    for report in reports:
+        agreement = f"{report['agreement']:.1%}" if report['agreement'] is not None else "-"
+        print(f"{report['method']}: {report['rule_decided']} of {report['model_scored']} model scores decidable by the rules "
+              f"({report['coverage']:.1%}), agreement {agreement}")
+        for label, counts in sorted(report['by_label'].items()):
+            print(f"  {label}: {counts['decided']} decided, {counts['agree']} agree, "
+                  f"mean abs. score difference {counts['mean_abs_error']:.2f}")
+
+    output_path = os.path.join(root_directory, 'cta_rules_agreement.json')
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(reports, f, indent=2, ensure_ascii=False)
+    print(f"Report saved to: {output_path}")
@@ -0,0 +1,258 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from artifact_index import update_index
+from results_store import open_store, sidecar_path, SQLITE_FILENAME
+from post_ingest import read_post_record, read_json as ingest_json
+
+LOADER_VERSION = 1
+SNAPSHOT_FILENAME = 'posts_snapshot'
+READ_WORKERS = int(os.environ.get("CTA_READ_WORKERS", 16))
+
+# Result methods per column of the post table
+TEXT_METHODS = {'text_cta_local_score': 'txt-loc', 'text_cta_api_score': 'txt-api'}
+IMAGE_METHODS = {'local': 'img-loc', 'api': 'img-api'}
+
+
+def load_relevant_files(root_directory):
+    with open(os.path.join(root_directory, 'relevant_cta_files.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Function to resolve the folder of every post once, instead of listing all folders per post
+def resolve_directories(root_directory, relevant_files):
+    artifact_index = None
+    directories = {}
+    for post_id, data in relevant_files.items():
+        directory = data.get('directory')
+        if directory is None:
+            if artifact_index is None:
+                artifact_index = update_index(root_directory)
+            directory = artifact_index.lookup(post_id)['directory']
+        if directory is not None:
+            directories[post_id] = os.path.join(root_directory, directory)
+    return directories
+
+
+def read_json(path):
+    try:
+        return ingest_json(path)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"Error loading {path}: {e}")
+        return None
+
+
+# Function to read everything one post contributes to the table (runs in the thread pool)
+def read_post(store, post_id, directory, images):
+    json_path = os.path.join(directory, f"{post_id}.json")
+    try:
+        original = read_post_record(json_path)
+    except FileNotFoundError:
+        return None, []
+    except ValueError as e:
+        print(f"Error loading {json_path}: {e}")
+        return None, []
+    if original is None:
+        return None, []
+
+    post = {
+        'post_id': post_id,
+        'likes': original['likes'] if original['likes'] is not None else 0,
+        'comments_count': original['comments'] if original['comments'] is not None else 0,
+        'follower_count': original['follower_count'] if original['follower_count'] is not None else 1,
+    }
+    # Missing analyses count as 0, as in the notebooks
+    for column, method in TEXT_METHODS.items():
+        result = store.get(json_path, method)
+        post[column] = result['score'] if result and result['score'] is not None else 0.0
+
+    image_rows = []
+    for image in images:
+        image_path = os.path.join(directory, image)
+        row = {'post_id': post_id, 'image': image}
+        for source, method in IMAGE_METHODS.items():
+            result = store.get(image_path, method)
+            row[source] = result['score'] if result and result['score'] is not None else 0.0
+        image_rows.append(row)
+    return post, image_rows
+
+
+# Function to list the source files of the post table, including sidecars that do not exist yet
+def post_source_paths(root_directory, directories, relevant_files):
+    # The results database (if used) counts as source files; in WAL mode new results are only
+    # in the -wal file until a checkpoint copies them into the database
+    sqlite_path = os.path.join(root_directory, SQLITE_FILENAME)
+    paths = [sqlite_path, sqlite_path + '-wal']
+    for post_id, directory in directories.items():
+        json_path = os.path.join(directory, f"{post_id}.json")
+        paths.append(json_path)
+        paths.extend(sidecar_path(json_path, method) for method in TEXT_METHODS.values())
+        for image in relevant_files[post_id]['images']:
+            image_path = os.path.join(directory, image)
+            paths.extend(sidecar_path(image_path, method) for method in IMAGE_METHODS.values())
+    return paths
+
+
+# Function to build a fingerprint of the source files; it changes whenever one of them does
+def source_fingerprint(paths):
+    def stat(path):
+        try:
+            st = os.stat(path)
+            return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            return f"{path}:-"
+
+    digest = hashlib.sha256(f"v{LOADER_VERSION}".encode('utf-8'))
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        for entry in executor.map(stat, sorted(paths)):
+            digest.update(entry.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def snapshot_paths(root_directory, name=SNAPSHOT_FILENAME):
+    base = os.path.join(root_directory, name)
+    return base + '.parquet', base + '.pkl', base + '.fingerprint'
+
+
+def read_snapshot(root_directory, fingerprint, name=SNAPSHOT_FILENAME):
+    parquet_path, pickle_path, fingerprint_path = snapshot_paths(root_directory, name)
+    try:
+        with open(fingerprint_path, 'r') as f:
+            if f.read().strip() != fingerprint:
+                return None
+        if os.path.exists(parquet_path):
+            return pd.read_parquet(parquet_path)
+        return pd.read_pickle(pickle_path)
+    except (OSError, ValueError, ImportError):
+        return None
+
+
+def write_snapshot(root_directory, fingerprint, df, name=SNAPSHOT_FILENAME):
+    parquet_path, pickle_path, fingerprint_path = snapshot_paths(root_directory, name)
+    try:
+        df.to_parquet(parquet_path, index=False)
+    except ImportError:
+        # No pyarrow/fastparquet installed
+        df.to_pickle(pickle_path)
+    with open(fingerprint_path, 'w') as f:
+        f.write(fingerprint)
+
+
+# Function to return the snapshot `name` if none of `paths` changed, otherwise rebuild and store it
+def cached_frame(root_directory, name, paths, build, use_snapshot=True):
+    if not use_snapshot:
+        return build()
+    fingerprint = source_fingerprint(paths)
+    df = read_snapshot(root_directory, fingerprint, name)
+    if df is None:
+        df = build()
+        write_snapshot(root_directory, fingerprint, df, name)
+    return df
+
+
+# Function to add the columns that depend on the CTA threshold
+def add_threshold_columns(df_posts, threshold=0.5):
+    df_posts['has_text_cta_local'] = df_posts['text_cta_local_score'].to_numpy() >= threshold
+    df_posts['has_text_cta_api'] = df_posts['text_cta_api_score'].to_numpy() >= threshold
+    df_posts['has_local_image_cta'] = df_posts['max_local_image_cta_score'].to_numpy() >= threshold
+    df_posts['has_api_image_cta'] = df_posts['max_api_image_cta_score'].to_numpy() >= threshold
+    return df_posts
+
+
+def build_posts(root_directory, relevant_files, directories, workers=READ_WORKERS):
+    store = open_store(root_directory)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda post_id: read_post(store, post_id, directories[post_id], relevant_files[post_id]['images']),
+            [post_id for post_id in relevant_files if post_id in directories],
+        ))
+
+    posts = pd.DataFrame([post for post, _ in results if post is not None],
+                         columns=['post_id', 'likes', 'comments_count', 'follower_count', *TEXT_METHODS])
+    images = pd.DataFrame([row for post, rows in results if post is not None for row in rows],
+                          columns=['post_id', 'image', *IMAGE_METHODS])
+
+    # Engagement rate as in the notebooks: (likes + comments) / followers, 0 without followers
+    likes = posts['likes'].fillna(0).to_numpy(dtype=float)
+    comments = posts['comments_count'].fillna(0).to_numpy(dtype=float)
+    followers = posts['follower_count'].fillna(0).to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        posts['engagement_rate'] = np.where(followers > 0, (likes + comments) / followers, 0.0)
+
+    # Per-post image aggregates in one grouped pass
+    aggregates = images.groupby('post_id').agg(
+        image_count=('image', 'size'),
+        avg_local_image_cta_score=('local', 'mean'),
+        max_local_image_cta_score=('local', 'max'),
+        avg_api_image_cta_score=('api', 'mean'),
+        max_api_image_cta_score=('api', 'max'),
+    )
+    posts = posts.merge(aggregates, how='left', left_on='post_id', right_index=True)
+    posts['image_count'] = posts['image_count'].fillna(0).astype(int)
+    for column in aggregates.columns.drop('image_count'):
+        posts[column] = posts[column].fillna(0.0)
+    return posts
+
+
+# Function to load the post-level DataFrame used by the analysis notebooks.
+# The table is cached as a snapshot in the data root and rebuilt only when a source file changed.
+def load_posts(root_directory, relevant_files=None, threshold=0.5, use_snapshot=True, workers=READ_WORKERS):
+    if relevant_files is None:
+        relevant_files = load_relevant_files(root_directory)
+    directories = resolve_directories(root_directory, relevant_files)
+
+    paths = post_source_paths(root_directory, directories, relevant_files)
+    df_posts = cached_frame(root_directory, SNAPSHOT_FILENAME, paths,
+                            lambda: build_posts(root_directory, relevant_files, directories, workers),
+                            use_snapshot)
+
+    missing = len(relevant_files) - len(directories)
+    if missing:
+        print(f"Subfolder not found for {missing} posts")
+    return add_threshold_columns(df_posts, threshold)
+
+
+# Function to read one post of the hypothesis 2 table (post text and post image analysis)
+def read_score_pair(directory, post_id):
+    txt_data = read_json(os.path.join(directory, f"{post_id}-cta-txt.json"))
+    img_data = read_json(os.path.join(directory, f"{post_id}-cta-img.json"))
+    original_data = read_json(os.path.join(directory, f"{post_id}.json"))
+    if txt_data is None or img_data is None or not isinstance(original_data, dict):
+        return None
+
+    comments = original_data.get('comments', 0)
+    if isinstance(comments, list):
+        comments = len(comments)
+    return {
+        'filename': txt_data.get('original_filename', 'unknown'),
+        'cta_txt_score': txt_data.get('cta_txt_score', 0),
+        'cta_img_score': img_data.get('cta_img_score', 0),
+        'comments': comments,
+        'likes': original_data.get('likes', 0),
+    }
+
+
+# Function to load the table of hypothesis-2.ipynb: every post that has a text analysis,
+# a post-level image analysis and its original JSON
+def load_score_pairs(root_directory, use_snapshot=True, workers=READ_WORKERS):
+    artifact_index = update_index(root_directory)
+    posts = []
+    for post_id in artifact_index.post_ids():
+        artifacts = artifact_index.lookup(post_id)
+        if artifacts['cta_txt'] and f"{post_id}-cta-img.json" in artifacts['cta_img'] and artifacts['original']:
+            posts.append((os.path.join(root_directory, artifacts['directory'] or ''), post_id))
+
+    paths = [os.path.join(directory, post_id + suffix)
+             for directory, post_id in posts for suffix in ('.json', '-cta-txt.json', '-cta-img.json')]
+
+    def build():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = [row for row in executor.map(lambda post: read_score_pair(*post), posts) if row is not None]
+        return pd.DataFrame(rows, columns=['filename', 'cta_txt_score', 'cta_img_score', 'comments', 'likes'])
+
+    return cached_frame(root_directory, 'score_pairs_snapshot', paths, build, use_snapshot)
@@ -0,0 +1,375 @@
+import re
+import json
+import email.parser
+import email.policy
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Response texts of the fake models; {score} is replaced by a random score
+DEFAULT_RESPONSES = [
+    "Score: {score}\nReasoning: The text asks the reader to visit the website.",
+    "Score: {score}\nReasoning: There is no direct request to the reader.",
+    "Score: {score}\nReasoning: The post invites the reader to register for the event.",
+]
+
+
+# Function to build a latency sampler from a spec such as "fixed:0.5", "uniform:0.2,1.5"
+# or "lognormal:0.8,0.4" (median seconds, sigma)
+def latency_sampler(spec, rng=None):
+    rng = rng or random.Random()
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',')] if args else []
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda: median * rng.lognormvariate(0.0, sigma)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeModelConfig:
+    def __init__(self, latency='fixed:0.5', error_rate=0.0, error_status=500, responses=None,
+                 parallel=0, seed=None):
+        self.rng = random.Random(seed)
+        self.latency = latency_sampler(latency, self.rng)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.responses = responses or DEFAULT_RESPONSES
+        # Requests served at once, like OLLAMA_NUM_PARALLEL (0 = unlimited); the rest queue up
+        self.slots = threading.Semaphore(parallel) if parallel > 0 else None
+        self.lock = threading.Lock()
+        # Uploaded files and batch jobs of the fake OpenAI server
+        self.files = {}
+        self.batches = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.cancelled = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.queue_times = []
+            self.service_times = []
+
+    def response_text(self):
+        with self.lock:
+            template = self.rng.choice(self.responses)
+            score = self.rng.randint(0, 10) / 10.0
+        return template.format(score=f"{score:.1f}")
+
+    # Function to answer in JSON mode: one random score per "Text N:" item of a multi-caption
+    # prompt, or a caption score and one score per attached image of a post prompt
+    def json_scores(self, prompt, images=0):
+        count = len(re.findall(r'^Text \d+:', prompt, re.MULTILINE)) or images
+        with self.lock:
+            answer = {'scores': [{'id': number, 'score': self.rng.randint(0, 10) / 10.0} for number in range(1, count + 1)]}
+            if images:
+                answer['text_score'] = self.rng.randint(0, 10) / 10.0
+                answer['reasoning'] = "The caption and the images were scored together."
+        return json.dumps(answer)
+
+    # Function to hold one model slot for a sampled latency; returns the HTTP status to send.
+    # A streamed answer passes its chunks and a send function: the latency is spread over the
+    # chunks and the slot is freed as soon as the client hangs up, like Ollama does.
+    def serve(self, chunks=None, send=None):
+        received = time.monotonic()
+        if self.slots is not None:
+            self.slots.acquire()
+        started = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency()
+            failed = self.rng.random() < self.error_rate
+        try:
+            if failed or not chunks:
+                time.sleep(max(0.0, delay))
+            else:
+                for chunk in chunks:
+                    time.sleep(max(0.0, delay / len(chunks)))
+                    try:
+                        send(chunk)
+                    except OSError:
+                        with self.lock:
+                            self.cancelled += 1
+                        break
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+            with self.lock:
+                self.in_flight -= 1
+                self.queue_times.append(started - received)
+                self.service_times.append(time.monotonic() - started)
+                if failed:
+                    self.errors += 1
+        return self.error_status if failed else 200
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'cancelled': self.cancelled,
+                'max_in_flight': self.max_in_flight,
+                'queue_time_total': sum(self.queue_times),
+                'service_time_total': sum(self.service_times),
+            }
+
+
+class FakeModelHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, status, body, headers=None):
+        raw = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.config.stats())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+
+class FakeOllamaHandler(FakeModelHandler):
+    # Speaks the /api/generate protocol of Ollama, streamed (one JSON line per token) or not
+    def do_POST(self):
+        if self.path != '/api/generate':
+            self.send_json(404, {'error': 'not found'})
+            return
+        payload = self.read_json()
+        if not payload.get('prompt'):
+            # An empty prompt only loads the model
+            self.send_json(200, {'model': payload.get('model'), 'response': '', 'done': True})
+            return
+        if payload.get('stream', True):
+            self.stream_generate(payload)
+            return
+        status = self.server.config.serve()
+        if status != 200:
+            self.send_json(status, {'error': 'model runner failed'})
+            return
+        self.send_json(200, {
+            'model': payload.get('model'),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'response': self.server.config.json_scores(payload['prompt'], len(payload.get('images') or [])) if payload.get('format')
+                        else self.server.config.response_text(),
+            'done': True,
+        })
+
+    def send_chunk(self, body):
+        raw = json.dumps(body).encode('utf-8') + b'\n'
+        self.wfile.write(f"{len(raw):x}\r\n".encode('ascii') + raw + b'\r\n')
+        self.wfile.flush()
+
+    # Function to stream the answer word by word; num_predict cuts it off like a token limit
+    def stream_generate(self, payload):
+        config = self.server.config
+        tokens = re.findall(r'\S+\s*', config.response_text())
+        num_predict = payload.get('options', {}).get('num_predict', -1)
+        if num_predict >= 0:
+            tokens = tokens[:num_predict]
+        started = [False]
+
+        def send(token):
+            if not started[0]:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                started[0] = True
+            self.send_chunk({'model': payload.get('model'), 'response': token, 'done': False})
+
+        status = config.serve(tokens, send)
+        if status != 200:
+            if not started[0]:
+                self.send_json(status, {'error': 'model runner failed'})
+            return
+        try:
+            if not started[0]:
+                send('')
+            self.send_chunk({'model': payload.get('model'), 'response': '', 'done': True})
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+
+# Function to answer one chat completion request; returns the HTTP status and the body
+def chat_completion(config, payload):
+    status = config.serve()
+    if status != 200:
+        return status, {'error': {'message': 'fake failure', 'type': 'server_error'}}
+    if (payload.get('response_format') or {}).get('type') == 'json_object':
+        content = payload['messages'][-1]['content']
+        if isinstance(content, list):
+            images = sum(1 for part in content if part.get('type') == 'image_url')
+            content = config.json_scores(" ".join(part.get('text', '') for part in content), images)
+        else:
+            content = config.json_scores(content)
+    else:
+        content = config.response_text()
+    prompt_tokens = len(json.dumps(payload.get('messages', []))) // 4
+    completion_tokens = len(content) // 4
+    return 200, {
+        'id': f"chatcmpl-fake-{config.requests}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': payload.get('model'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    }
+
+
+# Function to store an uploaded or generated file like the Files API does
+def add_file(config, content, filename, purpose):
+    with config.lock:
+        file_id = f"file-fake-{len(config.files)}"
+        config.files[file_id] = {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                                 'filename': filename, 'purpose': purpose, 'status': 'processed', 'content': content}
+    return file_id
+
+
+# Function to work through a batch input file in the background: every request line is
+# answered like a chat request, successes go to the output file and failures to the error file
+def run_batch(config, batch):
+    batch['status'] = 'in_progress'
+    batch['in_progress_at'] = int(time.time())
+    outputs = []
+    errors = []
+    for index, line in enumerate(config.files[batch['input_file_id']]['content'].splitlines()):
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        status, body = chat_completion(config, request['body'])
+        result = {'id': f"batch_req_{batch['id']}_{index}", 'custom_id': request['custom_id'],
+                  'response': {'status_code': status, 'request_id': f"req_{index}", 'body': body}, 'error': None}
+        (outputs if status == 200 else errors).append(json.dumps(result).encode('utf-8'))
+        batch['request_counts']['completed' if status == 200 else 'failed'] += 1
+    if outputs:
+        batch['output_file_id'] = add_file(config, b'\n'.join(outputs) + b'\n', f"{batch['id']}_output.jsonl", 'batch_output')
+    if errors:
+        batch['error_file_id'] = add_file(config, b'\n'.join(errors) + b'\n', f"{batch['id']}_error.jsonl", 'batch_output')
+    batch['completed_at'] = int(time.time())
+    batch['status'] = 'completed'
+
+
+class FakeOpenAIHandler(FakeModelHandler):
+    # Speaks the chat completions, files and batches protocols of the OpenAI API (base URL .../v1).
+    # Batches run in a background thread, so they can be polled like real ones.
+    def do_POST(self):
+        config = self.server.config
+        if self.path == '/v1/chat/completions':
+            status, body = chat_completion(config, self.read_json())
+            headers = {'retry-after-ms': '100'} if status == 429 else None
+            self.send_json(status, body, headers)
+        elif self.path == '/v1/files':
+            fields = self.read_multipart()
+            file_id = add_file(config, fields['file'][1], fields['file'][0], fields.get('purpose', (None, b'batch'))[1].decode())
+            self.send_json(200, self.file_object(file_id))
+        elif self.path == '/v1/batches':
+            payload = self.read_json()
+            if payload.get('input_file_id') not in config.files:
+                self.send_json(404, {'error': {'message': 'input file not found'}})
+                return
+            with config.lock:
+                batch_id = f"batch_fake_{len(config.batches)}"
+                total = len([line for line in config.files[payload['input_file_id']]['content'].splitlines() if line.strip()])
+                batch = config.batches[batch_id] = {
+                    'id': batch_id, 'object': 'batch', 'endpoint': payload.get('endpoint'), 'errors': None,
+                    'input_file_id': payload['input_file_id'], 'completion_window': payload.get('completion_window'),
+                    'status': 'validating', 'output_file_id': None, 'error_file_id': None, 'created_at': int(time.time()),
+                    'request_counts': {'total': total, 'completed': 0, 'failed': 0}, 'metadata': payload.get('metadata'),
+                }
+            threading.Thread(target=run_batch, args=(config, batch), daemon=True).start()
+            self.send_json(200, batch)
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+    def do_GET(self):
+        config = self.server.config
+        parts = self.path.strip('/').split('/')
+        if parts[:2] == ['v1', 'batches'] and len(parts) == 3 and parts[2] in config.batches:
+            self.send_json(200, config.batches[parts[2]])
+        elif parts[:2] == ['v1', 'files'] and len(parts) == 4 and parts[3] == 'content' and parts[2] in config.files:
+            content = config.files[parts[2]]['content']
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            super().do_GET()
+
+    def file_object(self, file_id):
+        return {key: value for key, value in self.server.config.files[file_id].items() if key != 'content'}
+
+    # Function to read a multipart/form-data upload into {field: (filename, bytes)}
+    def read_multipart(self):
+        length = int(self.headers.get('Content-Length', 0))
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('latin-1') + self.rfile.read(length))
+        return {part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True))
+                for part in message.iter_parts()}
+
+
+# Function to start a fake server in a background thread; port 0 picks a free port
+def start_server(handler_class, config, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    server.config = config
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run fake Ollama and OpenAI servers for offline testing.")
+    parser.add_argument('--ollama-port', type=int, default=11434)
+    parser.add_argument('--openai-port', type=int, default=8089)
+    parser.add_argument('--latency', default='lognormal:0.8,0.4')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--ollama-parallel', type=int, default=4)
+    args = parser.parse_args()
+
+    ollama = start_server(FakeOllamaHandler, FakeModelConfig(args.latency, args.error_rate, 500, parallel=args.ollama_parallel),
+                          port=args.ollama_port)
+    openai = start_server(FakeOpenAIHandler, FakeModelConfig(args.latency, args.error_rate, 429), port=args.openai_port)
+    print(f"Ollama: {server_url(ollama)}  OpenAI: {server_url(openai)}/v1  (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -1,46 +1,46 @@
 import os
 import json
+import argparse
 from datetime import datetime, timezone
+from post_metadata import posts_in_window
 
-def is_valid_json_file(filename):
-    return filename.endswith('.json')
+def parse_date(value):
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
 
-def is_post_from_dec_2023_onwards(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-        if 'time' in data:
-            post_time = datetime.fromisoformat(data['time'].replace('Z', '+00:00'))
-            comparison_date = datetime(2023, 12, 1, tzinfo=timezone.utc)
-            return post_time >= comparison_date
-    return False
+def get_posts_in_window(root_directory, since=None, until=None):
+    return [os.path.basename(rel_path) for rel_path, _ in sorted(posts_in_window(root_directory, since, until))]
 
 def get_posts_from_dec_2023_onwards(root_directory):
-    relevant_filenames = []
-   
-    for subdir, _, files in os.walk(root_directory):
-        for file in files:
-            if is_valid_json_file(file):
-                file_path = os.path.join(subdir, file)
-                if is_post_from_dec_2023_onwards(file_path):
-                    relevant_filenames.append(file)
-   
-    return relevant_filenames
-
-def save_results(filenames, output_file):
+    return get_posts_in_window(root_directory, since=datetime(2023, 12, 1, tzinfo=timezone.utc))
+
+def save_results(filenames, output_file, since=None, until=None):
     result = {
         'total_posts_from_dec_2023': len(filenames),
+        'since': since.isoformat() if since else None,
+        'until': until.isoformat() if until else None,
         'filenames': filenames
     }
-   
+
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(result, f, indent=2, ensure_ascii=False)
 
 if __name__ == "__main__":
-    root_directory = r'C:\git\SocialReporter\data'
+    parser = argparse.ArgumentParser(description="Collect the posts published within a date window.")
+    parser.add_argument('--root', default=r'C:\git\SocialReporter\data')
+    parser.add_argument('--since', type=parse_date, default=parse_date('2023-12-01'),
+                        help="first day to include (ISO date, default 2023-12-01)")
+    parser.add_argument('--until', type=parse_date, default=None,
+                        help="first day to exclude (ISO date, default: no upper limit)")
+    args = parser.parse_args()
+
+    root_directory = args.root
     output_file = os.path.join(root_directory, 'relevant_post_filenames.json')
-   
-    relevant_filenames = get_posts_from_dec_2023_onwards(root_directory)
-    save_results(relevant_filenames, output_file)
-   
-    print(f"Analyse abgeschlossen. {len(relevant_filenames)} Dateien für Posts ab Dezember 2023 gefunden.")
-    print(f"Ergebnisse wurden in {output_file} gespeichert.")
\ No newline at end of file
+
+    relevant_filenames = get_posts_in_window(root_directory, args.since, args.until)
+    save_results(relevant_filenames, output_file, args.since, args.until)
+
+    print(f"Analyse abgeschlossen. {len(relevant_filenames)} Dateien für Posts von {args.since.date()} bis {args.until.date() if args.until else 'heute'} gefunden.")
+    print(f"Ergebnisse wurden in {output_file} gespeichert.")
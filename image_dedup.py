@@ -0,0 +1,235 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+# Defaults can be overridden through the environment. "off" scores every picture, even exact copies.
+DEDUP_MODE = os.environ.get("CTA_DEDUP", "on")
+# Distances are in bits of the 64-bit hashes: re-compressions and small crops
+# stay within a few bits, unrelated images differ by about 32.
+PHASH_DISTANCE = int(os.environ.get("CTA_DEDUP_DISTANCE", 6))
+AHASH_DISTANCE = int(os.environ.get("CTA_DEDUP_AHASH_DISTANCE", 10))
+HASH_WORKERS = int(os.environ.get("CTA_DEDUP_WORKERS", 8))
+
+HASH_INDEX_FILENAME = 'image_hash_index.json'
+HASH_INDEX_VERSION = 1
+
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(PHASH_SIZE)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+# Function to compute the average hash: 8x8 grayscale thumbnail, one bit per pixel above the mean
+def average_hash(image):
+    pixels = np.asarray(image.convert('L').resize((HASH_SIZE, HASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    return _bits_to_int(pixels > pixels.mean())
+
+
+# Function to compute the perceptual hash: low frequencies of the 2D DCT of a 32x32 thumbnail,
+# one bit per coefficient above the median (the DC term is left out of the median)
+def perceptual_hash(image):
+    pixels = np.asarray(image.convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE]
+    return _bits_to_int(low > np.median(low.flatten()[1:]))
+
+
+def image_hashes(image_path):
+    with Image.open(image_path) as image:
+        # JPEG files can be decoded at a fraction of their size
+        image.draft('L', (PHASH_SIZE * 4, PHASH_SIZE * 4))
+        image.load()
+        return average_hash(image), perceptual_hash(image)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    # Burkhard-Keller tree over the Hamming distance: a search only visits children whose
+    # edge distance lies within max_distance of the distance to their parent
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (key, value, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (key, value, {})
+                return
+            node = child
+
+    # Function to list (distance, key, value) of all entries within max_distance, closest first
+    def search(self, key, max_distance):
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_key, value, children = stack.pop()
+            distance = hamming(key, node_key)
+            if distance <= max_distance:
+                found.append((distance, node_key, value))
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda entry: entry[0])
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+# Function to load the stored hashes of a data root (or an empty index)
+def load_hash_index(root_directory):
+    try:
+        with open(os.path.join(root_directory, HASH_INDEX_FILENAME), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == HASH_INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version': HASH_INDEX_VERSION, 'images': {}}
+
+
+def save_hash_index(root_directory, index):
+    index_path = os.path.join(root_directory, HASH_INDEX_FILENAME)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+class DedupIndex:
+    # Near-duplicate lookup for the images of one data root. Hashes are kept in
+    # image_hash_index.json keyed by path, mtime and size, so every image is decoded once.
+    def __init__(self, root_directory, phash_distance=PHASH_DISTANCE, ahash_distance=AHASH_DISTANCE):
+        self.root_directory = root_directory
+        self.phash_distance = phash_distance
+        self.ahash_distance = ahash_distance
+        self.index = load_hash_index(root_directory)
+        self.tree = BKTree()
+
+    def _relative(self, image_path):
+        return os.path.relpath(image_path, self.root_directory).replace(os.sep, '/')
+
+    def _cached_hashes(self, image_path):
+        entry = self.index['images'].get(self._relative(image_path))
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        if entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            return None
+        return int(entry['ahash'], 16), int(entry['phash'], 16)
+
+    # Function to return {image_path: (ahash, phash)}, hashing new or changed images in a thread pool
+    def hashes(self, image_paths, workers=HASH_WORKERS):
+        result = {}
+        missing = []
+        for image_path in image_paths:
+            cached = self._cached_hashes(image_path)
+            if cached is None:
+                missing.append(image_path)
+            else:
+                result[image_path] = cached
+
+        def compute(image_path):
+            try:
+                return image_path, image_hashes(image_path), os.stat(image_path)
+            except (OSError, ValueError) as e:
+                print(f"{os.path.basename(image_path)}: Could not hash image - {e}")
+                return image_path, None, None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for image_path, hashes, stat in executor.map(compute, missing):
+                if hashes is None:
+                    continue
+                result[image_path] = hashes
+                self.index['images'][self._relative(image_path)] = {
+                    'mtime': stat.st_mtime, 'size': stat.st_size,
+                    'ahash': format(hashes[0], '016x'), 'phash': format(hashes[1], '016x'),
+                }
+        return result
+
+    def add(self, hashes, value):
+        ahash, phash = hashes
+        self.tree.add(phash, (ahash, value))
+
+    # Function to find the closest known image within the pHash distance whose aHash agrees as well.
+    # Returns (value, phash distance) or None.
+    def find(self, hashes):
+        ahash, phash = hashes
+        for distance, _, (other_ahash, value) in self.tree.search(phash, self.phash_distance):
+            if hamming(ahash, other_ahash) <= self.ahash_distance:
+                return value, distance
+        return None
+
+    def save(self):
+        save_hash_index(self.root_directory, self.index)
+
+
+# Function to split the pending items into the ones to score and near-duplicates of already scored
+# or pending images ({source image path: [(item, distance)]}). path_of returns the image path of an item.
+def find_duplicates(root_directory, scored_paths, pending, path_of=lambda item: item):
+    dedup = DedupIndex(root_directory)
+    hashes = dedup.hashes(list(scored_paths) + [path_of(item) for item in pending])
+    for image_path in scored_paths:
+        if image_path in hashes:
+            dedup.add(hashes[image_path], image_path)
+
+    to_score = []
+    duplicates = {}
+    for item in pending:
+        image_path = path_of(item)
+        match = dedup.find(hashes[image_path]) if image_path in hashes else None
+        if match is None:
+            to_score.append(item)
+            if image_path in hashes:
+                dedup.add(hashes[image_path], image_path)
+        else:
+            source_path, distance = match
+            duplicates.setdefault(source_path, []).append((item, distance))
+    dedup.save()
+    return to_score, duplicates
+
+
+# Function to give a near-duplicate the result of the image it copies, recording where it came from.
+# Returns the score, or None if the source has no usable result (the duplicate is then scored on its own).
+def reuse_score(store, method, model, image_path, source_path, distance):
+    source = store.get(source_path, method)
+    # Error results of older runs are no score
+    if source is None or source['score'] is None or (source['response'] or '').startswith("Error: HTTP"):
+        return None
+    store.put(image_path, method, model, source['score'], source['response'],
+              extra={"reused_from": os.path.relpath(source_path, store.root_directory).replace(os.sep, '/'),
+                     "hash_distance": distance})
+    print(f"{os.path.basename(image_path)}: {source['score']} (near-duplicate of {os.path.basename(source_path)}, distance {distance})")
+    return source['score']
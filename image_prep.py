@@ -0,0 +1,133 @@
+import io
+import os
+import base64
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+# Defaults can be overridden through the environment
+MAX_EDGE = int(os.environ.get("CTA_IMAGE_MAX_EDGE", 1024))
+IMAGE_FORMAT = os.environ.get("CTA_IMAGE_FORMAT", "JPEG").upper()
+QUALITY = int(os.environ.get("CTA_IMAGE_QUALITY", 85))
+PREP_CACHE_DIR = os.environ.get("CTA_IMAGE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cta-cache", "images"))
+PREP_WORKERS = int(os.environ.get("CTA_IMAGE_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+# Describes the preprocessing, so result cache keys change when the settings change
+PREP_SIGNATURE = f"prep:{MAX_EDGE}:{IMAGE_FORMAT}:{QUALITY}"
+MIME_TYPE = MIME_TYPES[IMAGE_FORMAT]
+
+
+def scaled_size(width, height, max_edge=MAX_EDGE):
+    scale = min(1.0, max_edge / float(max(width, height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Function to decode an image, shrink it to max_edge and re-encode it
+def convert_image(source_bytes, max_edge=MAX_EDGE, image_format=IMAGE_FORMAT, quality=QUALITY):
+    with Image.open(io.BytesIO(source_bytes)) as image:
+        image.load()
+        if image_format == "JPEG" and image.mode != "RGB":
+            # JPEG has no alpha channel: put transparent screenshots on white
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True)
+        return output.getvalue()
+
+
+# Function to return the preprocessed bytes of an image, reusing the on-disk copy
+# that was derived from the same source bytes and settings
+def preprocess_image(image_path, max_edge=MAX_EDGE, image_format=IMAGE_FORMAT, quality=QUALITY, cache_dir=PREP_CACHE_DIR):
+    with open(image_path, "rb") as image_file:
+        source_bytes = image_file.read()
+    digest = hashlib.sha256(source_bytes)
+    digest.update(f"{max_edge}:{image_format}:{quality}".encode("utf-8"))
+    key = digest.hexdigest()
+    cached_path = os.path.join(cache_dir, key[:2], key + EXTENSIONS[image_format])
+
+    try:
+        with open(cached_path, "rb") as cached_file:
+            return cached_file.read()
+    except FileNotFoundError:
+        pass
+
+    prepared = convert_image(source_bytes, max_edge, image_format, quality)
+
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as cached_file:
+        cached_file.write(prepared)
+    os.replace(tmp_path, cached_path)
+    return prepared
+
+
+class ImagePreprocessor:
+    # Decodes and resizes images in a process pool while the model is busy with earlier ones
+    def __init__(self, workers=PREP_WORKERS):
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def submit(self, image_path):
+        if self.executor is None:
+            return
+        with self.lock:
+            if image_path not in self.futures:
+                self.futures[image_path] = self.executor.submit(preprocess_image, image_path)
+
+    # Function to pass items through while preprocessing up to `lookahead` items ahead of them.
+    # path_of returns the image path of an item, or a list of paths (e.g. all images of a post).
+    # Items that never reach get() (cache hits, skipped items) would keep their preprocessed bytes,
+    # so the futures of items handed out more than `lookahead` items ago are discarded.
+    def prefetch(self, items, path_of=lambda item: item, lookahead=32):
+        buffer = deque()
+        handed_out = deque()
+        for item in items:
+            paths = path_of(item)
+            paths = [paths] if isinstance(paths, str) else list(paths)
+            for image_path in paths:
+                self.submit(image_path)
+            buffer.append((item, paths))
+            if len(buffer) > lookahead:
+                yield self._hand_out(buffer, handed_out, lookahead)
+        while buffer:
+            yield self._hand_out(buffer, handed_out, lookahead)
+
+    def _hand_out(self, buffer, handed_out, lookahead):
+        item, paths = buffer.popleft()
+        handed_out.append(paths)
+        if len(handed_out) > lookahead:
+            for image_path in handed_out.popleft():
+                self.discard(image_path)
+        return item
+
+    def get(self, image_path):
+        with self.lock:
+            future = self.futures.pop(image_path, None)
+        if future is not None:
+            return future.result()
+        return preprocess_image(image_path)
+
+    # Function to drop the prefetched copy of an image that is not going to be encoded
+    def discard(self, image_path):
+        with self.lock:
+            future = self.futures.pop(image_path, None)
+        if future is not None:
+            future.cancel()
+
+    # Function to return the preprocessed image as a base64 string
+    def encode(self, image_path):
+        return base64.b64encode(self.get(image_path)).decode("utf-8")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,233 @@
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+# Defaults can be overridden through the environment. A path ending in .json gets a JSON
+# snapshot, anything else the Prometheus text format (e.g. for the node_exporter textfile collector).
+METRICS_DIR = os.environ.get("CTA_METRICS_DIR", os.path.join(os.path.expanduser("~"), ".cta-cache", "metrics"))
+METRICS_PATH = os.environ.get("CTA_METRICS_PATH")
+METRICS_INTERVAL = float(os.environ.get("CTA_METRICS_INTERVAL", 30))
+
+# Upper bounds in seconds, from a cache hit to a slow llava answer
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    # Function to estimate a quantile from the buckets (upper bound of the matching bucket)
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    # Stage histograms, event counters and gauges of one script run, labelled by script and model
+    def __init__(self, script, model=None, path=None, interval=METRICS_INTERVAL):
+        self.labels = {'script': script, 'model': model or ''}
+        self.path = path or METRICS_PATH or os.path.join(METRICS_DIR, f"{script}.prom")
+        self.interval = interval
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    # Function to time a block of code as one observation of `stage`
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # Function to pass items through while timing how long it takes to produce each one
+    def timed(self, name, items):
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, event, amount=1):
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_gauge(self, name, amount):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    # Function to count the requests that are currently waiting for the model
+    @contextmanager
+    def in_flight(self, name='in_flight'):
+        self.add_gauge(name, 1)
+        try:
+            yield
+        finally:
+            self.add_gauge(name, -1)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'labels': dict(self.labels),
+                'started': self.started,
+                'updated': time.time(),
+                'stages': {
+                    stage: {
+                        'count': histogram.count,
+                        'sum': histogram.sum,
+                        'p50': histogram.quantile(0.5),
+                        'p95': histogram.quantile(0.95),
+                        'buckets': dict(zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.counts)),
+                    }
+                    for stage, histogram in self.histograms.items()
+                },
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def _label_text(self, **extra):
+        labels = dict(self.labels, **extra)
+        return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, value in labels.items())
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append("# HELP cta_stage_seconds Time spent per processing stage.")
+            lines.append("# TYPE cta_stage_seconds histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f"cta_stage_seconds_bucket{{{self._label_text(stage=stage, le=bound)}}} {cumulative}")
+                lines.append(f"cta_stage_seconds_sum{{{self._label_text(stage=stage)}}} {histogram.sum}")
+                lines.append(f"cta_stage_seconds_count{{{self._label_text(stage=stage)}}} {histogram.count}")
+            lines.append("# HELP cta_events_total Files and requests by outcome.")
+            lines.append("# TYPE cta_events_total counter")
+            for event, value in sorted(self.counters.items()):
+                lines.append(f"cta_events_total{{{self._label_text(event=event)}}} {value}")
+            lines.append("# HELP cta_gauge Current value of a run gauge (e.g. requests in flight).")
+            lines.append("# TYPE cta_gauge gauge")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"cta_gauge{{{self._label_text(name=name)}}} {value}")
+            lines.append("# TYPE cta_run_started_seconds gauge")
+            lines.append(f"cta_run_started_seconds{{{self._label_text()}}} {self.started}")
+        return '\n'.join(lines) + '\n'
+
+    # Function to write the current snapshot atomically, so collectors never see half a file
+    def write(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.path.endswith('.json'):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.to_prometheus()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+    def _write_periodically(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Could not write metrics to {self.path}: {e}")
+
+    # Function to write snapshots every `interval` seconds and once more at exit
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write_periodically, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        try:
+            self.write()
+        except OSError as e:
+            print(f"Could not write metrics to {self.path}: {e}")
+
+    # Function to print where the time went, one line per stage
+    def print_summary(self):
+        snapshot = self.snapshot()
+        for stage, values in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['sum']):
+            mean = values['sum'] / values['count'] if values['count'] else 0.0
+            print(f"  {stage:10} {values['count']:7d} x  mean {mean:8.3f}s  total {values['sum']:10.1f}s")
+        if snapshot['counters']:
+            print("  " + ", ".join(f"{event}: {value}" for event, value in sorted(snapshot['counters'].items())))
+
+
+# Metrics of this process by model; the first one writes to the script's snapshot path
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+# Function to return the metrics of a model. Without a model (e.g. from adaptive_limit.py) the
+# metrics of the script's own model are returned. Another model in the same process gets metrics
+# of its own, written next to the first snapshot with the model in the file name.
+def get_metrics(model=None):
+    with _registry_lock:
+        if model is None and _registry:
+            return next(iter(_registry.values()))
+        if model in _registry:
+            return _registry[model]
+        if None in _registry and len(_registry) == 1:
+            # Created by a shared module before the script asked for its model
+            metrics = _registry.pop(None)
+            metrics.labels['model'] = model
+            _registry[model] = metrics
+            return metrics
+        script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+        path = METRICS_PATH or os.path.join(METRICS_DIR, f"{script}.prom")
+        if _registry:
+            base, extension = os.path.splitext(path)
+            path = f"{base}-{re.sub(r'[^A-Za-z0-9_.-]', '_', model)}{extension}"
+        metrics = _registry[model] = Metrics(script, model, path)
+        return metrics
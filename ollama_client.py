@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from scoring_engine import run_concurrently
+from adaptive_limit import AdaptiveLimit, max_limit
+
+# Defaults can be overridden through the environment
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+# Several servers as "http://gpu1:11434=4,http://gpu2:11434=2" (URL=parallel requests)
+OLLAMA_ENDPOINTS = os.environ.get("OLLAMA_ENDPOINTS", "")
+# Should match OLLAMA_NUM_PARALLEL of the server, more in-flight requests only queue up there
+NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# How long the server keeps the model loaded after the last request
+KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Seconds to wait for a connection and for a complete response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", 600))
+# "on" streams the answer and stops the generation as soon as the score is complete,
+# the reasoning is only generated for the audit sample
+SCORE_ONLY = os.environ.get("CTA_SCORE_ONLY", "off")
+# Share of the items that keep the full reasoning in score-only mode
+AUDIT_RATE = float(os.environ.get("CTA_AUDIT_RATE", 0.05))
+# Tokens generated at most in score-only mode, in case the score never shows up
+SCORE_NUM_PREDICT = int(os.environ.get("CTA_SCORE_NUM_PREDICT", 32))
+# Part of the result cache key in score-only mode, so answers cut off after the score are
+# never served to a run that wants the full reasoning
+ANSWER_SIGNATURE = "\nscore-only" if SCORE_ONLY == 'on' else ""
+
+# A score is complete once something other than a digit or a dot follows it
+SCORE_PATTERN = re.compile(r'Score:\s*(\d+(?:\.\d+)?)(?=[^\d.])')
+
+
+# Function to pick the audit sample. With a key (e.g. the cache key) the choice is stable
+# across runs, so an item is either always audited or never.
+def in_audit_sample(key=None, rate=None):
+    rate = AUDIT_RATE if rate is None else rate
+    if key is None:
+        return random.random() < rate
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < rate
+
+
+class StreamedResponse:
+    # The parts of a requests.Response the scripts use, for an answer that was streamed
+    # (possibly cut off right after the score)
+    def __init__(self, status_code, text, cancelled):
+        self.status_code = status_code
+        self.text = text
+        self.cancelled = cancelled
+
+    def json(self):
+        return {'response': self.text, 'done': True, 'cancelled': self.cancelled}
+
+
+# Function to tell whether an answer shows the server is overloaded (timeouts and connection
+# errors are raised and count as overloaded as well)
+def server_coped(response):
+    return response.status_code != 429 and response.status_code < 500
+
+
+class OllamaClient:
+    def __init__(self, base_url=OLLAMA_URL, num_parallel=NUM_PARALLEL, keep_alive=KEEP_ALIVE, condition=None):
+        self.base_url = base_url.rstrip('/')
+        self.num_parallel = num_parallel
+        # Workers and connections for the highest in-flight limit the controller may reach
+        self.max_parallel = max_limit(num_parallel)
+        self.keep_alive = keep_alive
+        # In-flight limits per model, see adaptive_limit.py
+        self.condition = condition or threading.Condition()
+        self.limits = {}
+        # One pooled keep-alive connection per worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_parallel)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def limit_for(self, model):
+        with self.condition:
+            if model not in self.limits:
+                self.limits[model] = AdaptiveLimit(f"{model}@{self.base_url}", self.num_parallel, self.max_parallel, self.condition)
+            return self.limits[model]
+
+    # Function to send a request within the in-flight limit of the model and report how it went.
+    # `kind` separates requests with different answer lengths in the latency signal.
+    def limited(self, model, request, limit=None, kind="full"):
+        if limit is None:
+            limit = self.limit_for(model)
+            limit.acquire()
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = request()
+            ok = server_coped(response)
+            return response
+        finally:
+            limit.release(time.perf_counter() - start, ok, kind)
+
+    # Function to send one /api/generate request and return the HTTP response
+    def generate(self, model, prompt, images=None, limit=None, kind="full", **options):
+        return self.limited(model, lambda: self._post_generate(model, prompt, images, **options), limit, kind)
+
+    def _post_generate(self, model, prompt, images=None, **options):
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": self.keep_alive,
+        }
+        if images:
+            payload["images"] = images
+        payload.update(options)
+        return self.session.post(
+            f"{self.base_url}/api/generate",
+            json=payload,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+
+    # Function to stream an answer and close the connection once the score is complete,
+    # which makes Ollama stop generating. num_predict caps the tokens in case it never is.
+    def generate_score(self, model, prompt, images=None, num_predict=SCORE_NUM_PREDICT, limit=None, **options):
+        return self.limited(model, lambda: self._stream_score(model, prompt, images, num_predict, **options), limit, "score")
+
+    def _stream_score(self, model, prompt, images=None, num_predict=SCORE_NUM_PREDICT, **options):
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            "keep_alive": self.keep_alive,
+            "options": {"num_predict": num_predict},
+        }
+        if images:
+            payload["images"] = images
+        payload.update(options)
+        response = self.session.post(
+            f"{self.base_url}/api/generate",
+            json=payload,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            stream=True,
+        )
+        if response.status_code != 200:
+            return response
+
+        text = ""
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    return StreamedResponse(500, json.dumps(chunk), False)
+                text += chunk.get('response', '')
+                if chunk.get('done'):
+                    break
+                if SCORE_PATTERN.search(text):
+                    return StreamedResponse(200, text, True)
+        finally:
+            response.close()
+        return StreamedResponse(200, text, False)
+
+    # Function to ask for a score: score-only outside the audit sample, the full answer otherwise
+    def score(self, model, prompt, images=None, sample_key=None, limit=None, **options):
+        if SCORE_ONLY == 'on' and not in_audit_sample(sample_key):
+            return self.generate_score(model, prompt, images, limit=limit, **options)
+        return self.generate(model, prompt, images, limit=limit, **options)
+
+    # Function to load the model before the first real request (an empty prompt only loads it)
+    def preload(self, model):
+        try:
+            self.session.post(
+                f"{self.base_url}/api/generate",
+                json={"model": model, "keep_alive": self.keep_alive},
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+        except requests.RequestException as e:
+            print(f"Could not preload {model}: {e}")
+
+    # Function to process items with a worker for every request the in-flight limit may allow
+    # (or `workers` workers); the limit holds back the ones beyond it
+    def map(self, items, worker, workers=None):
+        return run_concurrently(items, worker, workers or self.max_parallel)
+
+
+# Function to parse endpoint specs like "http://gpu1:11434=4" into (url, parallel requests)
+def parse_endpoints(specs):
+    endpoints = []
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        url, separator, parallel = spec.rpartition('=')
+        if separator and parallel.isdigit():
+            endpoints.append((url, int(parallel)))
+        else:
+            endpoints.append((spec, NUM_PARALLEL))
+    return endpoints
+
+
+class EndpointPool:
+    # Same interface as OllamaClient, spread over several servers. Every request goes to
+    # the server with the most free slots under its in-flight limit for the model.
+    def __init__(self, endpoints, keep_alive=KEEP_ALIVE):
+        self.condition = threading.Condition()
+        self.clients = [OllamaClient(url, parallel, keep_alive, self.condition) for url, parallel in endpoints]
+        self.num_parallel = sum(client.num_parallel for client in self.clients)
+        self.max_parallel = sum(client.max_parallel for client in self.clients)
+
+    def _acquire(self, model):
+        limits = [client.limit_for(model) for client in self.clients]
+        with self.condition:
+            while max(limit.free() for limit in limits) <= 0:
+                self.condition.wait()
+            index = max(range(len(limits)), key=lambda i: limits[i].free())
+            limits[index].take()
+            return self.clients[index], limits[index]
+
+    def generate(self, model, prompt, images=None, **options):
+        client, limit = self._acquire(model)
+        return client.generate(model, prompt, images, limit=limit, **options)
+
+    def score(self, model, prompt, images=None, sample_key=None, **options):
+        client, limit = self._acquire(model)
+        return client.score(model, prompt, images, sample_key, limit=limit, **options)
+
+    def preload(self, model):
+        for client in self.clients:
+            client.preload(model)
+
+    def map(self, items, worker, workers=None):
+        return run_concurrently(items, worker, workers or self.max_parallel)
+
+
+# Function to build a client for one or several endpoint specs (see parse_endpoints)
+def client_for(specs):
+    endpoints = parse_endpoints(specs)
+    if len(endpoints) == 1:
+        return OllamaClient(*endpoints[0])
+    return EndpointPool(endpoints)
+
+
+_default_client = None
+
+
+def get_client():
+    global _default_client
+    if _default_client is None:
+        _default_client = client_for(OLLAMA_ENDPOINTS.split(',')) if OLLAMA_ENDPOINTS else OllamaClient()
+    return _default_client
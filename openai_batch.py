@@ -0,0 +1,195 @@
+import os
+import json
+import time
+
+# "on" makes cta-img-api.py and cta-text-api.py go through the Batch API instead of one
+# chat request per file. Every run ingests finished batches and submits the inputs still missing.
+BATCH_MODE = os.environ.get("CTA_OPENAI_BATCH", "off")
+BATCH_DIRNAME = 'openai_batches'
+MANIFEST_FILENAME = 'manifest.json'
+# Limits of one batch input file (the API allows 50,000 requests and 200 MB)
+BATCH_MAX_REQUESTS = int(os.environ.get("CTA_BATCH_MAX_REQUESTS", 50000))
+BATCH_MAX_BYTES = int(os.environ.get("CTA_BATCH_MAX_BYTES", 190 * 1024 * 1024))
+BATCH_ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+
+# Batch states after which nothing changes on the server anymore
+FINAL_STATES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+# Function to build the custom ID of a request: method and path relative to the data root,
+# so the same input always gets the same ID and results map back without a lookup table
+def custom_id(root_directory, method, input_path):
+    return f"{method}:{os.path.relpath(input_path, root_directory).replace(os.sep, '/')}"
+
+
+def input_path_of(root_directory, request_id):
+    _, _, relative_path = request_id.partition(':')
+    return os.path.join(root_directory, *relative_path.split('/'))
+
+
+class BatchTracker:
+    # Keeps the batch files of a data root in openai_batches/ and a manifest with one entry
+    # per input file: its requests, the batch job and whether the results were ingested
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+        self.directory = os.path.join(root_directory, BATCH_DIRNAME)
+        self.manifest_path = os.path.join(self.directory, MANIFEST_FILENAME)
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.batches = json.load(f)['batches']
+        except (OSError, ValueError, KeyError):
+            self.batches = []
+
+    def save(self):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'batches': self.batches}, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    # Function to list the custom IDs of one method whose results are still to come
+    def open_ids(self, method):
+        ids = set()
+        for batch in self.batches:
+            if batch['method'] == method and not batch.get('ingested'):
+                ids.update(batch['custom_ids'])
+        return ids
+
+    # Function to write requests ((input path, request body) pairs) into as many JSONL files
+    # as the batch limits need. Returns the manifest entries of the new files.
+    def write(self, method, requests):
+        created = []
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        batch_file = None
+        for input_path, body in requests:
+            request_id = custom_id(self.root_directory, method, input_path)
+            line = json.dumps({'custom_id': request_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body},
+                              ensure_ascii=False).encode('utf-8') + b'\n'
+            if batch_file is None or len(entry['custom_ids']) >= BATCH_MAX_REQUESTS or entry['bytes'] + len(line) > BATCH_MAX_BYTES:
+                if batch_file is not None:
+                    batch_file.close()
+                filename = f"{method}-{stamp}-{len(self.batches) + len(created)}.jsonl"
+                entry = {'method': method, 'file': filename, 'custom_ids': [], 'bytes': 0, 'status': 'created'}
+                created.append(entry)
+                batch_file = open(os.path.join(self.directory, filename), 'wb')
+            batch_file.write(line)
+            entry['custom_ids'].append(request_id)
+            entry['bytes'] += len(line)
+        if batch_file is not None:
+            batch_file.close()
+        self.batches.extend(created)
+        self.save()
+        return created
+
+    # Function to upload a batch file and start the batch job
+    def submit(self, client, entry):
+        with open(os.path.join(self.directory, entry['file']), 'rb') as f:
+            uploaded = client.files.create(file=f, purpose='batch')
+        batch = client.batches.create(input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT, completion_window=COMPLETION_WINDOW,
+                                      metadata={'method': entry['method'], 'file': entry['file']})
+        entry.update({'input_file_id': uploaded.id, 'batch_id': batch.id, 'status': batch.status,
+                      'submitted_at': time.time()})
+        self.save()
+        print(f"Submitted {entry['file']} ({len(entry['custom_ids'])} requests) as {batch.id}")
+
+    # Function to poll the open batch jobs and download the output and error files of finished ones
+    def refresh(self, client):
+        for entry in self.batches:
+            if entry.get('ingested'):
+                continue
+            if 'batch_id' not in entry:
+                # The upload of an earlier run failed, try again
+                self.submit(client, entry)
+                continue
+            if entry['status'] in FINAL_STATES and 'output' in entry:
+                continue
+            batch = client.batches.retrieve(entry['batch_id'])
+            entry['status'] = batch.status
+            counts = batch.request_counts
+            if counts is not None:
+                entry['request_counts'] = {'total': counts.total, 'completed': counts.completed, 'failed': counts.failed}
+            if batch.status in FINAL_STATES:
+                base = os.path.splitext(entry['file'])[0]
+                entry['output'] = self._download(client, batch.output_file_id, f"{base}.output.jsonl")
+                entry['errors'] = self._download(client, batch.error_file_id, f"{base}.errors.jsonl")
+        self.save()
+
+    def _download(self, client, file_id, filename):
+        if not file_id:
+            return None
+        content = client.files.content(file_id).content
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            f.write(content)
+        return filename
+
+    # Function to store the results of finished batches. parse_score turns a response text into a
+    # score (None if there is none). Failed requests are not stored, so the next run submits them again.
+    def ingest(self, store, method, model, parse_score, extra=None):
+        stored = 0
+        failed = 0
+        for entry in self.batches:
+            if entry['method'] != method or entry.get('ingested') or entry['status'] not in FINAL_STATES:
+                continue
+            for filename in (entry.get('output'), entry.get('errors')):
+                if not filename:
+                    continue
+                with open(os.path.join(self.directory, filename), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        result = json.loads(line)
+                        input_path = input_path_of(self.root_directory, result['custom_id'])
+                        response = result.get('response') or {}
+                        if result.get('error') or response.get('status_code') != 200:
+                            failed += 1
+                            error = result.get('error') or response.get('body', {}).get('error')
+                            print(f"{os.path.basename(input_path)}: Batch request failed - {error}")
+                            continue
+                        response_text = response['body']['choices'][0]['message']['content'].strip()
+                        score = parse_score(response_text)
+                        if score is None:
+                            print(f"{os.path.basename(input_path)}: No score found in the response")
+                            score = 0.0
+                        store.put(input_path, method, model, score, response_text,
+                                  extra=dict(extra or {}, batch_id=entry['batch_id']))
+                        stored += 1
+            entry['ingested'] = True
+        self.save()
+        return stored, failed
+
+    def print_status(self, method=None):
+        for entry in self.batches:
+            if method is not None and entry['method'] != method:
+                continue
+            counts = entry.get('request_counts') or {}
+            state = 'ingested' if entry.get('ingested') else entry['status']
+            print(f"{entry['file']}: {entry.get('batch_id', '-')} {state} "
+                  f"({counts.get('completed', 0)}/{len(entry['custom_ids'])} completed, {counts.get('failed', 0)} failed)")
+
+
+# Function to run one step of batch mode for a scoring script: ingest what finished, then submit
+# requests for the items that are neither scored nor in an open batch. build_request turns an
+# item into (input path, request body) or None if it needs no request.
+def run_batches(client, store, method, model, items, path_of, build_request, parse_score, extra=None):
+    tracker = BatchTracker(store.root_directory)
+    tracker.refresh(client)
+    stored, failed = tracker.ingest(store, method, model, parse_score, extra)
+    if stored or failed:
+        print(f"Ingested {stored} results ({failed} failed requests will be submitted again)")
+
+    open_ids = tracker.open_ids(method)
+    pending = (item for item in items if custom_id(store.root_directory, method, path_of(item)) not in open_ids)
+    requests = (request for request in map(build_request, pending) if request is not None)
+    for entry in tracker.write(method, requests):
+        tracker.submit(client, entry)
+    tracker.print_status(method)
+    return tracker
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python openai_batch.py <root_directory> [method]")
+        sys.exit(1)
+    BatchTracker(sys.argv[1]).print_status(sys.argv[2] if len(sys.argv) > 2 else None)
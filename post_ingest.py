@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import codecs
+import atexit
+import threading
+
+# orjson is optional, it parses large post files several times faster
+try:
+    import orjson
+
+    def loads(raw):
+        return orjson.loads(raw)
+except ImportError:
+    def loads(raw):
+        return json.loads(raw)
+
+# chardet is only needed for the few files that are not UTF-8
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
+# Encodings detected for files that are not UTF-8, keyed by path (with mtime and size)
+ENCODING_CACHE_PATH = os.environ.get("CTA_ENCODING_CACHE", os.path.join(os.path.expanduser("~"), ".cta-cache", "post_encodings.json"))
+# Bytes handed to chardet at most; taken around the non-ASCII bytes, the JSON syntax says nothing about the charset
+DETECT_SAMPLE_BYTES = int(os.environ.get("CTA_DETECT_SAMPLE_BYTES", 64 * 1024))
+DETECT_WINDOW = 512
+# Tried in order when chardet is missing or its guess does not decode the file
+FALLBACK_ENCODINGS = ('cp1252', 'latin-1')
+
+NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+
+# Function to cut the sample chardet looks at: windows around the non-ASCII bytes, which are
+# the only ones that tell the encodings apart
+def detection_sample(raw, size=DETECT_SAMPLE_BYTES):
+    if len(raw) <= size:
+        return raw
+    chunks = []
+    total = 0
+    end = 0
+    for match in NON_ASCII.finditer(raw):
+        if match.start() < end:
+            continue
+        start = max(end, match.start() - DETECT_WINDOW // 8)
+        end = start + DETECT_WINDOW
+        chunks.append(raw[start:end])
+        total += end - start
+        if total >= size:
+            break
+    return b' '.join(chunks) or raw[:size]
+
+
+def detect_encoding(raw):
+    candidates = []
+    if chardet is not None:
+        detected = chardet.detect(detection_sample(raw))['encoding']
+        if detected:
+            candidates.append(detected)
+    for encoding in candidates + list(FALLBACK_ENCODINGS):
+        try:
+            raw.decode(encoding)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return 'latin-1'
+
+
+class EncodingCache:
+    # Remembers the encoding of every file that is not UTF-8, so it is detected only once.
+    # An entry is used only while the file keeps its mtime and size.
+    def __init__(self, path=ENCODING_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        atexit.register(self.save)
+
+    def get(self, file_path, stat):
+        entry = self.entries.get(os.path.abspath(file_path))
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            return None
+        return entry['encoding']
+
+    def put(self, file_path, stat, encoding):
+        with self.lock:
+            self.entries[os.path.abspath(file_path)] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'encoding': encoding}
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+
+
+_encoding_cache = None
+_encoding_cache_lock = threading.Lock()
+
+
+def get_encoding_cache():
+    global _encoding_cache
+    with _encoding_cache_lock:
+        if _encoding_cache is None:
+            _encoding_cache = EncodingCache()
+        return _encoding_cache
+
+
+# Function to parse the raw bytes of a JSON file. UTF-8 is tried first and costs nothing extra;
+# only files that are not valid UTF-8 go through charset detection. Returns (data, encoding).
+def parse_json(raw, file_path=None, stat=None):
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+    encoding = None
+    if file_path is not None and stat is not None:
+        encoding = get_encoding_cache().get(file_path, stat)
+    if encoding is None:
+        try:
+            return loads(raw), 'utf-8'
+        except ValueError:
+            try:
+                raw.decode('utf-8')
+            except UnicodeDecodeError:
+                encoding = detect_encoding(raw)
+            else:
+                # Valid UTF-8, so the JSON itself is broken
+                raise
+        if file_path is not None and stat is not None:
+            get_encoding_cache().put(file_path, stat, encoding)
+    return loads(raw.decode(encoding)), encoding
+
+
+def read_json(file_path):
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        raw = f.read()
+    return parse_json(raw, file_path, stat)[0]
+
+
+# Function to find the caption of a post; some exports keep it in a nested object
+def find_caption(data):
+    caption = data.get('caption')
+    if not caption:
+        for value in data.values():
+            if isinstance(value, dict) and 'caption' in value:
+                return value['caption']
+    return caption
+
+
+# Function to reduce a parsed post to the fields the scripts use. Returns None for files
+# that are not a post object (e.g. lists).
+def make_record(data):
+    if not isinstance(data, dict):
+        return None
+    comments = data.get('comments', 0)
+    return {
+        'text': data.get('text') or '',
+        'caption': find_caption(data) or '',
+        'time': data.get('time'),
+        'likes': data.get('likes'),
+        'comments': len(comments) if isinstance(comments, list) else comments,
+        'follower_count': data.get('follower_count'),
+    }
+
+
+# Function to read one post JSON into its compact record. Raises OSError and ValueError like
+# open() and json.load() do.
+def read_post_record(file_path):
+    return make_record(read_json(file_path))
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python post_ingest.py <post.json> [...]")
+        sys.exit(1)
+    for file_path in sys.argv[1:]:
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data, encoding = parse_json(f.read(), file_path, stat)
+        record = make_record(data)
+        print(f"{os.path.basename(file_path)}: {encoding}, " + (json.dumps(record, ensure_ascii=False) if record else "not a post object"))
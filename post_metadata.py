@@ -0,0 +1,106 @@
+import os
+import json
+from datetime import datetime, timezone
+from artifact_index import update_index, is_post_json
+from post_ingest import parse_json, make_record
+
+MANIFEST_FILENAME = 'post_metadata_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def parse_time(value):
+    if not value:
+        return None
+    try:
+        post_time = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if post_time.tzinfo is None:
+        post_time = post_time.replace(tzinfo=timezone.utc)
+    return post_time
+
+
+# Function to extract the small fields of a post. Files without a "time" key
+# are recognised from the raw bytes and never parsed.
+def extract_metadata(file_path):
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        raw = f.read()
+    if b'"time"' not in raw:
+        return {'time': None}
+    record = make_record(parse_json(raw, file_path, stat)[0])
+    if record is None:
+        return {'time': None}
+    return {key: record[key] for key in ('time', 'likes', 'comments', 'follower_count')}
+
+
+def load_manifest(root_directory):
+    try:
+        with open(os.path.join(root_directory, MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'posts': {}}
+
+
+def save_manifest(root_directory, manifest):
+    manifest_path = os.path.join(root_directory, MANIFEST_FILENAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+
+# Function to bring the metadata manifest up to date. Only post files whose
+# mtime or size changed since the last run are read again.
+def scan_posts(root_directory):
+    manifest = load_manifest(root_directory)
+    old_posts = manifest['posts']
+    new_posts = {}
+    parsed = 0
+
+    artifact_index = update_index(root_directory)
+    for file_path in artifact_index.iter_files():
+        filename = os.path.basename(file_path)
+        if not is_post_json(filename) or filename == MANIFEST_FILENAME:
+            continue
+        rel_path = os.path.relpath(file_path, root_directory)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+
+        entry = old_posts.get(rel_path)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            try:
+                metadata = extract_metadata(file_path)
+            except (OSError, ValueError) as e:
+                print(f"{filename}: Error reading JSON - {e}")
+                metadata = {'time': None}
+            entry = dict(metadata, mtime=stat.st_mtime, size=stat.st_size)
+            parsed += 1
+        new_posts[rel_path] = entry
+
+    manifest['posts'] = new_posts
+    save_manifest(root_directory, manifest)
+    print(f"Post metadata: {len(new_posts)} files, {parsed} read since the last run.")
+    return new_posts
+
+
+def in_window(post_time, since=None, until=None):
+    if post_time is None:
+        return False
+    if since is not None and post_time < since:
+        return False
+    if until is not None and post_time >= until:
+        return False
+    return True
+
+
+# Function to list (relative path, metadata) of all posts within [since, until)
+def posts_in_window(root_directory, since=None, until=None):
+    for rel_path, entry in scan_posts(root_directory).items():
+        if in_window(parse_time(entry.get('time')), since, until):
+            yield rel_path, entry
@@ -0,0 +1,121 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Defaults can be overridden through the environment
+CACHE_PATH = os.environ.get("CTA_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cta-cache", "results.sqlite"))
+CACHE_MAX_BYTES = int(os.environ.get("CTA_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# Rough per-row overhead added to the stored response size
+ROW_OVERHEAD = 128
+
+
+# Function to build the cache key from the model, the prompt template and the input bytes.
+# A different prompt or model gives a different key, so old entries are simply not found.
+def make_key(model, prompt_template, data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt_template.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+def file_key(model, prompt_template, file_path):
+    with open(file_path, "rb") as f:
+        return make_key(model, prompt_template, f.read())
+
+
+class ResultCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " score REAL,"
+            " response TEXT,"
+            " size INTEGER,"
+            " created REAL,"
+            " last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        # Size of all entries, updated in the same transaction as every write, so several
+        # processes sharing the cache evict from the same total
+        self.conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO totals (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM results")
+        self.hits = 0
+        self.misses = 0
+
+    # Function to return (score, response) for a key, or None if it is not cached
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT score, response FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key, score, response):
+        size = len(response.encode("utf-8")) + ROW_OVERHEAD
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self.conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO results (key, score, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, score, response, size, now, now),
+                )
+                self.conn.execute("UPDATE totals SET bytes = bytes + ? WHERE id = 0", (size - (old[0] if old else 0),))
+                total_bytes = self.conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+                if total_bytes > self.max_bytes:
+                    self._evict(total_bytes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # Function to drop the least recently used entries until the cache is at 90% of its size limit
+    # (call inside the write transaction)
+    def _evict(self, total_bytes):
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM results ORDER BY last_used").fetchall()
+        evicted = []
+        freed = 0
+        for key, size in rows:
+            if total_bytes - freed <= target:
+                break
+            evicted.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+        self.conn.execute("UPDATE totals SET bytes = bytes - ? WHERE id = 0", (freed,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
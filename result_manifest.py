@@ -0,0 +1,144 @@
+import os
+import json
+from artifact_index import update_index
+from results_store import METHODS, RESULTS_BACKEND, SqliteStore, parse_sidecar
+
+MANIFEST_FILENAME = 'cta_result_manifest.json'
+MANIFEST_VERSION = 1
+
+
+# Function to load a previously saved manifest (or an empty one)
+def load_manifest(root_directory):
+    manifest_path = os.path.join(root_directory, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'methods': {}}
+
+
+def save_manifest(root_directory, manifest):
+    manifest_path = os.path.join(root_directory, MANIFEST_FILENAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+
+# Function to bring the sidecar results of one method up to date. Directories whose mtime is the
+# one stored in the manifest are taken as they are (the store and export_sidecars replace sidecars
+# atomically, which changes the directory); in the others only files with a new mtime are read again.
+# A sidecar rewritten in place by another tool does not change its directory and is only seen
+# once something else in that directory changes (or after deleting cta_result_manifest.json).
+def refresh_sidecars(root_directory, method, entry, artifact_index):
+    suffix = METHODS[method]['suffix']
+    old_dirs = entry.get('dirs', {})
+    new_dirs = {}
+    read = 0
+
+    for rel_dir, dir_entry in artifact_index.index['dirs'].items():
+        old = old_dirs.get(rel_dir)
+        if old is not None and old['mtime'] == dir_entry['mtime']:
+            new_dirs[rel_dir] = old
+            continue
+        names = [filename for filename in dir_entry['files'] if filename.endswith(suffix)]
+        if not names:
+            continue
+
+        old_files = old['files'] if old is not None else {}
+        files = {}
+        for filename in names:
+            path = os.path.join(root_directory, rel_dir, filename)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            previous = old_files.get(filename)
+            if previous is not None and previous[0] == mtime:
+                files[filename] = previous
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    result = parse_sidecar(method, path, json.load(f))
+            except FileNotFoundError:
+                continue
+            except ValueError:
+                print(f"{filename}: Invalid JSON, ignoring it")
+                continue
+            # mtime, input filename, score
+            files[filename] = [mtime, os.path.basename(result['input_path']), result['score']]
+            read += 1
+        new_dirs[rel_dir] = {'mtime': dir_entry['mtime'], 'files': files}
+
+    entry['dirs'] = new_dirs
+    scores = {
+        os.path.join(root_directory, rel_dir, input_filename): score
+        for rel_dir, dir_entry in new_dirs.items()
+        for _, input_filename, score in dir_entry['files'].values()
+    }
+    return scores, read
+
+
+# Function to bring the SQLite results of one method up to date: only rows from the highest rowid
+# of the last run on are read (that row is read again, as a replaced row can take its rowid)
+def refresh_sqlite(root_directory, method, entry):
+    results = entry.setdefault('results', {})
+    since = entry.get('rowid', 0)
+    read = 0
+    store = SqliteStore(root_directory)
+    try:
+        for result, rowid in store.iter_results_since(method, since):
+            results[os.path.relpath(result['input_path'], root_directory)] = result['score']
+            entry['rowid'] = max(entry.get('rowid', 0), rowid)
+            read += 1
+    finally:
+        store.close()
+    scores = {os.path.join(root_directory, rel_path): score for rel_path, score in results.items()}
+    return scores, read
+
+
+class ResultSet:
+    # Scores of one method by input path, and how many result files/rows had to be read for it
+    def __init__(self, method, scores, read):
+        self.method = method
+        self.scores = scores
+        self.read = read
+
+    def __len__(self):
+        return len(self.scores)
+
+    def analyzed(self, input_path):
+        return input_path in self.scores
+
+
+# Function to return all results of one method, reading only what changed since the last run.
+# The manifest is saved in the data root next to the artifact index.
+def update_results(root_directory, method, artifact_index=None, backend=None):
+    backend = backend or RESULTS_BACKEND
+    manifest = load_manifest(root_directory)
+    entry = manifest['methods'].get(method)
+    if entry is None or entry.get('backend') != backend:
+        entry = {'backend': backend}
+    if backend == 'sqlite':
+        scores, read = refresh_sqlite(root_directory, method, entry)
+    else:
+        if artifact_index is None:
+            artifact_index = update_index(root_directory)
+        scores, read = refresh_sidecars(root_directory, method, entry, artifact_index)
+    manifest['methods'][method] = entry
+    save_manifest(root_directory, manifest)
+    return ResultSet(method, scores, read)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python result_manifest.py <root_directory> [method ...]")
+        sys.exit(1)
+    root_directory = sys.argv[1]
+    for method in sys.argv[2:] or list(METHODS):
+        results = update_results(root_directory, method)
+        print(f"{method}: {len(results)} results ({results.read} read since the last run)")
@@ -0,0 +1,133 @@
+import os
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+# "on" lets the scoring scripts hand results to a writer thread instead of writing them
+# on the thread that sends the next model request
+WRITE_BEHIND = os.environ.get("CTA_WRITE_BEHIND", "on")
+# Results waiting to be written at most; put() blocks when the writer falls this far behind
+WRITE_QUEUE_SIZE = int(os.environ.get("CTA_WRITE_QUEUE_SIZE", 256))
+# Results written in one go (one transaction with the SQLite store)
+WRITE_BATCH_SIZE = int(os.environ.get("CTA_WRITE_BATCH_SIZE", 64))
+
+_STOP = object()
+
+
+class WriteBehindStore:
+    # Wraps a results store: put() queues the result and returns, a writer thread writes the
+    # queue in batches. Reads see queued results too, so nothing is scored twice. The queue is
+    # drained on close(), at exit and after Ctrl+C (once the running workers have finished).
+    def __init__(self, store, max_pending=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE):
+        self.store = store
+        self.root_directory = store.root_directory
+        self.batch_size = batch_size
+        self.queue = queue.Queue(max_pending)
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Signals the puts that are still on their way into the queue when close() starts
+        self.idle = threading.Condition(self.lock)
+        self.putting = 0
+        self.closed = False
+        self.errors = 0
+        self.thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            results = batch[:-1] if stop else batch
+            if results:
+                self._write(results)
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def _write(self, results):
+        try:
+            self.store.put_many(results)
+        except Exception as e:
+            # Write them one by one, so one bad result does not lose the others
+            print(f"Writing {len(results)} results failed, retrying one by one - {e}")
+            for result in results:
+                try:
+                    self.store.put_many([result])
+                except Exception as e:
+                    self.errors += 1
+                    print(f"{os.path.basename(result[0])}: Could not write the result - {e}")
+        with self.lock:
+            for result in results:
+                key = (result[0], result[1])
+                if self.pending.get(key) is result:
+                    del self.pending[key]
+
+    def put(self, input_path, method, model, score, response, latency=None, extra=None, analyzed_at=None):
+        result = (input_path, method, model, score, response, latency, extra, analyzed_at or datetime.now().isoformat())
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                self.pending[(input_path, method)] = result
+                self.putting += 1
+        if closed:
+            # A worker that finished after close() writes its result itself
+            self.store.put_many([result])
+            return
+        try:
+            self.queue.put(result)
+        finally:
+            with self.idle:
+                self.putting -= 1
+                self.idle.notify_all()
+
+    def _queued(self, input_path, method, model):
+        with self.lock:
+            result = self.pending.get((input_path, method))
+        if result is None or (model is not None and (result[2] or '') != model):
+            return None
+        return result
+
+    def exists(self, input_path, method, model=None):
+        return self._queued(input_path, method, model) is not None or self.store.exists(input_path, method, model)
+
+    def get(self, input_path, method, model=None):
+        result = self._queued(input_path, method, model)
+        if result is None:
+            return self.store.get(input_path, method, model)
+        input_path, method, model, score, response, latency, extra, analyzed_at = result
+        return {'input_path': input_path, 'method': method, 'model': model, 'score': score, 'response': response,
+                'analyzed_at': analyzed_at, 'latency': latency, 'extra': extra or {}}
+
+    def put_many(self, results):
+        for result in results:
+            self.put(*result)
+
+    def iter_results(self, method=None):
+        self.flush()
+        return self.store.iter_results(method)
+
+    # Function to wait until everything queued so far is written
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        with self.idle:
+            if self.closed:
+                return
+            self.closed = True
+            while self.putting:
+                self.idle.wait()
+            waiting = len(self.pending)
+        if waiting:
+            print(f"Writing {waiting} queued results ...")
+        self.queue.put(_STOP)
+        self.thread.join()
+        atexit.unregister(self.close)
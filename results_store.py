@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from result_writer import WriteBehindStore, WRITE_BEHIND
+
+# Backend used by the scoring scripts: "sidecar" (one JSON file per input, the legacy
+# layout) or "sqlite" (one table in the data root)
+RESULTS_BACKEND = os.environ.get("CTA_RESULTS_STORE", "sidecar")
+SQLITE_FILENAME = 'cta_results.sqlite'
+
+# Legacy sidecar layout per scoring method: file suffix and the keys used inside the file
+METHODS = {
+    'img-api': {'suffix': '-cta-img.json', 'filename_key': 'original_filename',
+                'score_key': 'cta_img_score', 'response_key': 'api_img_response'},
+    'img-loc': {'suffix': '-cta-img-loc.json', 'filename_key': 'original_loc_filename',
+                'score_key': 'cta_img_loc_score', 'response_key': 'api_img_loc_response'},
+    'txt-api': {'suffix': '-cta-txt.json', 'filename_key': 'original_filename',
+                'score_key': 'cta_txt_score', 'response_key': 'api_txt_response'},
+    'txt-loc': {'suffix': '-cta-txt-loc.json', 'filename_key': 'original_loc_filenam',
+                'score_key': 'cta_txt_loc_score', 'response_key': 'api_txt_loc_response',
+                'date_key': 'analysis_date'},
+    # Caption scores of LLaVA from cta-post.py --backend loc, kept apart from the llama3.1 ones
+    'txt-llava': {'suffix': '-cta-txt-llava.json', 'filename_key': 'original_filename',
+                  'score_key': 'cta_txt_llava_score', 'response_key': 'api_txt_llava_response'},
+    'local': {'suffix': '-cta-local.json', 'filename_key': 'original_filename',
+              'score_key': 'cta_txt_score', 'response_key': 'api_txt_response',
+              'date_key': 'check_date', 'checked': True},
+}
+
+
+def sidecar_path(input_path, method):
+    return os.path.splitext(input_path)[0] + METHODS[method]['suffix']
+
+
+# Function to build the legacy sidecar JSON for one result
+def build_sidecar(method, input_path, score, response, analyzed_at=None, extra=None):
+    layout = METHODS[method]
+    result = {layout['filename_key']: os.path.basename(input_path)}
+    if score is not None:
+        result[layout['score_key']] = score
+        result[layout['response_key']] = response
+    if layout.get('checked'):
+        result['checked'] = True
+    if 'date_key' in layout:
+        result[layout['date_key']] = analyzed_at or datetime.now().isoformat()
+    if extra:
+        result.update(extra)
+    return result
+
+
+# Function to write a sidecar through a temporary file, so a crash never leaves half of one behind
+# and a rewrite always changes the mtime of its directory (see result_manifest.py)
+def write_sidecar(path, sidecar):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(sidecar, outfile, indent=4)
+    os.replace(tmp_path, path)
+
+
+# Function to turn a legacy sidecar back into a result row
+def parse_sidecar(method, path, data):
+    layout = METHODS[method]
+    known = {layout['filename_key'], layout['score_key'], layout['response_key'], 'checked', layout.get('date_key')}
+    filename = data.get(layout['filename_key'])
+    if filename is None:
+        # The input keeps its name, only the extension is unknown
+        filename = os.path.basename(path)[:-len(layout['suffix'])]
+    return {
+        'input_path': os.path.join(os.path.dirname(path), filename),
+        'method': method,
+        'model': data.get('model'),
+        'score': data.get(layout['score_key']),
+        'response': data.get(layout['response_key']),
+        'analyzed_at': data.get(layout.get('date_key')) if 'date_key' in layout else None,
+        'latency': data.get('latency'),
+        'extra': {key: value for key, value in data.items() if key not in known and key not in ('model', 'latency')},
+    }
+
+
+class SidecarStore:
+    # Writes one JSON file next to every input, exactly as the scripts always did
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+
+    # A sidecar that is empty or does not end with the closing brace (truncated by a crash during
+    # a write) counts as missing. Only its last bytes are read, the scripts call this for every input.
+    def exists(self, input_path, method, model=None):
+        path = sidecar_path(input_path, method)
+        try:
+            with open(path, 'rb') as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - 16))
+                return f.read().rstrip().endswith(b'}')
+        except FileNotFoundError:
+            return False
+
+    def get(self, input_path, method, model=None):
+        path = sidecar_path(input_path, method)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return parse_sidecar(method, path, json.load(f))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Truncated by a crash of an older version, treat as not analyzed
+            print(f"{os.path.basename(path)}: Invalid JSON, ignoring it")
+            return None
+
+    def put(self, input_path, method, model, score, response, latency=None, extra=None, analyzed_at=None):
+        result = build_sidecar(method, input_path, score, response, analyzed_at, extra)
+        write_sidecar(sidecar_path(input_path, method), result)
+
+    def put_many(self, results):
+        for result in results:
+            self.put(*result)
+
+    # Function to read all results of one method by walking the tree
+    def iter_results(self, method):
+        suffix = METHODS[method]['suffix']
+        for subdir, _, files in os.walk(self.root_directory):
+            for filename in files:
+                if filename.endswith(suffix):
+                    path = os.path.join(subdir, filename)
+                    try:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            data = json.load(f)
+                    except ValueError:
+                        print(f"{filename}: Invalid JSON, ignoring it")
+                        continue
+                    yield parse_sidecar(method, path, data)
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    # One row per (input, method, model) in a single WAL-mode database
+    def __init__(self, root_directory, path=None):
+        self.root_directory = root_directory
+        self.path = path or os.path.join(root_directory, SQLITE_FILENAME)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " input_path TEXT NOT NULL,"
+            " method TEXT NOT NULL,"
+            " model TEXT NOT NULL DEFAULT '',"
+            " score REAL,"
+            " response TEXT,"
+            " analyzed_at TEXT,"
+            " created REAL,"
+            " latency REAL,"
+            " extra TEXT,"
+            " PRIMARY KEY (input_path, method, model))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_method ON results (method)")
+
+    def _relative(self, input_path):
+        return os.path.relpath(input_path, self.root_directory).replace(os.sep, '/')
+
+    def _absolute(self, relative_path):
+        return os.path.join(self.root_directory, *relative_path.split('/'))
+
+    def _row_to_result(self, row):
+        input_path, method, model, score, response, analyzed_at, latency, extra = row
+        return {
+            'input_path': self._absolute(input_path),
+            'method': method,
+            'model': model or None,
+            'score': score,
+            'response': response,
+            'analyzed_at': analyzed_at,
+            'latency': latency,
+            'extra': json.loads(extra) if extra else {},
+        }
+
+    def _where(self, input_path, method, model):
+        query = "WHERE input_path = ? AND method = ?"
+        params = [self._relative(input_path), method]
+        if model is not None:
+            query += " AND model = ?"
+            params.append(model)
+        return query, params
+
+    def exists(self, input_path, method, model=None):
+        query, params = self._where(input_path, method, model)
+        with self.lock:
+            return self.conn.execute(f"SELECT 1 FROM results {query} LIMIT 1", params).fetchone() is not None
+
+    def get(self, input_path, method, model=None):
+        query, params = self._where(input_path, method, model)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT input_path, method, model, score, response, analyzed_at, latency, extra "
+                f"FROM results {query} ORDER BY created DESC LIMIT 1", params).fetchone()
+        return self._row_to_result(row) if row else None
+
+    def _to_row(self, input_path, method, model, score, response, latency=None, extra=None, analyzed_at=None):
+        return (
+            self._relative(input_path), method, model or '', score, response,
+            analyzed_at or datetime.now().isoformat(), time.time(), latency,
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        )
+
+    def put(self, input_path, method, model, score, response, latency=None, extra=None, analyzed_at=None):
+        self.put_many([(input_path, method, model, score, response, latency, extra, analyzed_at)])
+
+    # Function to write several results (tuples in the argument order of put) in one transaction
+    def put_many(self, results):
+        rows = [self._to_row(*result) for result in results]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO results (input_path, method, model, score, response, analyzed_at, created, latency, extra) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # Function to read all results of one method (or all methods) with a single query
+    def iter_results(self, method=None):
+        query = "SELECT input_path, method, model, score, response, analyzed_at, latency, extra FROM results"
+        params = []
+        if method is not None:
+            query += " WHERE method = ?"
+            params.append(method)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        for row in rows:
+            yield self._row_to_result(row)
+
+    # Function to read the results of one method with a rowid of at least `since`, together with
+    # their rowid. SQLite runs one write transaction at a time and INSERT OR REPLACE gives a replaced
+    # row a new rowid above all others (or the same one when it held the highest), so rows written
+    # after a read always come at or after its highest rowid, unlike `created`, which is taken
+    # before the transaction commits.
+    def iter_results_since(self, method, since=0):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT input_path, method, model, score, response, analyzed_at, latency, extra, rowid "
+                "FROM results WHERE method = ? AND rowid >= ?", (method, since)).fetchall()
+        for row in rows:
+            yield self._row_to_result(row[:-1]), row[-1]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Function to open the results store of a data root. With write_behind the scoring scripts
+# get a WriteBehindStore, which writes on a background thread (unless CTA_WRITE_BEHIND=off).
+def open_store(root_directory, backend=None, write_behind=False):
+    backend = backend or RESULTS_BACKEND
+    if backend == 'sidecar':
+        store = SidecarStore(root_directory)
+    elif backend == 'sqlite':
+        store = SqliteStore(root_directory)
+    else:
+        raise ValueError(f"Unknown results backend: {backend}")
+    if write_behind and WRITE_BEHIND == 'on':
+        return WriteBehindStore(store)
+    return store
+
+
+# Function to write legacy sidecar files for every result in a store
+def export_sidecars(store, method=None, overwrite=False):
+    exported = 0
+    for result in store.iter_results(method):
+        path = sidecar_path(result['input_path'], result['method'])
+        if not overwrite and os.path.exists(path):
+            continue
+        extra = dict(result['extra'])
+        if result['model']:
+            extra['model'] = result['model']
+        sidecar = build_sidecar(result['method'], result['input_path'], result['score'],
+                                result['response'], result['analyzed_at'], extra)
+        write_sidecar(path, sidecar)
+        exported += 1
+    return exported
+
+
+# Function to load existing sidecar files into another store (e.g. to migrate to SQLite)
+def import_sidecars(root_directory, store, method=None):
+    imported = 0
+    sidecars = SidecarStore(root_directory)
+    for name in ([method] if method else METHODS):
+        for result in sidecars.iter_results(name):
+            store.put(result['input_path'], name, result['model'], result['score'], result['response'],
+                      latency=result['latency'], extra=result['extra'] or None, analyzed_at=result['analyzed_at'])
+            imported += 1
+    return imported
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3 or sys.argv[1] not in ('export', 'import'):
+        print("Usage: python results_store.py export|import <root_directory> [method]")
+        sys.exit(1)
+    root_directory = sys.argv[2]
+    method = sys.argv[3] if len(sys.argv) > 3 else None
+    store = SqliteStore(root_directory)
+    if sys.argv[1] == 'export':
+        print(f"Exported {export_sidecars(store, method)} sidecar files.")
+    else:
+        print(f"Imported {import_sidecars(root_directory, store, method)} sidecar files into {store.path}.")
+    store.close()
@@ -0,0 +1,161 @@
+import math
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Status codes that are worth retrying (rate limit, timeouts, server errors)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    # Two buckets that refill continuously: one for requests, one for tokens.
+    # Both budgets are given per minute, as on the OpenAI limits page.
+    def __init__(self, requests_per_minute, tokens_per_minute=None):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute) if tokens_per_minute else None
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_capacity / 60.0)
+        if self.token_capacity is not None:
+            self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_capacity / 60.0)
+
+    # Function to block until one request with the given token estimate fits the budget
+    def acquire(self, tokens=0):
+        if self.token_capacity is not None:
+            tokens = min(tokens, self.token_capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                delay = self.paused_until - now
+                if delay <= 0:
+                    missing_requests = 1 - self.requests
+                    missing_tokens = tokens - self.tokens if self.token_capacity is not None else 0
+                    if missing_requests <= 0 and missing_tokens <= 0:
+                        self.requests -= 1
+                        if self.token_capacity is not None:
+                            self.tokens -= tokens
+                        return
+                    delay = max(
+                        missing_requests * 60.0 / self.request_capacity,
+                        missing_tokens * 60.0 / self.token_capacity if missing_tokens > 0 else 0,
+                    )
+            time.sleep(min(max(delay, 0.01), 5.0))
+
+    # Function to correct the token budget once the real usage is known
+    def record_usage(self, estimated_tokens, actual_tokens):
+        if self.token_capacity is None or actual_tokens is None:
+            return
+        with self.lock:
+            self.tokens -= actual_tokens - estimated_tokens
+
+    # Function to stop all callers until the server's retry-after has passed
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.requests = min(self.requests, 0.0)
+
+
+def estimate_text_tokens(text):
+    # Roughly four characters per token for English/German text
+    return max(1, len(text) // 4)
+
+
+def estimate_image_tokens(width, height):
+    # Tile based estimate for high detail images: fit into 2048x2048,
+    # scale the short side to 768, then 170 tokens per 512px tile plus 85 base
+    scale = min(1.0, 2048.0 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768.0 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512.0) * math.ceil(height / 512.0)
+    return 85 + 170 * tiles
+
+
+def get_status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+    return status
+
+
+# Function to read the retry delay from a 429 response (in seconds), if the server sent one
+def get_retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000.0
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_retryable(error):
+    status = get_status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ConnectionError, TimeoutError)) or \
+        type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+# Function to run one API call under the limiter, retrying on 429 and transient errors
+def call_with_limits(call, limiter=None, estimated_tokens=0, max_retries=6):
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire(estimated_tokens)
+        try:
+            result = call()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = get_retry_after(e)
+            if delay is None:
+                delay = min(60.0, 2 ** attempt) + random.random()
+            if limiter is not None and get_status_code(e) == 429:
+                limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+            continue
+
+        if limiter is not None:
+            usage = getattr(result, 'usage', None)
+            limiter.record_usage(estimated_tokens, getattr(usage, 'total_tokens', None))
+        return result
+
+
+# Function to process items with at most max_in_flight calls running at once.
+# Yields (item, result, error) in completion order; items are pulled lazily.
+def run_concurrently(items, worker, max_in_flight=8):
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(worker, item)] = item
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                error = future.exception()
+                yield item, (None if error else future.result()), error
@@ -0,0 +1,98 @@
+import os
+import glob
+import json
+import hashlib
+
+
+# Function to parse "i/N" (i counted from 0) into (i, N)
+def parse_shard(value):
+    index, separator, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Shard must look like i/N, got {value!r}")
+    if not separator or count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard must look like i/N with 0 <= i < N, got {value!r}")
+    return index, count
+
+
+# Function to map a post ID to its shard. The hash is stable across machines and Python
+# runs (unlike hash()), so every node computes the same partition.
+def shard_of(post_id, count):
+    digest = hashlib.sha1(post_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def in_shard(post_id, shard):
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(post_id, count) == index
+
+
+# Function to name the summary a shard writes instead of the combined one
+def shard_summary_path(root_directory, output_filename, shard):
+    if shard is None:
+        return os.path.join(root_directory, output_filename)
+    base, extension = os.path.splitext(output_filename)
+    index, count = shard
+    return os.path.join(root_directory, f"{base}.shard-{index}-of-{count}{extension}")
+
+
+# Function to combine per-shard summaries: counts are added up and score maps joined.
+# Posts never span shards, so nothing is counted twice.
+def merge_summaries(summaries):
+    merged = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            if isinstance(value, dict):
+                merged.setdefault(key, {}).update(value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+# Function to merge the shard summaries of one output file; fails if a shard is missing
+def merge_shard_summaries(root_directory, output_filename):
+    base, extension = os.path.splitext(output_filename)
+    paths = sorted(glob.glob(os.path.join(root_directory, f"{base}.shard-*-of-*{extension}")))
+    if not paths:
+        raise FileNotFoundError(f"No shard summaries for {output_filename} in {root_directory}")
+
+    counts = set()
+    indexes = set()
+    summaries = []
+    for path in paths:
+        index, count = os.path.basename(path)[len(base) + len('.shard-'):-len(extension)].split('-of-')
+        indexes.add(int(index))
+        counts.add(int(count))
+        with open(path, 'r', encoding='utf-8') as f:
+            summaries.append(json.load(f))
+    if len(counts) != 1:
+        raise ValueError(f"Shard summaries of different runs: {sorted(counts)} shards")
+    missing = set(range(counts.pop())) - indexes
+    if missing:
+        raise ValueError(f"Missing shard summaries: {sorted(missing)}")
+
+    merged = merge_summaries(summaries)
+    output_path = os.path.join(root_directory, output_filename)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(merged, f, indent=2, ensure_ascii=False)
+    return output_path, merged
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python sharding.py <root_directory> [summary filename ...]")
+        sys.exit(1)
+    root_directory = sys.argv[1]
+    filenames = sys.argv[2:] or ['updated_cta_analysis_summary.json', 'cta_txt_analysis_summary.json']
+    for filename in filenames:
+        try:
+            output_path, _ = merge_shard_summaries(root_directory, filename)
+            print(f"Merged summary saved to: {output_path}")
+        except (OSError, ValueError) as e:
+            print(f"{filename}: {e}")
@@ -0,0 +1,300 @@
+import os
+import json
+import time
+from artifact_index import refresh_index, save_index, scan_directory, is_image, is_post_json
+from post_metadata import extract_metadata, parse_time, in_window
+from work_queue import WorkQueue
+
+# inotify is only used when inotify_simple is installed (Linux); otherwise the data root is polled
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# "auto" uses inotify when it is available, "poll" always polls the artifact index
+WATCH_MODE = os.environ.get("CTA_WATCH_MODE", "auto")
+# Seconds between polls (and the longest wait for an inotify event)
+WATCH_INTERVAL = float(os.environ.get("CTA_WATCH_INTERVAL", 10))
+# A new file is taken once its size and mtime did not change for this many seconds
+SETTLE_SECONDS = float(os.environ.get("CTA_WATCH_SETTLE", 5))
+# An idle model is loaded again after this many seconds, so the server never unloads it
+KEEP_WARM_SECONDS = float(os.environ.get("CTA_KEEP_WARM_SECONDS", 600))
+
+RELEVANT_FILENAME = 'relevant_post_filenames.json'
+
+
+# Function to list the files of `index` that are not in `old_dirs` (directories with an unchanged
+# mtime are skipped)
+def new_files(root_directory, old_dirs, index):
+    paths = []
+    for rel_dir, entry in index['dirs'].items():
+        old = old_dirs.get(rel_dir)
+        if old is not None and old['mtime'] == entry['mtime']:
+            continue
+        known = set(old['files']) if old is not None else set()
+        paths.extend(os.path.join(root_directory, rel_dir, filename)
+                     for filename in entry['files'] if filename not in known)
+    return paths
+
+
+class PollingSource:
+    # New files from the artifact index, which only lists directories whose mtime changed
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+        self.index = refresh_index(root_directory)
+        save_index(root_directory, self.index)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        old_dirs = self.index['dirs']
+        self.index = refresh_index(self.root_directory, self.index)
+        save_index(self.root_directory, self.index)
+        return new_files(self.root_directory, old_dirs, self.index)
+
+
+class InotifySource:
+    # New and rewritten files from inotify, with a watch on every directory of the tree. The
+    # artifact index is kept up to date for the directories with events, so when the kernel queue
+    # overflows and events are lost, the tree can be compared with it instead.
+    def __init__(self, root_directory):
+        self.root_directory = root_directory
+        self.inotify = INotify()
+        self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE_SELF
+        self.directories = {}
+        self._watch_tree(root_directory)
+        self.index = refresh_index(root_directory)
+        save_index(root_directory, self.index)
+
+    # Function to watch a directory and everything below it; returns the files already in it
+    # (the directories are added to `touched`)
+    def _watch_tree(self, directory, touched=None):
+        found = []
+        for subdir, _, filenames in os.walk(directory):
+            self.directories[self.inotify.add_watch(subdir, self.mask)] = subdir
+            if touched is not None:
+                touched.add(subdir)
+            found.extend(os.path.join(subdir, filename) for filename in filenames)
+        return found
+
+    def _rel_dir(self, directory):
+        rel_dir = os.path.relpath(directory, self.root_directory)
+        return '' if rel_dir == '.' else rel_dir
+
+    # Function to list the directories with events again; returns their files that are not in the
+    # index yet (also ones whose event is still queued, so an overflow cannot lose them)
+    def _update_index(self, touched):
+        paths = []
+        for directory in touched:
+            rel_dir = self._rel_dir(directory)
+            try:
+                entry = scan_directory(self.root_directory, rel_dir)
+            except OSError:
+                self.index['dirs'].pop(rel_dir, None)
+                continue
+            old = self.index['dirs'].get(rel_dir)
+            known = set(old['files']) if old is not None else set()
+            paths.extend(os.path.join(directory, filename) for filename in entry['files'] if filename not in known)
+            self.index['dirs'][rel_dir] = entry
+        return paths
+
+    # Function to catch up after a queue overflow: directories created in the meantime are watched
+    # and every file that is not in the index is returned
+    def _rescan(self):
+        print("inotify queue overflowed, rescanning the data root")
+        old_dirs = self.index['dirs']
+        self.index = refresh_index(self.root_directory, self.index)
+        save_index(self.root_directory, self.index)
+        watched = {self._rel_dir(directory) for directory in self.directories.values()}
+        for rel_dir in self.index['dirs']:
+            if rel_dir not in watched:
+                directory = os.path.join(self.root_directory, rel_dir)
+                try:
+                    self.directories[self.inotify.add_watch(directory, self.mask)] = directory
+                except OSError as e:
+                    print(f"Could not watch {directory}: {e}")
+        return new_files(self.root_directory, old_dirs, self.index)
+
+    def wait(self, timeout):
+        paths = []
+        touched = set()
+        overflow = False
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self.directories.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & (flags.DELETE_SELF | flags.IGNORED):
+                # The directory is gone (or its watch was removed)
+                del self.directories[event.wd]
+                continue
+            if not event.name:
+                continue
+            touched.add(directory)
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                # Files can land in a new post folder before its watch is in place
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    try:
+                        paths.extend(self._watch_tree(path, touched))
+                    except OSError as e:
+                        print(f"Could not watch {path}: {e}")
+            else:
+                paths.append(path)
+        if overflow:
+            paths.extend(self._rescan())
+        else:
+            paths.extend(self._update_index(touched))
+        return paths
+
+
+def open_source(root_directory):
+    if WATCH_MODE != 'poll' and INotify is not None:
+        try:
+            return InotifySource(root_directory)
+        except OSError as e:
+            # e.g. fs.inotify.max_user_watches is too low for the tree
+            print(f"inotify not available ({e}), polling every {WATCH_INTERVAL:.0f} seconds instead")
+    return PollingSource(root_directory)
+
+
+class Debouncer:
+    # Holds new files until their size and mtime did not change for `settle` seconds,
+    # so partially written posts and pictures are never scored
+    def __init__(self, settle=SETTLE_SECONDS):
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, paths):
+        for path in paths:
+            self.pending.setdefault(path, None)
+
+    def settled(self):
+        now = time.time()
+        ready = []
+        for path, state in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed again (or renamed, which shows up as a new file)
+                del self.pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime)
+            if state is None or state[:2] != current:
+                self.pending[path] = (*current, now)
+            elif now - state[2] >= self.settle:
+                ready.append(path)
+                del self.pending[path]
+        return ready
+
+
+def load_relevant(root_directory):
+    try:
+        with open(os.path.join(root_directory, RELEVANT_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'since': None, 'until': None, 'filenames': []}
+
+
+# Function to add posts to relevant_post_filenames.json. The file is read again first, so
+# posts that another watcher added in the meantime are kept.
+def add_relevant_posts(root_directory, filenames):
+    data = load_relevant(root_directory)
+    data['filenames'] = sorted(set(data['filenames']) | set(filenames))
+    data['total_posts_from_dec_2023'] = len(data['filenames'])
+    output_file = os.path.join(root_directory, RELEVANT_FILENAME)
+    tmp_path = f"{output_file}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, output_file)
+
+
+class PostWatcher:
+    # Reports new post JSONs within the date window of relevant_post_filenames.json (as written by
+    # getRelevantPosts.py) and the pictures of relevant posts, once they are completely written.
+    # Pictures that land before their post JSON wait for it.
+    def __init__(self, root_directory, settle=SETTLE_SECONDS, interval=WATCH_INTERVAL):
+        self.root_directory = os.path.abspath(root_directory)
+        self.interval = interval
+        relevant = load_relevant(root_directory)
+        self.since = parse_time(relevant.get('since'))
+        self.until = parse_time(relevant.get('until'))
+        self.relevant_posts = {filename.replace('.json', '') for filename in relevant['filenames']}
+        self.waiting_pictures = {}
+        self.debouncer = Debouncer(settle)
+        self.source = open_source(root_directory)
+
+    def _candidate(self, path):
+        filename = os.path.basename(path)
+        # Summaries and manifests are written to the data root, posts live in their own folders
+        if os.path.dirname(os.path.abspath(path)) == self.root_directory or filename.endswith('.tmp'):
+            return False
+        return is_post_json(filename) or is_image(filename)
+
+    def _in_window(self, json_path):
+        try:
+            metadata = extract_metadata(json_path)
+        except (OSError, ValueError) as e:
+            print(f"{os.path.basename(json_path)}: Error reading JSON - {e}")
+            return False
+        return in_window(parse_time(metadata.get('time')), self.since, self.until)
+
+    # Function to wait for new files; returns the new relevant post JSONs and pictures
+    def poll(self):
+        timeout = min(self.interval, self.debouncer.settle) if self.debouncer.pending else self.interval
+        self.debouncer.add(path for path in self.source.wait(timeout) if self._candidate(path))
+
+        posts, pictures = [], []
+        for path in self.debouncer.settled():
+            filename = os.path.basename(path)
+            if is_post_json(filename):
+                if self._in_window(path):
+                    post_id = os.path.splitext(filename)[0]
+                    self.relevant_posts.add(post_id)
+                    posts.append(path)
+                    pictures.extend(self.waiting_pictures.pop(post_id, []))
+            else:
+                post_id = filename.split('_')[0]
+                if post_id in self.relevant_posts:
+                    pictures.append(path)
+                else:
+                    self.waiting_pictures.setdefault(post_id, []).append(path)
+        if posts:
+            add_relevant_posts(self.root_directory, [f"{post_id}.json" for post_id in self.relevant_posts])
+        return posts, pictures
+
+
+# Function to keep a scoring script running: new inputs from `find_new()` go into the work queue
+# of `method` and are scored with `score(input_path)`, which raises when an input could not be
+# scored (the queue retries it). `on_scored(input_path, result)` sees every result and `on_batch()`
+# runs after the queue was drained, e.g. to update the summary. The model is loaded again when it
+# was idle for KEEP_WARM_SECONDS.
+def watch_and_score(root_directory, method, find_new, score, on_scored, on_batch, client, model, workers):
+    queue = WorkQueue(root_directory)
+    last_request = time.time()
+    print(f"Watching {root_directory} for new inputs ({method}), stop with Ctrl+C.")
+    try:
+        while True:
+            new_inputs = find_new()
+            if new_inputs:
+                print(f"{queue.enqueue(method, new_inputs)} new inputs queued for {method}.")
+
+            drained = False
+            while queue.has_pending(method):
+                for job, result, error in client.map(queue.iter_jobs(method, batch_size=workers),
+                                                     lambda job: score(job['input_path']), workers):
+                    if queue.finish(job, error) and error is None:
+                        on_scored(job['input_path'], result)
+                drained = True
+                last_request = time.time()
+
+            if drained:
+                on_batch()
+            elif time.time() - last_request >= KEEP_WARM_SECONDS:
+                client.preload(model)
+                last_request = time.time()
+    except KeyboardInterrupt:
+        print("Watch mode stopped.")
+    finally:
+        queue.close()
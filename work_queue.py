@@ -0,0 +1,269 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+# "on" lets the scoring scripts drain a shared queue in the data root instead of walking the tree
+# on their own, so several processes (or machines on the same share) can work on one run
+QUEUE_MODE = os.environ.get("CTA_QUEUE", "off")
+QUEUE_FILENAME = 'cta_queue.sqlite'
+# Seconds a worker may hold a job before another worker takes it over
+LEASE_SECONDS = float(os.environ.get("CTA_LEASE_SECONDS", 900))
+MAX_ATTEMPTS = int(os.environ.get("CTA_MAX_ATTEMPTS", 3))
+# Seconds a failed job waits before its next attempt, doubled with every attempt, so a server
+# that is down does not use up all attempts within seconds
+RETRY_DELAY = float(os.environ.get("CTA_RETRY_DELAY", 30))
+
+STATES = ('pending', 'leased', 'done', 'failed')
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    # One row per (method, input file). Leases are taken in short write transactions,
+    # so concurrent workers never get the same job while its lease is valid.
+    def __init__(self, root_directory, path=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.root_directory = root_directory
+        self.path = path or os.path.join(root_directory, QUEUE_FILENAME)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=60)
+        # Rollback journal instead of WAL: WAL needs shared memory and does not work when
+        # machines share the data root over a network file system
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " method TEXT NOT NULL,"
+            " input_path TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT,"
+            " lease_expires REAL,"
+            " last_error TEXT,"
+            " not_before REAL,"
+            " created REAL,"
+            " updated REAL,"
+            " PRIMARY KEY (method, input_path))"
+        )
+        # Queues created before retries were delayed
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if 'not_before' not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (method, state)")
+        # Jobs leased by this process and not finished yet; their leases are renewed in the background
+        self.held = {}
+        self.stop = threading.Event()
+        self.renewer = None
+
+    def _relative(self, input_path):
+        return os.path.relpath(input_path, self.root_directory).replace(os.sep, '/')
+
+    def _absolute(self, relative_path):
+        return os.path.join(self.root_directory, *relative_path.split('/'))
+
+    # Function to add input files as pending jobs; files that are already queued keep their state
+    def enqueue(self, method, input_paths):
+        now = time.time()
+        rows = [(method, self._relative(path), now, now) for path in input_paths]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (method, input_path, created, updated) VALUES (?, ?, ?, ?)", rows)
+            added = self.conn.total_changes - before
+            self.conn.execute("COMMIT")
+        return added
+
+    # Function to lease up to `limit` jobs: pending ones whose retry time has come first, then
+    # leases that expired because their worker died. Every lease counts as one attempt.
+    def lease(self, method, owner, limit=1):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT input_path, attempts FROM jobs WHERE method = ? AND "
+                    "((state = 'pending' AND (not_before IS NULL OR not_before <= ?)) OR (state = 'leased' AND lease_expires < ?)) "
+                    "ORDER BY state DESC, created LIMIT ?", (method, now, now, limit)).fetchall()
+                self.conn.executemany(
+                    "UPDATE jobs SET state = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+                    "WHERE method = ? AND input_path = ?",
+                    [(owner, now + self.lease_seconds, now, method, input_path) for input_path, _ in rows])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        jobs = [{'method': method, 'input_path': self._absolute(input_path), 'attempts': attempts + 1, 'owner': owner}
+                for input_path, attempts in rows]
+        self._hold(jobs)
+        return jobs
+
+    def _hold(self, jobs):
+        with self.lock:
+            for job in jobs:
+                self.held[(job['method'], job['input_path'])] = job
+            if jobs and self.renewer is None:
+                self.renewer = threading.Thread(target=self._renew_held, daemon=True)
+                self.renewer.start()
+
+    # Function to renew the leases of all held jobs every third of the lease time, so a job
+    # that takes longer than its lease (or waits in a prefetch queue) is not handed out again
+    def _renew_held(self):
+        while not self.stop.wait(self.lease_seconds / 3):
+            with self.lock:
+                jobs = list(self.held.values())
+            for job in jobs:
+                if not self.renew(job):
+                    # Lost the lease (expired before a renewal), another worker may own it now
+                    with self.lock:
+                        self.held.pop((job['method'], job['input_path']), None)
+
+    def _finish(self, job, state, error=None, not_before=None):
+        with self.lock:
+            self.held.pop((job['method'], job['input_path']), None)
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?, not_before = ?, updated = ? "
+                "WHERE method = ? AND input_path = ? AND state = 'leased' AND lease_owner = ?",
+                (state, error, not_before, time.time(), job['method'], self._relative(job['input_path']), job['owner']))
+            return cursor.rowcount == 1
+
+    # Function to mark a job as done once its result is committed to the results store.
+    # Returns False if the lease had expired and another worker owns the job now.
+    def complete(self, job):
+        return self._finish(job, 'done')
+
+    # Function to put a failed job back as pending after its retry delay, or mark it failed
+    # after max_attempts
+    def fail(self, job, error):
+        if job['attempts'] >= self.max_attempts:
+            return self._finish(job, 'failed', str(error)[:2000])
+        not_before = time.time() + self.retry_delay * 2 ** (job['attempts'] - 1)
+        return self._finish(job, 'pending', str(error)[:2000], not_before)
+
+    # Function to complete or fail a job depending on the error returned by the worker
+    def finish(self, job, error=None):
+        if error is None:
+            return self.complete(job)
+        return self.fail(job, error)
+
+    # Function to extend the lease of a job that is still being worked on (done automatically
+    # for the jobs leased by this queue object)
+    def renew(self, job):
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE method = ? AND input_path = ? AND state = 'leased' AND lease_owner = ?",
+                (time.time() + self.lease_seconds, job['method'], self._relative(job['input_path']), job['owner']))
+            return cursor.rowcount == 1
+
+    # Function to yield leased jobs until none can be leased. Jobs are leased in small
+    # batches when the consumer asks for them, so leases start shortly before the work.
+    # When only failed jobs waiting for their retry are left, it waits for the first of them.
+    def iter_jobs(self, method, owner=None, batch_size=4):
+        owner = owner or worker_name()
+        while True:
+            jobs = self.lease(method, owner, batch_size)
+            if not jobs:
+                wait = self.next_retry(method)
+                if wait is None:
+                    return
+                time.sleep(wait)
+                continue
+            yield from jobs
+
+    # Function to return the seconds until the next failed job of a method may be retried
+    # (None if no job is waiting)
+    def next_retry(self, method):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(not_before) FROM jobs WHERE method = ? AND state = 'pending' AND not_before > ?",
+                (method, now)).fetchone()
+        return None if row[0] is None else row[0] - now
+
+    # Function to check whether jobs can still be leased (pending, or leases that expired).
+    # Failed attempts go back to pending (waiting for their retry), so callers drain the queue
+    # until this is False.
+    def has_pending(self, method):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM jobs WHERE method = ? AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?)) LIMIT 1",
+                (method, time.time())).fetchone() is not None
+
+    # Function to send failed jobs back to pending with a fresh attempt count.
+    # `error_like` selects jobs by their last error (SQL LIKE pattern).
+    def retry(self, method=None, error_like=None, state='failed'):
+        query = "UPDATE jobs SET state = 'pending', attempts = 0, lease_owner = NULL, lease_expires = NULL, not_before = NULL, updated = ? WHERE state = ?"
+        params = [time.time(), state]
+        if method is not None:
+            query += " AND method = ?"
+            params.append(method)
+        if error_like is not None:
+            query += " AND last_error LIKE ?"
+            params.append(error_like)
+        with self.lock:
+            return self.conn.execute(query, params).rowcount
+
+    def counts(self, method=None):
+        query = "SELECT method, state, COUNT(*) FROM jobs"
+        params = []
+        if method is not None:
+            query += " WHERE method = ?"
+            params.append(method)
+        with self.lock:
+            rows = self.conn.execute(query + " GROUP BY method, state", params).fetchall()
+        counts = {}
+        for row_method, state, count in rows:
+            counts.setdefault(row_method, dict.fromkeys(STATES, 0))[state] = count
+        return counts
+
+    def failures(self, method=None):
+        query = "SELECT method, input_path, attempts, last_error FROM jobs WHERE state = 'failed'"
+        params = []
+        if method is not None:
+            query += " AND method = ?"
+            params.append(method)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [{'method': row_method, 'input_path': self._absolute(input_path), 'attempts': attempts, 'last_error': error}
+                for row_method, input_path, attempts, error in rows]
+
+    def close(self):
+        self.stop.set()
+        if self.renewer is not None:
+            self.renewer.join()
+        with self.lock:
+            self.conn.close()
+
+
+# Function to print the queue state of one or all methods
+def print_counts(queue, method=None):
+    for row_method, counts in sorted(queue.counts(method).items()):
+        print(f"{row_method}: " + ", ".join(f"{state} {counts[state]}" for state in STATES))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect and reset the work queue of a data root.")
+    parser.add_argument('command', choices=['status', 'failures', 'retry'])
+    parser.add_argument('root_directory')
+    parser.add_argument('--method', default=None, help="img-api, img-loc, txt-api, txt-loc or local")
+    parser.add_argument('--error', default=None, help="only retry jobs whose last error contains this text")
+    parser.add_argument('--leased', action='store_true', help="retry jobs that are still leased (after a crash)")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.root_directory)
+    if args.command == 'status':
+        print_counts(queue, args.method)
+    elif args.command == 'failures':
+        for job in queue.failures(args.method):
+            print(f"{job['method']} {job['input_path']} (attempts: {job['attempts']}): {job['last_error']}")
+    else:
+        error_like = f"%{args.error}%" if args.error else None
+        retried = queue.retry(args.method, error_like, 'leased' if args.leased else 'failed')
+        print(f"{retried} jobs are pending again.")
+    queue.close()